@@ -0,0 +1,61 @@
+"""
+Shared fixtures for the tests of the RAG skill.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the rag skill directory to path
+RAG_DIR = Path(__file__).parent.parent / "v2" / "rag"
+sys.path.append(str(RAG_DIR))
+sys.path.append(str(RAG_DIR / "benchmarks"))
+
+# the tests count tokens like the benchmarks when the tiktoken BPE files are not available
+from word_encoding import WordEncoding  # noqa: E402
+
+
+@pytest.fixture
+def test_encoding(monkeypatch):
+    """Count tokens with WordEncoding in the indexer and retriever, worker processes inherit it through fork"""
+    import document_indexer
+    import tiktoken
+
+    encoding = WordEncoding()
+    monkeypatch.setattr(document_indexer, "_encoding", encoding)
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model_name: encoding)
+    return encoding
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    """
+    Replace the sentence-transformers model with deterministic vectors, one random 384-dimensional vector per distinct
+    text like all-MiniLM-L6-v2
+    """
+    import document_indexer
+    import document_retriever
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    def fake_model(model_name, backend=None, threads=None):
+        return DeterministicFakeEmbedding(size=384)
+
+    monkeypatch.setattr(document_indexer, "load_embedding_model", fake_model)
+    monkeypatch.setattr(document_retriever, "load_embedding_model", fake_model)
+
+
+@pytest.fixture
+def doc_dir(tmp_path):
+    """A small folder of markdown documents with a sub folder and a few files that cannot be indexed"""
+    from bench_chunking import make_text
+
+    docs = tmp_path / "documents"
+    (docs / "sub").mkdir(parents=True)
+    for i in range(12):
+        folder = docs / "sub" if i % 3 else docs
+        (folder / f"doc{i}.md").write_text(f"# Document {i}\n" + make_text(0.005, seed=i))
+    (docs / "broken.json").write_text("{not json")
+    (docs / "image.png").write_bytes(b"\x89PNG")
+    (docs / "broken.pdf").write_bytes(b"not a pdf")
+    return docs
@@ -0,0 +1,94 @@
+"""
+Tests for the asyncio interface of the RAG retriever.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_community")
+
+
+@pytest.fixture
+def retriever(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_indexer import build_index
+    from document_retriever import DocumentRetriever
+
+    build_index(str(doc_dir), str(tmp_path / "knowledge"), chunk_size=64, chunk_step=32)
+    return DocumentRetriever(str(tmp_path / "knowledge"), cache_size=0)
+
+
+def test_async_matches_retriever(retriever, tmp_path):
+    from async_retriever import AsyncDocumentRetriever
+
+    query = retriever.chunks[4].page_content
+
+    async def run():
+        async with await AsyncDocumentRetriever.load(str(tmp_path / "knowledge"), cache_size=0) as async_retriever:
+            single = await async_retriever(query, size=3)
+            return single, await async_retriever.retrieve_batch([query, "x"], mode="hybrid")
+
+    single, batch = asyncio.run(run())
+    assert single == retriever(query, size=3)
+    assert batch == retriever.retrieve_batch([query, "x"], mode="hybrid")
+
+
+def test_concurrent_calls_are_batched_without_blocking_the_loop(retriever, monkeypatch):
+    from async_retriever import AsyncDocumentRetriever
+
+    retrieve_batch = retriever.retrieve_batch
+    calls = []
+
+    def slow_retrieve_batch(queries, **options):
+        calls.append(queries)
+        time.sleep(0.2)
+        return retrieve_batch(queries, **options)
+
+    queries = [chunk.page_content for chunk in list(retriever.chunks)[:8]]
+    expected = [retriever(query, size=1) for query in queries]
+    monkeypatch.setattr(retriever, "retrieve_batch", slow_retrieve_batch)
+    async_retriever = AsyncDocumentRetriever(retriever, max_wait=0.05)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        results = await asyncio.gather(*(async_retriever(query, size=1) for query in queries))
+        task.cancel()
+        return results, ticks
+
+    try:
+        results, ticks = asyncio.run(run())
+    finally:
+        async_retriever.close()
+    assert results == expected
+    assert calls == [queries]
+    # the event loop kept running while the batch was retrieved
+    assert ticks >= 10
+
+
+def test_cancelled_calls_are_dropped(retriever):
+    from async_retriever import AsyncDocumentRetriever
+
+    async_retriever = AsyncDocumentRetriever(retriever, max_wait=0.2)
+    query = retriever.chunks[0].page_content
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(async_retriever("cancelled", size=1), 0.01)
+        with pytest.raises(ValueError, match="Unsupported search mode"):
+            await async_retriever(query, mode="fuzzy")
+        return await async_retriever(query, size=1)
+
+    try:
+        assert asyncio.run(run()) == retriever(query, size=1)
+    finally:
+        async_retriever.close()
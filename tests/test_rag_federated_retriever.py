@@ -0,0 +1,82 @@
+"""
+Tests for the federated search of the RAG skill over several index folders.
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_community")
+
+
+@pytest.fixture
+def index_folders(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    """One index of the top folder of the documents and one of their sub folder"""
+    import shutil
+
+    from document_indexer import build_index
+
+    shutil.move(str(doc_dir / "sub"), str(tmp_path / "sub"))
+    build_index(str(doc_dir), str(tmp_path / "top_index"), chunk_size=64, chunk_step=32)
+    build_index(str(tmp_path / "sub"), str(tmp_path / "sub_index"), chunk_size=64, chunk_step=32)
+    return [str(tmp_path / "top_index"), str(tmp_path / "sub_index")]
+
+
+def test_single_folder_matches_retriever(index_folders):
+    from document_retriever import DocumentRetriever
+    from federated_retriever import FederatedRetriever
+
+    retriever = DocumentRetriever(index_folders[0], cache_size=0)
+    federated = FederatedRetriever(index_folders[:1], cache_size=0)
+    queries = [retriever.chunks[4].page_content, "lorem"]
+    expected = retriever.retrieve_batch(queries, size=3)
+    assert federated.retrieve_batch(queries, size=3) == [
+        [{**result, "index_folder": index_folders[0]} for result in results] for results in expected
+    ]
+    federated.close()
+
+
+def test_hits_of_all_folders_are_merged_by_score(index_folders, monkeypatch):
+    import document_retriever
+    from document_retriever import DocumentRetriever
+    from federated_retriever import FederatedRetriever
+
+    import os
+
+    from embedding_cache import CachedEmbeddings
+
+    loads = []
+    load_embedding_model = document_retriever.load_embedding_model
+    monkeypatch.setattr(
+        document_retriever, "load_embedding_model", lambda *args: loads.append(args) or load_embedding_model(*args)
+    )
+    for folder in index_folders:
+        os.makedirs(os.path.join(folder, "embedding_cache"))
+    federated = FederatedRetriever(index_folders)
+    # the folders share the embedding model, wrapped in an embedding cache once
+    assert len(loads) == 1
+    embeddings = federated.retrievers[0].embeddings
+    assert all(retriever.embeddings is embeddings for retriever in federated.retrievers)
+    assert isinstance(embeddings, CachedEmbeddings) and not isinstance(embeddings.embeddings, CachedEmbeddings)
+
+    top, sub = (DocumentRetriever(folder) for folder in index_folders)
+    queries = [sub.chunks[7].page_content, top.chunks[2].page_content]
+    results = federated.retrieve_batch(queries, size=4)
+    assert [result["index_folder"] for result in results[0][:1] + results[1][:1]] == index_folders[::-1]
+    assert results[0][0]["score"] == pytest.approx(1.0, abs=1e-3)
+    for query, query_results in zip(queries, results):
+        assert len(query_results) == 4
+        scores = [result["score"] for result in query_results]
+        assert scores == sorted(scores, reverse=True)
+        # the best hit of all folders comes first, the folders' scores are comparable
+        best = max(float(retriever._rank_batch([query], 1)[0][1][0]) for retriever in (top, sub))
+        assert scores[0] == round(best, 4)
+
+    for mode in ("keyword", "hybrid"):
+        results = json.loads(federated(queries[0], size=3, mode=mode))
+        assert results[0]["index_folder"] == index_folders[1]
+        assert 0 < results[-1]["score"] <= results[0]["score"] <= 1
+    with pytest.raises(ValueError, match="Unsupported search mode"):
+        federated(queries[0], mode="fuzzy")
+    federated.close()
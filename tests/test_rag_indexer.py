@@ -0,0 +1,712 @@
+"""
+Tests for the document indexer of the RAG skill.
+"""
+
+import random
+import sys
+
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_community")
+from document_indexer import chunk_str_overlap, iter_chunks_overlap
+from bench_chunking import RegexEncoding, chunk_str_overlap_legacy, make_text
+
+
+def random_text(rng: random.Random) -> str:
+    """Random lines with blank lines, single words and lines longer than a chunk"""
+    lines = []
+    for _ in range(rng.randint(0, 60)):
+        kind = rng.random()
+        if kind < 0.2:
+            lines.append("")
+        elif kind < 0.3:
+            lines.append(" ".join(["long"] * rng.randint(20, 80)))
+        else:
+            lines.append(" ".join(rng.choices(["a", "b", "c", "(", ")"], k=rng.randint(1, 12))))
+    return "\n".join(lines)
+
+
+def test_chunk_str_overlap_matches_legacy_boundaries():
+    """The single-pass chunker produces exactly the chunks of the original implementation"""
+    rng = random.Random(0)
+    enc = RegexEncoding()
+    for _ in range(500):
+        text = random_text(rng)
+        num_tokens = rng.randint(1, 40)
+        step_tokens = rng.randint(1, num_tokens)
+        expected = chunk_str_overlap_legacy(text, num_tokens=num_tokens, step_tokens=step_tokens, encoding=enc)
+        assert chunk_str_overlap(text, num_tokens=num_tokens, step_tokens=step_tokens, encoding=enc) == expected
+
+
+def test_iter_chunks_overlap_matches_legacy_boundaries():
+    """The streaming chunker produces the same chunks, with the line range of each chunk"""
+    rng = random.Random(1)
+    enc = RegexEncoding()
+    for _ in range(500):
+        text = random_text(rng)
+        num_tokens = rng.randint(1, 40)
+        step_tokens = rng.randint(1, num_tokens)
+        lines = text.split("\n")
+        units = [(line, len(enc.encode(line))) for line in lines]
+        chunks = list(iter_chunks_overlap(iter(units), "\n", num_tokens, step_tokens))
+        expected = chunk_str_overlap_legacy(text, num_tokens=num_tokens, step_tokens=step_tokens, encoding=enc)
+        assert [chunk for chunk, _, _ in chunks] == expected
+        assert all(chunk == "\n".join(lines[start:end]) for chunk, start, end in chunks)
+
+
+def test_chunk_str_overlap_large_document():
+    enc = RegexEncoding()
+    text = make_text(0.2)
+    expected = chunk_str_overlap_legacy(text, num_tokens=64, step_tokens=16, encoding=enc)
+    assert chunk_str_overlap(text, num_tokens=64, step_tokens=16, encoding=enc) == expected
+
+
+def test_chunk_str_overlap_empty():
+    assert chunk_str_overlap("", encoding=RegexEncoding()) == []
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="worker processes inherit the test encoding through fork")
+def test_chunk_document_workers_match_serial(test_encoding, doc_dir, capsys):
+    from document_indexer import chunk_document
+
+    serial = chunk_document(str(doc_dir), chunk_size=64, chunk_step=32)
+    parallel = chunk_document(str(doc_dir), chunk_size=64, chunk_step=32, workers=3)
+    assert serial[1]
+    assert parallel == serial
+    # the broken file is reported and the other files are still chunked
+    assert "Error encountered when reading" in capsys.readouterr().out
+
+
+def test_dead_worker_fails_its_files_only(test_encoding, doc_dir, monkeypatch, capsys):
+    import os
+
+    import document_indexer
+    from document_indexer import iter_chunks, iter_files
+
+    files = sorted(iter_files(str(doc_dir)))
+    serial = list(iter_chunks(files, str(doc_dir), 64, 32))
+    text_parser = document_indexer.text_parser
+
+    def crashing_parser(read_file):
+        if read_file.endswith("doc3.md"):
+            # like a segfault in a parser, the worker process dies without an exception
+            os._exit(1)
+        return text_parser(read_file)
+
+    # the forked workers inherit the patched parser
+    monkeypatch.setattr(document_indexer, "text_parser", crashing_parser)
+    failed = []
+    parallel = list(iter_chunks(files, str(doc_dir), 64, 32, workers=2, failed=failed))
+    assert "A worker process died" in capsys.readouterr().out
+    assert "doc3.md" in failed and len(failed) < len(files)
+    assert parallel == [(chunk, metadata) for chunk, metadata in serial if metadata["source"] not in failed]
+    # the files after the crash are parsed in a new pool
+    assert parallel[-1] == serial[-1]
+
+
+def load_chunks(folder):
+    """Return the (source, chunk_id, text) of every vector and check the neighbor index against the chunk store"""
+    import faiss
+    from chunk_store import ChunkStore
+    from neighbor_index import load_neighbor_index
+
+    index = faiss.read_index(str(folder / "index.faiss"))
+    store = ChunkStore.load(str(folder))
+    neighbors = load_neighbor_index(str(folder))
+    chunks = set()
+    for position, doc in enumerate(store):
+        assert neighbors.position(doc.metadata["source"], doc.metadata["chunk_id"]) == position
+        chunks.add((doc.metadata["source"], doc.metadata["chunk_id"], doc.page_content))
+    assert len(neighbors) == len(store) == index.ntotal == len(chunks)
+    assert not (folder / "index.pkl").exists()
+    return chunks
+
+
+@pytest.mark.parametrize("storage", ["float32", "int8"])
+def test_update_index_matches_full_build(test_encoding, fake_embeddings, doc_dir, tmp_path, storage):
+    from document_indexer import build_index, update_index
+    from manifest import load_index_info, load_manifest
+
+    output = tmp_path / "knowledge"
+    build_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32, index_options={"storage": storage})
+    assert load_index_info(str(output))["storage"] == storage
+    assert len(load_manifest(str(output))["files"]) == 15
+
+    (doc_dir / "doc0.md").write_text("# Changed\n" + make_text(0.002, seed=100))
+    (doc_dir / "sub" / "doc1.md").unlink()
+    (doc_dir / "new.txt").write_text("A new document\n" + make_text(0.002, seed=101))
+    update_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32, index_options={"storage": storage})
+    # the int8 index is updated in place, the vectors of the changed and deleted files are removed from it
+    assert load_index_info(str(output))["storage"] == storage
+
+    fresh = tmp_path / "fresh"
+    build_index(str(doc_dir), str(fresh), chunk_size=64, chunk_step=32)
+    assert load_chunks(output) == load_chunks(fresh)
+    assert load_manifest(str(output))["files"].keys() == load_manifest(str(fresh))["files"].keys()
+
+
+def test_small_ivf_pq_index_is_updated_in_place(test_encoding, fake_embeddings, doc_dir, tmp_path, capsys):
+    from document_indexer import PQ_MIN_TRAIN, build_index, update_index
+    from manifest import load_index_info, load_manifest
+
+    output = str(tmp_path / "knowledge")
+    options = {"index_type": "ivf_pq", "nlist": 8, "pq_m": 8}
+    build_index(str(doc_dir), output, chunk_size=128, chunk_step=64, index_options=options)
+    assert sum(entry["chunks"] for entry in load_manifest(output)["files"].values()) < PQ_MIN_TRAIN
+    assert load_index_info(output)["index_type"] == "flat"
+    (doc_dir / "doc0.md").write_text("# Changed\n")
+    capsys.readouterr()
+    update_index(str(doc_dir), output, chunk_size=128, chunk_step=64, index_options=options)
+    assert "indexing all documents" not in capsys.readouterr().out
+    assert load_index_info(output)["requested_type"] == "ivf_pq"
+
+    # once there are enough chunks to train, the next update builds the ivf_pq index
+    for i in range(40):
+        (doc_dir / f"extra{i}.md").write_text("\n".join(f"line {i} {j} " * 5 for j in range(40)))
+    update_index(str(doc_dir), output, chunk_size=128, chunk_step=64, index_options=options)
+    update_index(str(doc_dir), output, chunk_size=128, chunk_step=64, index_options=options)
+    assert load_index_info(output)["index_type"] == "ivf_pq"
+
+
+def test_reservoir_sample_is_uniform():
+    import numpy as np
+    from document_indexer import ReservoirSample
+
+    vectors = np.arange(100000, dtype=np.float32).reshape(-1, 1)
+    sampler = ReservoirSample(1000)
+    for start in range(0, len(vectors), 256):
+        sampler.add(vectors[start : start + 256])
+    sample = sampler.sample[:, 0]
+    assert len(sample) == len(set(sample)) == 1000
+    # the first train_size chunks would all be below 1000
+    assert abs(sample.mean() - 50000) < 3000 and (sample >= 90000).sum() > 50
+    small = ReservoirSample(1000)
+    small.add(vectors[:300])
+    assert np.array_equal(small.sample, vectors[:300])
+
+
+def test_failed_files_are_retried(test_encoding, fake_embeddings, doc_dir, tmp_path, monkeypatch, capsys):
+    import document_indexer
+    from document_indexer import build_index, check_index, update_index
+    from manifest import load_index_info, load_manifest
+
+    parse_and_chunk = document_indexer.parse_and_chunk
+
+    def parse_without_markdown_parser(f, *args):
+        if f.endswith("doc0.md"):
+            return False, "", [], "No markdown parser"
+        return parse_and_chunk(f, *args)
+
+    monkeypatch.setattr(document_indexer, "parse_and_chunk", parse_without_markdown_parser)
+    output = tmp_path / "knowledge"
+    build_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32)
+    files = load_manifest(str(output))["files"]
+    assert files["doc0.md"]["failed"] and files["broken.pdf"]["failed"] and files["doc0.md"]["chunks"] == 0
+    capsys.readouterr()
+    assert check_index(str(doc_dir), str(output), 64, 32)
+    assert "Failed: doc0.md" in capsys.readouterr().out
+
+    # the unchanged file is parsed again once its parser works
+    monkeypatch.setattr(document_indexer, "parse_and_chunk", parse_and_chunk)
+    update_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32)
+    files = load_manifest(str(output))["files"]
+    assert "failed" not in files["doc0.md"] and files["doc0.md"]["chunks"] and files["broken.pdf"]["failed"]
+    fresh = tmp_path / "fresh"
+    build_index(str(doc_dir), str(fresh), chunk_size=64, chunk_step=32)
+    assert load_chunks(output) == load_chunks(fresh)
+    # a file that fails again leaves the index as it is
+    version = load_index_info(str(output))["version"]
+    update_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32)
+    assert load_index_info(str(output))["version"] == version
+    assert load_manifest(str(output))["files"] == files
+
+
+def test_build_index_batch_size_does_not_change_index(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_indexer import build_index
+
+    build_index(str(doc_dir), str(tmp_path / "small"), 64, 32, batch_size=3)
+    build_index(str(doc_dir), str(tmp_path / "large"), 64, 32, batch_size=10000)
+    assert load_chunks(tmp_path / "small") == load_chunks(tmp_path / "large")
+
+
+
+def test_index_files_are_written_from_a_stream(test_encoding, fake_embeddings, doc_dir, tmp_path, monkeypatch):
+    import types
+
+    import chunk_store
+    from document_indexer import build_index, update_index
+
+    write, streams = chunk_store.ChunkStore.write, []
+
+    def spy(folder, documents):
+        streams.append(documents)
+        write(folder, documents)
+
+    monkeypatch.setattr(chunk_store.ChunkStore, "write", staticmethod(spy))
+    output = tmp_path / "knowledge"
+    build_index(str(doc_dir), str(output), 64, 32, batch_size=3)
+    (doc_dir / "doc0.md").write_text("# Changed\n" + make_text(0.002, seed=100))
+    update_index(str(doc_dir), str(output), 64, 32, batch_size=3)
+    # the chunks stream from the spool and the old chunk store to every index file, no list of them is built
+    assert len(streams) == 2 and all(isinstance(stream, types.GeneratorType) for stream in streams)
+    # the spool and the spilled postings are anonymous temporary files
+    assert not [path.name for path in output.iterdir() if path.name.endswith(".tmp")]
+    fresh = tmp_path / "fresh"
+    build_index(str(doc_dir), str(fresh), 64, 32)
+    assert load_chunks(output) == load_chunks(fresh)
+
+def test_embedding_cache_skips_unchanged_chunks(test_encoding, monkeypatch, doc_dir, tmp_path):
+    import document_indexer
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    embedded = []
+
+    class CountingEmbedding(DeterministicFakeEmbedding):
+        def embed_documents(self, texts):
+            embedded.extend(texts)
+            return super().embed_documents(texts)
+
+    monkeypatch.setattr(document_indexer, "load_embedding_model", lambda *args: CountingEmbedding(size=384))
+    cache = str(tmp_path / "cache")
+    document_indexer.build_index(str(doc_dir), str(tmp_path / "a"), 64, 32, embedding_cache=cache)
+    first_run = len(embedded)
+    assert first_run > 0
+
+    (doc_dir / "new.txt").write_text("A new document\nwith two lines")
+    document_indexer.build_index(str(doc_dir), str(tmp_path / "b"), 64, 32, embedding_cache=cache)
+    assert embedded[first_run:] == ["A new document\nwith two lines"]
+    assert load_chunks(tmp_path / "b") >= load_chunks(tmp_path / "a")
+
+
+def test_embedding_cache_shared_between_instances(tmp_path):
+    from embedding_cache import EmbeddingCache
+
+    writer = EmbeddingCache(str(tmp_path))
+    reader = EmbeddingCache(str(tmp_path), readonly=True)
+    keys = [EmbeddingCache.key("model", text) for text in ("a", "b")]
+    assert EmbeddingCache.key("other", "a") != keys[0]
+    writer.put_many(keys, [[1.0, 2.0], [3.0, 4.0]])
+    writer.put_many(keys[:1], [[5.0, 6.0]])
+    assert len(writer) == 2
+    assert [list(v) for v in reader.get_many(keys)] == [[1.0, 2.0], [3.0, 4.0]]
+    assert reader.get_many([EmbeddingCache.key("model", "c")]) == [None]
+
+
+def test_embedding_cache_keys_are_sorted_on_disk(tmp_path, monkeypatch):
+    import embedding_cache
+    from embedding_cache import EmbeddingCache
+
+    monkeypatch.setattr(embedding_cache, "TAIL_ROWS", 8)
+    keys = [EmbeddingCache.key("model", str(i)) for i in range(30)]
+    vectors = [[float(i), -float(i)] for i in range(30)]
+    writer = EmbeddingCache(str(tmp_path))
+    reader = EmbeddingCache(str(tmp_path), readonly=True)
+    for start in range(0, 30, 5):
+        writer.put_many(keys[start : start + 5], vectors[start : start + 5])
+    # the keys are merged into the sorted keys every TAIL_ROWS appended keys, only the last ones are held in memory
+    assert len(writer) == 30 and len(writer.sorted_keys) == 30 and not writer.tail
+    assert list(writer.sorted_keys) == sorted(writer.sorted_keys)
+    writer.put_many(keys[:1] + [EmbeddingCache.key("model", "30")], vectors[:1] + [[30.0, -30.0]])
+    assert len(writer) == 31 and len(writer.tail) == 1
+    for cache in (writer, reader, EmbeddingCache(str(tmp_path), readonly=True)):
+        assert [list(v) for v in cache.get_many(keys)] == vectors
+        assert cache.get_many([EmbeddingCache.key("model", "missing")]) == [None]
+    # a reader reads the sorted keys merged by the writer and only the keys appended after them
+    assert len(reader.sorted_keys) == 30 and len(reader.tail) == 1
+
+    # a cache written before there were sorted keys is sorted when a writer opens it
+    (tmp_path / "sorted_keys.bin").unlink()
+    assert len(EmbeddingCache(str(tmp_path), readonly=True).tail) == 31
+    assert len(EmbeddingCache(str(tmp_path)).sorted_keys) == 31
+    assert [list(v) for v in EmbeddingCache(str(tmp_path), readonly=True).get_many(keys)] == vectors
+
+
+def test_embedding_cache_recovers_from_torn_append(tmp_path):
+    from embedding_cache import EmbeddingCache
+
+    keys = [EmbeddingCache.key("model", text) for text in ("a", "b", "c")]
+    EmbeddingCache(str(tmp_path)).put_many(keys[:1], [[1.0, 2.0]])
+    # a writer died after appending its vectors and part of its keys
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(b"\0" * 8 * 3)
+    with open(tmp_path / "keys.bin", "ab") as f:
+        f.write(keys[2][:5])
+    cache = EmbeddingCache(str(tmp_path))
+    assert cache.get_many(keys[1:]) == [None, None]
+    cache.put_many(keys[1:], [[3.0, 4.0], [5.0, 6.0]])
+    for cache in (cache, EmbeddingCache(str(tmp_path), readonly=True)):
+        assert [list(v) for v in cache.get_many(keys)] == [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+
+
+def write_docx(path, pages):
+    """Write a minimal docx file, each page is a list of paragraphs followed by a rendered page break"""
+    import zipfile
+
+    body = ""
+    for i, paragraphs in enumerate(pages):
+        for j, paragraph in enumerate(paragraphs):
+            page_break = "<w:r><w:lastRenderedPageBreak/></w:r>" if i and j == 0 else ""
+            body += f"<w:p>{page_break}<w:r><w:t>{paragraph}</w:t></w:r></w:p>"
+    xml = (
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f"<w:body>{body}</w:body></w:document>"
+    )
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("word/document.xml", xml)
+
+
+def test_docx_chunks_carry_page_numbers(test_encoding, tmp_path):
+    from document_indexer import clean_text, iter_pages, parse_and_chunk, text_parser
+
+    pages = [[f"page {p} paragraph {i} " + "word " * 10 for i in range(5)] for p in range(1, 4)]
+    write_docx(tmp_path / "manual.docx", pages)
+    assert [page for page, _ in iter_pages(str(tmp_path / "manual.docx"), "docx")] == [1, 2, 3]
+
+    parsed, title, chunks, error = parse_and_chunk(str(tmp_path / "manual.docx"), 40, 20)
+    chunks = list(chunks)
+    assert parsed and not error
+    assert title.startswith("page 1 paragraph 0")
+    for chunk, metadata in chunks:
+        pages_in_chunk = {int(line.split()[1]) for line in chunk.split("\n") if line}
+        assert (min(pages_in_chunk), max(pages_in_chunk)) == (metadata["page"], metadata["page_end"])
+    assert chunks[-1][1]["page_end"] == 3
+    # text_parser extracts docx files with the same code
+    text = "".join(text for _, text in iter_pages(str(tmp_path / "manual.docx"), "docx"))
+    assert text_parser(str(tmp_path / "manual.docx")) == (text.split("\n")[0], clean_text(text))
+
+
+
+def test_paged_files_are_chunked_in_flat_memory(test_encoding, tmp_path, monkeypatch):
+    import tempfile
+    import tracemalloc
+
+    from document_indexer import iter_chunks
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    (tmp_path / "docs").mkdir()
+    pages = [[f"page {p} paragraph {i} " + "word " * 12 for i in range(8)] for p in range(1, 601)]
+    write_docx(tmp_path / "docs" / "manual.docx", pages)
+    tracemalloc.start()
+    try:
+        total = 0
+        for chunk, metadata in iter_chunks([str(tmp_path / "docs" / "manual.docx")], str(tmp_path / "docs"), 64, 8):
+            total += len(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert metadata["page_end"] == 600 and total > 2 * 1024 * 1024
+    assert peak < total / 4
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["docs"]
+
+def write_pdf(path, pages):
+    """Write a minimal pdf file, each page is a list of lines drawn in Helvetica"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        text = " ".join(f"({line}) Tj 0 -14 Td" for line in lines)
+        stream = f"BT /F1 12 Tf 72 720 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects)} 0 R "
+            "/Resources << /Font << /F1 3 0 R >> >> >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    data, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    trailer = f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{len(data)}\n%%EOF\n"
+    path.write_bytes(data + (xref + trailer).encode("latin-1"))
+
+
+def test_pdf_chunks_carry_page_numbers(test_encoding, tmp_path):
+    pytest.importorskip("pypdf")
+    from document_indexer import iter_pages, parse_and_chunk
+
+    pages = [[f"page {p} line {i} " + "word " * 8 for i in range(6)] for p in range(1, 4)]
+    write_pdf(tmp_path / "manual.pdf", pages)
+    extracted = list(iter_pages(str(tmp_path / "manual.pdf"), "pdf"))
+    assert [page for page, _ in extracted] == [1, 2, 3]
+    assert [text.split("\n")[0].strip() for _, text in extracted] == [lines[0].strip() for lines in pages]
+
+    parsed, title, chunks, error = parse_and_chunk(str(tmp_path / "manual.pdf"), 40, 20)
+    chunks = list(chunks)
+    assert parsed and not error
+    assert title == "page 1 line 0 " + "word " * 7 + "word"
+    for chunk, metadata in chunks:
+        pages_in_chunk = {int(line.split()[1]) for line in chunk.split("\n") if line.strip()}
+        assert (min(pages_in_chunk), max(pages_in_chunk)) == (metadata["page"], metadata["page_end"])
+    assert chunks[-1][1]["page_end"] == 3
+    assert "page 2 line 3 " + "word " * 7 + "word" in "\n".join(chunk for chunk, _ in chunks)
+
+
+def test_pptx_chunks_carry_slide_numbers(test_encoding, tmp_path):
+    pptx = pytest.importorskip("pptx")
+    from pptx.util import Inches
+
+    from document_indexer import iter_pages, parse_and_chunk
+
+    presentation = pptx.Presentation()
+    for slide_number in range(1, 4):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[6])
+        # the text of each shape is one line
+        lines = [f"slide {slide_number} title"] + [f"slide {slide_number} point {i} " + "word " * 8 for i in range(5)]
+        for i, line in enumerate(lines):
+            slide.shapes.add_textbox(Inches(1), Inches(1 + i), Inches(8), Inches(1)).text_frame.text = line
+    presentation.save(tmp_path / "deck.pptx")
+    assert [page for page, _ in iter_pages(str(tmp_path / "deck.pptx"), "pptx")] == [1, 2, 3]
+
+    parsed, title, chunks, error = parse_and_chunk(str(tmp_path / "deck.pptx"), 40, 20)
+    chunks = list(chunks)
+    assert parsed and not error
+    assert title == "slide 1 title"
+    for chunk, metadata in chunks:
+        slides_in_chunk = {int(line.split()[1]) for line in chunk.split("\n") if line.strip()}
+        assert (min(slides_in_chunk), max(slides_in_chunk)) == (metadata["page"], metadata["page_end"])
+    assert chunks[-1][1]["page_end"] == 3
+    assert "slide 3 point 4 " + "word " * 7 + "word" in "\n".join(chunk for chunk, _ in chunks)
+
+def test_csv_and_jsonl_chunks_carry_row_ranges(test_encoding, tmp_path):
+    import csv
+    import json
+    from document_indexer import parse_and_chunk
+
+    rows = [["id", "name", "comment"]] + [[str(i), f"name{i}", "some words " * (i % 4)] for i in range(1, 200)]
+    with open(tmp_path / "export.csv", "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+    lines = [json.dumps({"id": i, "text": "some words " * (i % 4)}) for i in range(200)]
+    lines[10] = "not json"
+    (tmp_path / "export.jsonl").write_text("\n".join(lines) + "\n")
+
+    for name, records in (("export.csv", [" ".join(row) for row in rows]), ("export.jsonl", lines)):
+        parsed, title, chunks, error = parse_and_chunk(str(tmp_path / name), 48, 24)
+        chunks = list(chunks)
+        assert parsed and not error and len(chunks) > 1
+        for chunk, metadata in chunks:
+            expected = records[metadata["row"] - 1 : metadata["row_end"]]
+            if name.endswith(".jsonl"):
+                expected = ["" if r == "not json" else json.dumps(json.loads(r)) for r in expected]
+            assert chunk == "\n".join(expected)
+        assert chunks[-1][1]["row_end"] == len(records)
+
+
+
+def test_record_files_are_chunked_in_flat_memory(test_encoding, tmp_path, monkeypatch):
+    import tempfile
+    import tracemalloc
+
+    from document_indexer import iter_chunks
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    (tmp_path / "docs").mkdir()
+    with open(tmp_path / "docs" / "export.csv", "w") as f:
+        for i in range(10000):
+            f.write(f"{i},name{i},some words about row {i}\n")
+    tracemalloc.start()
+    try:
+        total = 0
+        for chunk, metadata in iter_chunks([str(tmp_path / "docs" / "export.csv")], str(tmp_path / "docs"), 64, 8):
+            total += len(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # the chunks of the file overlap eight times, they are never all held at once
+    assert metadata["row_end"] == 10000 and total > 2 * 1024 * 1024
+    assert peak < total / 10
+    # the spilled chunks are deleted once read
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["docs"]
+
+def test_long_text_files_are_spilled(test_encoding, tmp_path, monkeypatch):
+    import tempfile
+
+    import document_indexer
+    from document_indexer import SpilledChunks, parse_and_chunk
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "short.md").write_text("a few words\n" * 100)
+    (tmp_path / "docs" / "long.md").write_text("a few more words\n" * 1000)
+    monkeypatch.setattr(document_indexer, "SPILL_CHARS", 10000)
+    _, _, short, _ = parse_and_chunk(str(tmp_path / "docs" / "short.md"), 64, 32)
+    _, _, long, _ = parse_and_chunk(str(tmp_path / "docs" / "long.md"), 64, 32)
+    assert isinstance(short, list) and isinstance(long, SpilledChunks)
+    chunks = list(long)
+    assert chunks[0][0].startswith("a few more words") and chunks[0][1]["tokens"] == 64
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["docs"]
+
+
+def test_neighbor_index(tmp_path):
+    from neighbor_index import LegacyNeighborIndex, NeighborIndex, load_neighbor_index
+
+    metadata_list = [{"source": "a.md", "chunk_id": i} for i in range(3)] + [{"source": "b.md", "chunk_id": 0}]
+    NeighborIndex.from_metadata(metadata_list).save(str(tmp_path))
+    neighbors = load_neighbor_index(str(tmp_path))
+    assert [neighbors.position("a.md", i) for i in (-1, 0, 2, 3)] == [None, 0, 2, None]
+    assert neighbors.position("b.md", 0) == 3
+    assert neighbors.position("c.md", 0) is None
+    assert LegacyNeighborIndex({"a.md_1": 7}).position("a.md", 1) == 7
+    with pytest.raises(ValueError):
+        NeighborIndex.from_metadata(metadata_list + [{"source": "a.md", "chunk_id": 3}])
+
+
+def test_check_index(test_encoding, fake_embeddings, doc_dir, tmp_path, capsys):
+    from document_indexer import build_index, check_index
+
+    output = str(tmp_path / "knowledge")
+    assert not check_index(str(doc_dir), output, 64, 32)
+    build_index(str(doc_dir), output, chunk_size=64, chunk_step=32)
+    assert check_index(str(doc_dir), output, 64, 32)
+    (doc_dir / "doc0.md").write_text("# Changed\n")
+    capsys.readouterr()
+    assert not check_index(str(doc_dir), output, 64, 32)
+    assert "Changed: doc0.md" in capsys.readouterr().out
+    assert not check_index(str(doc_dir), output, 128, 32)
+
+
+def test_check_sharded_index(test_encoding, fake_embeddings, doc_dir, tmp_path, capsys):
+    from document_indexer import build_shards, check_index
+    from manifest import shard_of
+
+    output = str(tmp_path / "sharded")
+    build_shards(str(doc_dir), output, 3, 64, 32, processes=1)
+    assert check_index(str(doc_dir), output, 64, 32)
+    assert not check_index(str(doc_dir), output, 128, 32)
+    (doc_dir / "doc0.md").write_text("# Changed\n")
+    (doc_dir / "new.md").write_text("# New\n")
+    capsys.readouterr()
+    assert not check_index(str(doc_dir), output, 64, 32)
+    out = capsys.readouterr().out
+    assert "New: new.md" in out and "Changed: doc0.md" in out and "--shards 3" in out
+    build_shards(str(doc_dir), output, 3, 64, 32, incremental=True, processes=1)
+    assert check_index(str(doc_dir), output, 64, 32)
+    # deleting every file of a shard leaves its index stale
+    number = shard_of("new.md", 3)
+    for path in list(doc_dir.rglob("*")):
+        if path.is_file() and shard_of(str(path.relative_to(doc_dir)), 3) == number:
+            path.unlink()
+    capsys.readouterr()
+    assert not check_index(str(doc_dir), output, 64, 32)
+    assert "Deleted: new.md" in capsys.readouterr().out
+
+
+def test_sharded_build(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    import json
+
+    from document_indexer import build_index, build_shards, merge_shards
+    from document_retriever import DocumentRetriever
+    from federated_retriever import FederatedRetriever, load_retriever
+    from manifest import load_index_info, load_manifest, load_shards, shard_of
+
+    build_index(str(doc_dir), str(tmp_path / "single"), 64, 32)
+    single = DocumentRetriever(str(tmp_path / "single"))
+    output = tmp_path / "sharded"
+    build_shards(str(doc_dir), str(output), 3, 64, 32, processes=2)
+    shards = load_shards(str(output))
+    assert shards["count"] == 3 and not shards["merged"]
+    files = dict()
+    for name in shards["shards"]:
+        shard_files = load_manifest(str(output / name))["files"]
+        assert {shard_of(source, 3) for source in shard_files} == {int(name[-3:])}
+        files.update(shard_files)
+    assert files == load_manifest(str(tmp_path / "single"))["files"]
+
+    retriever = load_retriever(str(output))
+    assert isinstance(retriever, FederatedRetriever)
+    assert sum(shard.index.ntotal for shard in retriever.retrievers) == single.index.ntotal
+    changed = next(source for source in files if source.endswith(".md"))
+    query = next(chunk.page_content for chunk in single.chunks if chunk.metadata["source"] != changed)
+    result = json.loads(retriever(query, size=2))[0]
+    assert query in result["chunk"] and result["score"] == pytest.approx(1.0, abs=1e-3)
+
+    # a shard is rebuilt without touching the others
+    number = shard_of(changed, 3)
+    (doc_dir / changed).write_text("# Changed\n" + "changed words " * 50)
+    versions = {name: load_index_info(str(output / name))["version"] for name in shards["shards"]}
+    build_shards(str(doc_dir), str(output), 3, 64, 32, only=[number], incremental=True)
+    for name, version in versions.items():
+        assert (load_index_info(str(output / name))["version"] != version) == (name == f"shard_{number:03d}")
+    assert retriever.retrieve_batch(["changed words"], size=1, mode="keyword")[0][0]["metadata"]["source"] == changed
+    with pytest.raises(ValueError, match="has no 4 shards"):
+        build_shards(str(doc_dir), str(output), 4, 64, 32, only=[0])
+
+    # the shards merged into a single index
+    merge_shards(str(output))
+    merged = load_retriever(str(output))
+    assert isinstance(merged, DocumentRetriever)
+    assert merged.index.ntotal == sum(shard.index.ntotal for shard in retriever.retrievers)
+    assert merged.search("changed words", size=1, mode="keyword")[0].metadata["source"] == changed
+    assert merged.search(query, size=1)[0].page_content == query
+    retriever.close()
+
+
+def test_near_duplicates():
+    from near_duplicates import NearDuplicates, lsh_parameters
+
+    assert lsh_parameters(0.9) == (8, 16)
+    assert lsh_parameters(0.8) == (16, 8)
+    text = make_text(0.002, seed=7)
+    words = text.split()
+    near_duplicates = NearDuplicates(0.8)
+    assert near_duplicates.check("a", text) is None
+    assert near_duplicates.check("b", make_text(0.002, seed=8)) is None
+    # one word of a few hundred changed
+    assert near_duplicates.check("c", " ".join(words[:100] + ["changed"] + words[101:])) == "a"
+    assert near_duplicates.check("d", " ".join(words[: len(words) // 2])) is None
+    assert near_duplicates.check("e", "") is None
+    assert near_duplicates.keys == ["a", "b", "d"]
+
+
+def test_near_duplicate_chunks(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from chunk_store import ChunkStore
+    from document_indexer import build_index, update_index
+    from manifest import load_manifest
+
+    # the files start with the same license header
+    header = "Licensed under the terms below.\n" + make_text(0.002, seed=50)
+    for i in range(4):
+        (doc_dir / f"licensed{i}.md").write_text(header + "\n# Licensed " + make_text(0.002, seed=60 + i))
+    build_index(str(doc_dir), str(tmp_path / "all"), 64, 32)
+    output = tmp_path / "deduplicated"
+    build_index(str(doc_dir), str(output), 64, 32, dedup_threshold=0.8)
+    assert load_manifest(str(output))["dedup_threshold"] == 0.8
+
+    chunks, all_chunks = load_chunks(output), load_chunks(tmp_path / "all")
+    assert len(chunks) < len(all_chunks)
+    assert {text for _, _, text in chunks} <= {text for _, _, text in all_chunks}
+    store = {(doc.metadata["source"], doc.metadata["chunk_id"]): doc for doc in ChunkStore.load(str(output))}
+    headers = [doc for doc in store.values() if doc.page_content.startswith("Licensed under")]
+    licensed = {f"licensed{i}.md" for i in range(4)}
+    assert len(headers) == 1 and headers[0].metadata["source"] in licensed
+    kept = headers[0].metadata["source"]
+    assert {alias["source"] for alias in headers[0].metadata["duplicates"]} >= licensed - {kept}
+
+    # the header is kept in another file once the file holding it is deleted
+    (doc_dir / kept).unlink()
+    update_index(str(doc_dir), str(output), 64, 32, dedup_threshold=0.8)
+    fresh = tmp_path / "fresh"
+    build_index(str(doc_dir), str(fresh), 64, 32, dedup_threshold=0.8)
+    assert load_chunks(output) == load_chunks(fresh)
+    stores = [ChunkStore.load(str(folder)) for folder in (output, fresh)]
+    duplicates = [
+        {(doc.metadata["source"], doc.metadata["chunk_id"]): doc.metadata.get("duplicates") for doc in store}
+        for store in stores
+    ]
+    assert duplicates[0] == duplicates[1]
+    headers = [doc for doc in stores[0] if doc.page_content.startswith("Licensed under")]
+    assert len(headers) == 1 and headers[0].metadata["source"] in licensed - {kept}
+    assert kept not in {alias["source"] for doc in stores[0] for alias in doc.metadata.get("duplicates", ())}
+
+
+@pytest.mark.parametrize("module", ["document_indexer", "document_retriever", "retriever_client"])
+def test_import_loads_no_heavy_dependencies(module):
+    import subprocess
+
+    from conftest import RAG_DIR
+
+    heavy = ["numpy", "faiss", "tiktoken", "langchain_core", "langchain_community", "torch"]
+    code = f"import sys, {module}; print([m for m in {heavy!r} if m in sys.modules])"
+    output = subprocess.run([sys.executable, "-c", code], cwd=RAG_DIR, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
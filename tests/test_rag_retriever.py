@@ -0,0 +1,699 @@
+"""
+Tests for the document retriever of the RAG skill, on indexes built by the indexer with fake embeddings.
+"""
+
+import json
+import shutil
+
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_community")
+from conftest import RAG_DIR, WordEncoding
+
+
+def build(doc_dir, output, **index_options):
+    from document_indexer import build_index
+
+    build_index(str(doc_dir), str(output), chunk_size=64, chunk_step=32, index_options=index_options)
+    return output
+
+
+@pytest.fixture
+def index_dir(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    return build(doc_dir, tmp_path / "knowledge")
+
+
+def all_chunks(retriever):
+    return list(retriever.chunks)
+
+
+@pytest.mark.parametrize(
+    "index_options",
+    [
+        {},
+        {"index_type": "ivf_flat", "nlist": 4},
+        {"index_type": "hnsw"},
+        {"storage": "float16"},
+        {"storage": "int8"},
+        {"index_type": "ivf_flat", "nlist": 4, "storage": "int8"},
+        {"index_type": "hnsw", "storage": "float16"},
+    ],
+    ids=["flat", "ivf_flat", "hnsw", "flat_float16", "flat_int8", "ivf_flat_int8", "hnsw_float16"],
+)
+def test_search_finds_exact_chunk(test_encoding, fake_embeddings, doc_dir, tmp_path, index_options):
+    from document_retriever import DocumentRetriever
+
+    output = build(doc_dir, tmp_path / "knowledge", **index_options)
+    retriever = DocumentRetriever(str(output))
+    assert retriever.index_info["index_type"] == index_options.get("index_type", "flat")
+    # the storage is read from the index itself
+    assert retriever.index_info["storage"] == index_options.get("storage", "float32")
+    for chunk in all_chunks(retriever)[::7]:
+        # exhaustive search parameters make the approximate indexes exact
+        hits = retriever.search(chunk.page_content, size=1, nprobe=4, ef_search=256)
+        assert hits[0].page_content == chunk.page_content
+
+
+def test_ivf_pq_index(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_retriever import DocumentRetriever
+
+    for i in range(40):
+        (doc_dir / f"extra{i}.md").write_text("\n".join(f"line {i} {j} " * 5 for j in range(40)))
+    output = build(doc_dir, tmp_path / "knowledge", index_type="ivf_pq", nlist=8, pq_m=8)
+    retriever = DocumentRetriever(str(output))
+    assert len(retriever.index_info.pop("version")) == 32
+    assert retriever.index_info == {
+        "index_type": "ivf_pq",
+        "nlist": 8,
+        "nprobe": 16,
+        "embedding_backend": "huggingface",
+        "embedding_model": "all-MiniLM-L6-v2",
+    }
+    assert len(retriever.search("line 1 2", size=5)) == 5
+
+
+def test_reduced_precision_storage_size(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    import numpy as np
+    from document_indexer import DEFAULT_INDEX_OPTIONS, create_faiss_index
+
+    sizes = dict()
+    for storage in ("float32", "float16", "int8"):
+        output = build(doc_dir, tmp_path / storage, storage=storage)
+        sizes[storage] = (output / "index.faiss").stat().st_size
+    assert sizes["float16"] < sizes["float32"] * 0.55
+    assert sizes["int8"] < sizes["float32"] * 0.3
+    with pytest.raises(ValueError, match="storage"):
+        options = {**DEFAULT_INDEX_OPTIONS, "index_type": "ivf_pq", "storage": "int8"}
+        create_faiss_index(np.zeros((300, 384), dtype=np.float32), options)
+
+
+def test_missing_dependency_is_named(monkeypatch):
+    import sys
+
+    import document_retriever
+
+    for module, package in [("tiktoken", "tiktoken"), ("faiss", "faiss-cpu")]:
+        with monkeypatch.context() as patch:
+            # a None entry makes the import fail like a missing package
+            patch.setitem(sys.modules, module, None)
+            with pytest.raises(ImportError, match=f"Please install {package} first"):
+                document_retriever._load_dependencies()
+
+
+def test_expanded_results(index_dir):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir))
+    chunk = all_chunks(retriever)[3]
+    results = json.loads(retriever(chunk.page_content, size=2, target_length=256))
+    assert len(results) == 2
+    assert results[0]["metadata"] == chunk.metadata
+    assert chunk.page_content in results[0]["chunk"]
+
+
+def test_retrieve_batch_matches_single_queries(index_dir, monkeypatch):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir), cache_size=0)
+    chunks = all_chunks(retriever)
+    queries = [chunks[0].page_content, chunks[9].page_content, "unrelated words", chunks[0].page_content]
+    expected = [json.loads(retriever(query, size=3, target_length=128)) for query in queries]
+
+    calls = []
+    model = type(retriever.embeddings)
+    embed_documents = model.embed_documents
+    monkeypatch.setattr(
+        model, "embed_documents", lambda self, texts: calls.append(texts) or embed_documents(self, texts)
+    )
+    assert retriever.retrieve_batch(queries, size=3, target_length=128) == expected
+    # one forward pass for all distinct queries
+    assert calls == [queries[:3]]
+    assert retriever.retrieve_batch([]) == []
+
+
+def test_expansion_uses_stored_token_counts(index_dir, test_encoding, monkeypatch):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir))
+    chunks = all_chunks(retriever)
+    for chunk in chunks:
+        assert chunk.metadata["tokens"] == len(test_encoding.encode(chunk.page_content))
+    source = chunks[0].metadata["source"]
+    hit, left2, left1, right1 = (chunks[retriever.neighbors.position(source, chunk_id)] for chunk_id in (3, 1, 2, 4))
+    target = sum(c.metadata["tokens"] for c in (hit, left1, right1)) + 3
+
+    encoded = []
+    monkeypatch.setattr(test_encoding, "encode", lambda s: encoded.append(s) or WordEncoding.encode(test_encoding, s))
+    [expanded] = retriever.do_expand([hit], target)
+    # only the left neighbor cut at the boundary is encoded, and its end is kept on the left
+    assert encoded == [left2.page_content]
+    left_end = "".join(WordEncoding().encode(left2.page_content)[-3:])
+    assert expanded["chunk"] == left_end + left1.page_content + hit.page_content + right1.page_content
+    # a hit longer than the target is returned as is
+    assert retriever.do_expand([hit], 1)[0]["chunk"] == hit.page_content
+
+
+def test_merge_overlapping_expansions(index_dir):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir), cache_size=0)
+    chunks = all_chunks(retriever)
+    other = int(retriever.neighbors.offsets[1])
+    # chunks 0, 1 and 2 of the first source are hits, with two hits of the second source in between
+    positions, scores = [0, 1, other, 2, other + 5], [0.9, 0.8, 0.7, 0.6, 0.5]
+    # windows of one chunk, the windows of chunks 0, 1 and 2 touch and are merged, then cut down to the best hit
+    results = retriever.merge_expansions(positions, scores, 3, 1)
+    assert len(results) == 3
+    assert results[0]["chunk"] == chunks[0].page_content
+    assert results[0]["metadata"] == chunks[0].metadata
+    assert results[0]["score"] == 0.9 and "hits" not in results[0]
+    # the freed results go to the next distinct hits
+    assert [result["metadata"] for result in results[1:]] == [chunks[other].metadata, chunks[other + 5].metadata]
+    assert results[1]["score"] == 0.7 and "hits" not in results[1]
+    # the window of chunk 2 cuts chunk 0, the merged window keeps both hits whole and cuts its other neighbors
+    lengths = [chunk.metadata["tokens"] for chunk in chunks[:4]]
+    target = sum(lengths[:3]) + 5
+    results = retriever.merge_expansions([2, 0], [0.9, 0.8], 2, target)
+    assert len(results) == 1
+    assert results[0]["chunk"].startswith("".join(chunk.page_content for chunk in chunks[:3]))
+    assert len(retriever.enc.encode(results[0]["chunk"])) <= target
+    assert results[0]["hits"] == [{"chunk_id": 2, "score": 0.9}, {"chunk_id": 0, "score": 0.8}]
+    # the window of the best hit holds chunks 1 and 2 whole, they take no window of their own
+    target = sum(chunk.metadata["tokens"] for chunk in chunks[:3]) + 5
+    results = retriever.merge_expansions(positions, scores, 3, target)
+    assert results[0]["chunk"] == retriever.do_expand([chunks[0]], target)[0]["chunk"]
+    assert [hit["chunk_id"] for hit in results[0]["hits"]] == [0, 1, 2]
+    # a single hit is expanded like do_expand
+    assert retriever.merge_expansions([other], [1.0], 1, target)[0]["chunk"] == (
+        retriever.do_expand([chunks[other]], target)[0]["chunk"]
+    )
+
+
+@pytest.mark.parametrize("target", [1, 40, 100, 160, 300])
+def test_merged_expansions_keep_target_length(index_dir, target):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir), cache_size=0)
+    chunks = all_chunks(retriever)
+    count = int(retriever.neighbors.counts[0])
+    # hits all over the first source, so many of their windows touch and are merged
+    positions = [0, count - 1, count // 2, 3, count // 2 + 2, 1, count - 3]
+    scores = [1.0 - i / 10 for i in range(len(positions))]
+    for result in retriever.merge_expansions(positions, scores, 3, target):
+        best = result.get("hits", [{"chunk_id": result["metadata"]["chunk_id"]}])[0]["chunk_id"]
+        assert len(retriever.enc.encode(result["chunk"])) <= max(target, chunks[best].metadata["tokens"])
+        # the best hit and the hits kept in the window are whole
+        for hit in result.get("hits", []):
+            assert chunks[hit["chunk_id"]].page_content in result["chunk"]
+
+def test_chunk_store_round_trip(tmp_path):
+    from chunk_store import ChunkStore
+    from langchain_core.documents import Document
+
+    documents = [
+        Document(page_content="caf\u00e9 \u2013 na\u00efve\nline", metadata={"source": "a.md", "chunk_id": 0}),
+        Document(page_content="", metadata={"source": "a.md", "chunk_id": 1, "page": 2}),
+        Document(page_content="{\"json\": true}", metadata={"source": "b.md", "chunk_id": 0}),
+    ]
+    ChunkStore.write(str(tmp_path), documents)
+    store = ChunkStore.load(str(tmp_path))
+    assert len(store) == 3
+    assert list(store) == documents
+    assert store[2] == documents[2]
+    with pytest.raises(IndexError):
+        store[3]
+
+    ChunkStore.write(str(tmp_path), [])
+    assert list(ChunkStore.load(str(tmp_path))) == []
+
+
+def test_open_retriever_survives_rebuild(index_dir, doc_dir):
+    """The index files are replaced rather than rewritten, so mappings held during a rebuild stay valid"""
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir))
+    index, chunks = retriever.index, retriever.chunks
+    chunk = chunks[5]
+    for path in doc_dir.rglob("*.md"):
+        path.write_text("replaced " * 100)
+    build(doc_dir, index_dir)
+    assert chunks[5] == chunk
+    assert index.search(retriever.embed_queries([chunk.page_content]), 1)[1][0][0] == 5
+    # the next query reloads the new index
+    assert retriever.search("replaced", size=1)[0].page_content.startswith("replaced")
+
+
+def test_open_neighbor_index_survives_shrinking_rebuild(index_dir, doc_dir):
+    """A rebuild with fewer sources writes shorter neighbor arrays, the mapped ones must not be truncated"""
+    import os
+
+    from document_retriever import DocumentRetriever
+    from neighbor_index import OFFSETS_FILE
+
+    retriever = DocumentRetriever(str(index_dir))
+    neighbors = retriever.neighbors
+    offsets, counts = neighbors.offsets.tolist(), neighbors.counts.tolist()
+    inode = os.stat(index_dir / OFFSETS_FILE).st_ino
+    for path in list(doc_dir.rglob("*.md"))[1:]:
+        path.unlink()
+    build(doc_dir, index_dir)
+    # checked before reading the old mappings, reading a truncated mapping kills the process with SIGBUS
+    assert os.stat(index_dir / OFFSETS_FILE).st_ino != inode
+    assert neighbors.offsets.tolist() == offsets and neighbors.counts.tolist() == counts
+    assert not list(index_dir.glob("*.tmp"))
+    assert len(retriever.search("lorem", size=1)) == 1
+    assert len(retriever.neighbors.sources) == 1
+
+
+def test_query_cache(index_dir, doc_dir, monkeypatch):
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir), cache_size=8)
+    query = all_chunks(retriever)[2].page_content
+    first = retriever(query, size=2)
+    # queries differing only in whitespace are served from the cache
+    assert retriever(f"  {query}\n", size=2) == first
+    assert retriever.cache_info()["results"] == {"hits": 1, "misses": 1, "size": 1, "max_size": 8}
+    assert retriever.cache_info()["embeddings"]["misses"] == 1
+    # size and target_length are part of the key, the query embedding is reused
+    retriever(query, size=3)
+    retriever(query, size=2, target_length=64)
+    assert retriever.cache_info()["results"]["misses"] == 3
+    assert retriever.cache_info()["embeddings"] == {"hits": 2, "misses": 1, "size": 1, "max_size": 8}
+
+    # a rebuild writes a new version, cached results of the old index are not served
+    version = retriever.version
+    for path in doc_dir.rglob("*.md"):
+        path.write_text("replaced " * 100)
+    build(doc_dir, index_dir)
+    assert json.loads(retriever(query, size=2))[0]["chunk"].startswith("replaced")
+    assert retriever.version != version
+
+
+def test_retriever_does_not_write_queries_to_the_embedding_cache(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_indexer import build_index
+    from document_retriever import DocumentRetriever
+    from embedding_cache import EmbeddingCache
+
+    output = tmp_path / "knowledge"
+    build_index(str(doc_dir), str(output), 64, 32, embedding_cache=str(output / "embedding_cache"))
+    size = len(EmbeddingCache(str(output / "embedding_cache")))
+    retriever = DocumentRetriever(str(output))
+    chunk = all_chunks(retriever)[3]
+    # chunk texts are found in the cache of the indexer, new queries are not added to it
+    assert retriever.search(chunk.page_content, size=1)[0] == chunk
+    retriever.search("a query nobody indexed", size=1)
+    assert retriever.embeddings.hits == 1 and retriever.embeddings.misses == 1
+    assert len(EmbeddingCache(str(output / "embedding_cache"))) == size
+
+
+def test_lru_cache(monkeypatch):
+    import query_cache
+    from query_cache import LRUCache
+
+    now = [0.0]
+    monkeypatch.setattr(query_cache.time, "monotonic", lambda: now[0])
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # b was the least recently used
+    assert (cache.get("b"), cache.get("a"), cache.get("c")) == (None, 1, 3)
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.info() == {"hits": 3, "misses": 2, "size": 1, "max_size": 2}
+
+    disabled = LRUCache(max_size=0)
+    disabled.put("a", 1)
+    assert disabled.get("a") is None
+
+
+def test_bm25_matches_brute_force(tmp_path):
+    import math
+    import random
+
+    from bm25_index import B, K1, BM25Index, tokenize
+
+    rng = random.Random(0)
+    vocabulary = [f"w{i}" for i in range(50)] + ["ERR_42", "caf\u00e9", "os.path"]
+    texts = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(0, 30))) for _ in range(200)]
+    BM25Index.write(str(tmp_path), texts)
+    index = BM25Index.load(str(tmp_path))
+
+    documents = [tokenize(text) for text in texts]
+    average = sum(map(len, documents)) / len(documents)
+    for query in ["w1 w2", "err_42 caf\u00e9", "os.path w3 w3", "missing"]:
+        expected = dict()
+        for term in set(tokenize(query)):
+            df = sum(term in document for document in documents)
+            idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+            for position, document in enumerate(documents):
+                tf = document.count(term)
+                if tf:
+                    norm = K1 * (1 - B + B * len(document) / average)
+                    expected[position] = expected.get(position, 0) + idf * tf * (K1 + 1) / (tf + norm)
+        positions, scores = index.search(query, size=10)
+        best = sorted(expected.values(), reverse=True)[:10]
+        assert scores.tolist() == pytest.approx(best, rel=1e-5)
+        assert all(expected[p] == pytest.approx(score, rel=1e-5) for p, score in zip(positions.tolist(), scores))
+    assert index.term_id("w0") is not None and index.term_id("w") is None
+
+
+
+def test_bm25_writer_spills_postings(tmp_path):
+    import random
+
+    from bm25_index import BM25Index, BM25Writer
+
+    rng = random.Random(0)
+    vocabulary = [f"w{i}" for i in range(50)] + ["ERR_42", "caf\u00e9"]
+    texts = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(0, 30))) for _ in range(200)]
+    held, spilled = tmp_path / "held", tmp_path / "spilled"
+    held.mkdir()
+    spilled.mkdir()
+    # all postings fit in the buffer of one writer, the other spills them every 7 postings
+    BM25Index.write(str(held), texts)
+    writer = BM25Writer(str(spilled), spill_size=7)
+    for text in texts:
+        writer.add(text)
+    writer.close()
+    assert sorted(path.name for path in spilled.iterdir()) == sorted(path.name for path in held.iterdir())
+    for path in held.iterdir():
+        assert (spilled / path.name).read_bytes() == path.read_bytes()
+
+def test_reciprocal_rank_fusion():
+    from document_retriever import reciprocal_rank_fusion
+
+    # a chunk ranked second by both searches beats chunks ranked first by only one
+    assert reciprocal_rank_fusion([[1, 2, 3], [4, 2, 5]], 3) == [2, 1, 4]
+    assert reciprocal_rank_fusion([[], []], 3) == []
+
+
+def test_keyword_and_hybrid_search(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_retriever import DocumentRetriever
+
+    (doc_dir / "errors.md").write_text("# Errors\nThe client raises ERR_CONN_4711 when the socket closes early.\n")
+    retriever = DocumentRetriever(str(build(doc_dir, tmp_path / "knowledge")))
+    query = "what does err_conn_4711 mean"
+    assert retriever.search(query, size=1, mode="keyword")[0].metadata["source"] == "errors.md"
+    assert "errors.md" in [chunk.metadata["source"] for chunk in retriever.search(query, size=3, mode="hybrid")]
+    assert retriever.search("no such words", size=3, mode="keyword") == []
+    results = json.loads(retriever(query, size=2, mode="hybrid"))
+    assert len(results) == 2
+    with pytest.raises(ValueError):
+        retriever.search(query, mode="fuzzy")
+
+
+def test_legacy_index(test_encoding, fake_embeddings, tmp_path):
+    """The sample index built by an earlier version of the indexer, with index.pkl and chunk_id_to_index.pkl"""
+    from document_retriever import DocumentRetriever
+
+    shutil.copytree(RAG_DIR / "knowledge", tmp_path / "knowledge")
+    retriever = DocumentRetriever(str(tmp_path / "knowledge"))
+    results = json.loads(retriever("What is AutoGen Studio?", size=3))
+    # the best hits of the small sample index are neighbors, merged into fewer windows
+    assert 1 <= len(results) <= 3
+    assert all(result["chunk"] for result in results)
+    with pytest.raises(ValueError, match="no keyword index"):
+        retriever("What is AutoGen Studio?", mode="hybrid")
+    with pytest.raises(ValueError, match="no metadata filters"):
+        retriever("What is AutoGen Studio?", filters={"folder": "docs"})
+
+
+def test_embedding_backends(test_encoding, doc_dir, tmp_path):
+    """The indexer records its embedding backend and model, the retriever embeds queries with them and refuses others"""
+    from document_indexer import build_index, update_index
+    from document_retriever import DocumentRetriever
+    from embedding_backends import HashBackend, check_embeddings
+    from manifest import load_index_info, save_index_info
+
+    output = str(tmp_path / "knowledge")
+    build_index(str(doc_dir), output, 64, 32, embedding_options={"embedding_backend": "hash"})
+    info = load_index_info(output)
+    assert (info["embedding_backend"], info["embedding_model"]) == ("hash", "bag-of-words-384")
+    retriever = DocumentRetriever(output)
+    chunk = retriever.chunks[5]
+    assert retriever.search(chunk.page_content, size=1)[0].page_content == chunk.page_content
+    assert HashBackend().embed_query(chunk.page_content) == retriever.embeddings.embed_query(chunk.page_content)
+    with pytest.raises(ValueError, match="embedded by the hash backend"):
+        DocumentRetriever(output, embedding_backend="huggingface")
+    # indexes built before the backends were embedded by all-MiniLM-L6-v2
+    assert check_embeddings({}) == ("huggingface", "all-MiniLM-L6-v2")
+    with pytest.raises(ValueError, match="not by the huggingface backend with paraphrase-MiniLM-L3-v2"):
+        check_embeddings({}, model_name="paraphrase-MiniLM-L3-v2")
+
+    # an open retriever refuses an index rebuilt with other embeddings
+    save_index_info(output, {**info, "embedding_model": "bag-of-words-256", "version": "other"})
+    with pytest.raises(ValueError, match="bag-of-words-256"):
+        retriever.search(chunk.page_content)
+    # the indexer rebuilds an index embedded with other embeddings instead of updating it
+    update_index(str(doc_dir), output, 64, 32, embedding_options={"embedding_backend": "hash"})
+    assert DocumentRetriever(output).index.d == 384
+
+
+def test_onnx_backend(tmp_path, monkeypatch):
+    """The onnx backend pools and normalizes the token embeddings of each text, whatever batch it ran in"""
+    import sys
+    import types
+
+    import numpy as np
+
+    from embedding_backends import ONNXBackend
+
+    class Encoding:
+        def __init__(self, text):
+            self.ids = [len(word) for word in text.split()]
+
+    class Tokenizer:
+        @staticmethod
+        def from_file(path):
+            return Tokenizer()
+
+        def enable_truncation(self, max_length):
+            pass
+
+        def no_padding(self):
+            pass
+
+        def encode_batch(self, texts):
+            return [Encoding(text) for text in texts]
+
+    class InferenceSession:
+        sessions = []
+
+        def __init__(self, path, options, providers):
+            self.path = path
+            self.widths = []
+            InferenceSession.sessions.append(self)
+
+        def get_inputs(self):
+            return [types.SimpleNamespace(name="input_ids"), types.SimpleNamespace(name="attention_mask")]
+
+        def run(self, output_names, inputs):
+            ids = inputs["input_ids"]
+            self.widths.append(ids.shape)
+            # token i embeds as (id, 1, i), padding as a large vector the mask must leave out
+            tokens = np.stack([ids, np.ones_like(ids), np.broadcast_to(np.arange(ids.shape[1]), ids.shape)], axis=2)
+            return [np.where(inputs["attention_mask"][:, :, None] == 1, tokens, 1000).astype(np.float32)]
+
+    def quantize_dynamic(source, target, weight_type):
+        quantized.append(source)
+        with open(target, "wb") as f:
+            f.write(b"int8")
+
+    quantized = []
+    onnxruntime = types.ModuleType("onnxruntime")
+    onnxruntime.SessionOptions = types.SimpleNamespace
+    onnxruntime.GraphOptimizationLevel = types.SimpleNamespace(ORT_ENABLE_ALL=99)
+    onnxruntime.InferenceSession = InferenceSession
+    quantization = types.ModuleType("onnxruntime.quantization")
+    quantization.QuantType = types.SimpleNamespace(QInt8="QInt8")
+    quantization.quantize_dynamic = quantize_dynamic
+    onnxruntime.quantization = quantization
+    monkeypatch.setitem(sys.modules, "onnxruntime", onnxruntime)
+    monkeypatch.setitem(sys.modules, "onnxruntime.quantization", quantization)
+    monkeypatch.setitem(sys.modules, "tokenizers", types.SimpleNamespace(Tokenizer=Tokenizer))
+
+    model = tmp_path / "model"
+    model.mkdir()
+    (model / "model.onnx").write_bytes(b"float32")
+    (model / "tokenizer.json").write_text("{}")
+    backend = ONNXBackend(str(model), batch_tokens=8, cache_folder=str(tmp_path / "cache"))
+    assert InferenceSession.sessions[-1].path == str(model / "model.onnx")
+
+    texts = ["a bb ccc dddd eeeee", "x", "yy zz", "a b c d e f g h i", "", "mm nnn"]
+    vectors = backend.embed_documents(texts)
+    # the texts ran in several batches of similar length, shortest first
+    widths = InferenceSession.sessions[-1].widths
+    assert len(widths) > 1 and [width for _, width in widths] == sorted(width for _, width in widths)
+    assert all(rows * width <= 8 for rows, width in widths if rows > 1)
+    for text, vector in zip(texts, vectors):
+        ids = [len(word) for word in text.split()]
+        expected = np.zeros(3)
+        if ids:
+            expected = np.array([[i, 1, position] for position, i in enumerate(ids)]).mean(axis=0)
+            expected /= np.linalg.norm(expected)
+        assert vector == pytest.approx(expected.tolist(), abs=1e-6)
+    assert backend.embed_query("yy zz") == vectors[2]
+
+    # the int8 model is quantized once into the cache folder, the model folder is left as it was
+    for _ in range(2):
+        ONNXBackend(str(model) + "-int8", cache_folder=str(tmp_path / "cache"))
+    assert quantized == [str(model / "model.onnx")]
+    assert InferenceSession.sessions[-1].path.startswith(str(tmp_path / "cache"))
+    assert sorted(path.name for path in model.iterdir()) == ["model.onnx", "tokenizer.json"]
+
+
+def test_metadata_filters(tmp_path):
+    from metadata_filter import MetadataFilters, filter_key, folders_of
+    from neighbor_index import NeighborIndex
+
+    assert folders_of("a/b/c.md") == ["a/b", "a"]
+    assert folders_of("c.md") == []
+    metadata = [
+        {"source": source, "chunk_id": i, "title": title}
+        for source, count, title in [("a/x.md", 2, "X"), ("y.md", 3, "Y"), ("a/b/z.md", 1, "X")]
+        for i in range(count)
+    ]
+    neighbors = NeighborIndex.from_metadata(metadata)
+    MetadataFilters.from_metadata(neighbors, metadata).save(str(tmp_path))
+    filters = MetadataFilters.load(str(tmp_path), neighbors)
+    assert filters.mask(filter_key({"folder": "a"})).tolist() == [1, 1, 0, 0, 0, 1]
+    assert filters.mask(filter_key({"folder": "a/", "title": ["Y", "X"]})).tolist() == [1, 1, 0, 0, 0, 1]
+    assert filters.mask(filter_key({"source": ["y.md", "a/b/z.md"], "title": "X"})).tolist() == [0, 0, 0, 0, 0, 1]
+    assert not filters.mask(filter_key({"source": "missing.md"})).any()
+    assert filter_key({}) is None
+    with pytest.raises(ValueError, match="Unsupported filter field"):
+        filter_key({"author": "me"})
+
+
+def test_cached_selections_are_bitmaps(index_dir, monkeypatch):
+    import document_retriever
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(index_dir))
+    chunks = all_chunks(retriever)
+    in_sub = [i for i, chunk in enumerate(chunks) if chunk.metadata["source"].startswith("sub")]
+    selection = retriever.selection({"folder": "sub"})
+    assert not hasattr(selection, "mask") and selection.bitmap.nbytes == (len(chunks) + 7) // 8
+    assert selection.count == len(in_sub) and selection.positions.tolist() == in_sub
+    assert retriever.selection({"folder": "sub/"}) is selection
+    # the positions of broad selections, searched with the bitmap, are not kept
+    monkeypatch.setattr(document_retriever, "EXACT_SEARCH_LIMIT", 0)
+    assert retriever.selection({"source": "doc0.md"}).positions is None
+
+
+@pytest.mark.parametrize(
+    "index_options",
+    [{}, {"index_type": "ivf_flat", "nlist": 16, "nprobe": 1}, {"index_type": "hnsw", "ef_search": 8}],
+    ids=["flat", "ivf_flat", "hnsw"],
+)
+def test_filtered_search(test_encoding, fake_embeddings, doc_dir, tmp_path, index_options):
+    import numpy as np
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(build(doc_dir, tmp_path / "knowledge", **index_options)), cache_size=0)
+    chunks = all_chunks(retriever)
+    # a chunk of a sub folder file, far from the ivf lists of most selections
+    query = chunks[-1].page_content
+    sources = {chunk.metadata["source"] for chunk in chunks}
+    in_sub = [chunk for chunk in chunks if chunk.metadata["source"].startswith("sub")]
+    title = chunks[0].metadata["title"]
+    for filters, selected in [
+        ({"folder": "sub"}, in_sub),
+        ({"source": "doc3.md"}, [chunk for chunk in chunks if chunk.metadata["source"] == "doc3.md"]),
+        ({"title": title}, [chunk for chunk in chunks if chunk.metadata["title"] == title]),
+        ({"folder": "sub", "source": "doc3.md"}, []),
+    ]:
+        for mode in ("vector", "keyword", "hybrid"):
+            hits = retriever.search(query, size=5, mode=mode, filters=filters)
+            assert all(hit in selected for hit in hits)
+            if mode != "keyword":
+                # even visiting one ivf list or few hnsw nodes, the search finds enough selected chunks
+                assert len(hits) == min(5, len(selected))
+    # the filtered vector search finds the closest selected chunks, like an exhaustive search over them
+    vectors = np.array(retriever.embeddings.embed_documents([chunk.page_content for chunk in in_sub]))
+    distances = ((vectors - retriever.embed_queries([query])[0]) ** 2).sum(axis=1)
+    expected = [in_sub[i].page_content for i in np.argsort(distances)[:3]]
+    hits = retriever.search(query, size=3, nprobe=4, ef_search=256, filters={"folder": "sub"})
+    assert [hit.page_content for hit in hits] == expected
+    assert len(sources) > len({hit.metadata["source"] for hit in hits})
+    results = json.loads(retriever(query, size=2, filters={"folder": "sub/"}))
+    assert [result["metadata"]["source"][:4] for result in results] == ["sub/", "sub/"]
+    with pytest.raises(ValueError, match="Unsupported filter field"):
+        retriever(query, filters={"author": "me"})
+
+
+@pytest.mark.parametrize(
+    "index_options",
+    [{"index_type": "ivf_flat", "nlist": 16, "nprobe": 1}, {"index_type": "hnsw", "ef_search": 8}],
+    ids=["ivf_flat", "hnsw"],
+)
+def test_filtered_search_cost_is_bounded(
+    test_encoding, fake_embeddings, doc_dir, tmp_path, monkeypatch, index_options
+):
+    import math
+
+    import faiss
+    import numpy as np
+
+    import document_retriever
+    from document_retriever import DocumentRetriever
+
+    retriever = DocumentRetriever(str(build(doc_dir, tmp_path / "knowledge", **index_options)), cache_size=0)
+    chunks = all_chunks(retriever)
+    query = chunks[-1].page_content
+    selected = [chunk for chunk in chunks if chunk.metadata["source"] == "doc3.md"]
+    parameters = []
+    search_parameters = DocumentRetriever._search_parameters
+    monkeypatch.setattr(
+        DocumentRetriever,
+        "_search_parameters",
+        lambda self, *args: parameters.append(args[:2]) or search_parameters(self, *args),
+    )
+    # a selective filter scores the selected vectors only, exactly, without searching the index
+    faiss.cvar.hnsw_stats.reset()
+    hits = retriever.search(query, size=3, filters={"source": "doc3.md"})
+    vectors = np.array(retriever.embeddings.embed_documents([chunk.page_content for chunk in selected]))
+    distances = ((vectors - retriever.embed_queries([query])[0]) ** 2).sum(axis=1)
+    assert [hit.page_content for hit in hits] == [selected[i].page_content for i in np.argsort(distances)[:3]]
+    assert parameters == [] and faiss.cvar.hnsw_stats.ndis == 0
+
+    # the search of a broad filter short of results is repeated visiting more of the index, but not all of it
+    monkeypatch.setattr(document_retriever, "EXACT_SEARCH_LIMIT", 0)
+    monkeypatch.setattr(document_retriever, "MAX_EF_SEARCH", 16)
+    hits = retriever.search(query, size=len(selected), filters={"source": "doc3.md"})
+    assert all(hit in selected for hit in hits)
+    assert len(parameters) == 2
+    nprobe, ef_search = parameters[1]
+    if index_options["index_type"] == "hnsw":
+        assert ef_search == 16
+    else:
+        # as many more lists as the filter leaves out chunks
+        assert nprobe == math.ceil(len(chunks) / len(selected)) < retriever.index.nlist
+
+
+
+def test_retrieval_benchmark(test_encoding, tmp_path):
+    from bench_retrieval import make_corpus, run_benchmark
+
+    labels = make_corpus(str(tmp_path / "corpus"), files=3, file_kb=1)
+    assert len(labels) == 9
+    for label in labels:
+        assert label["fact"] in (tmp_path / "corpus" / label["source"]).read_text()
+
+    measures = run_benchmark(
+        str(tmp_path / "run"),
+        files=20,
+        file_kb=2,
+        queries=20,
+        mode="keyword",
+        embedding_options={"embedding_backend": "hash"},
+    )
+    assert measures["queries"] == 20
+    assert measures["chunks"] > 20
+    assert measures["p50_ms"] <= measures["p95_ms"] <= measures["p99_ms"]
+    # every question names its component, the keyword search finds its fact
+    assert measures["recall@5"] == 1.0
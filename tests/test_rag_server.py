@@ -0,0 +1,112 @@
+"""
+Tests for the resident retriever server of the RAG skill and its client.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_community")
+
+
+@pytest.fixture
+def retriever(test_encoding, fake_embeddings, doc_dir, tmp_path):
+    from document_indexer import build_index
+    from document_retriever import DocumentRetriever
+
+    build_index(str(doc_dir), str(tmp_path / "knowledge"), chunk_size=64, chunk_step=32)
+    return DocumentRetriever(str(tmp_path / "knowledge"), cache_size=0)
+
+
+def serve(retriever, **kwargs):
+    from retriever_server import create_server
+
+    server = create_server(retriever, port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    server.batcher.close()
+
+
+@pytest.fixture
+def client(retriever):
+    from retriever_client import RetrieverClient
+
+    server = serve(retriever)
+    yield RetrieverClient(f"http://127.0.0.1:{server.server_address[1]}")
+    stop(server)
+
+
+def test_client_matches_retriever(client, retriever):
+    query = retriever.chunks[4].page_content
+    assert client(query, size=3, target_length=128) == retriever(query, size=3, target_length=128)
+    assert client.retrieve_batch([query, "other words"], size=2, mode="hybrid") == retriever.retrieve_batch(
+        [query, "other words"], size=2, mode="hybrid"
+    )
+    filters = {"folder": "sub"}
+    assert client(query, size=2, filters=filters) == retriever(query, size=2, filters=filters)
+    assert client.health()["status"] == "ok"
+    assert client.health()["version"] == retriever.version
+
+
+def test_client_is_a_self_contained_skill(client, retriever, monkeypatch):
+    import ast
+    import sys
+
+    import retriever_client
+
+    # the skill is pasted on its own, it may only import the standard library
+    with open(retriever_client.__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imported = {alias.name for node in ast.walk(tree) if isinstance(node, ast.Import) for alias in node.names}
+    imported |= {node.module for node in ast.walk(tree) if isinstance(node, ast.ImportFrom)}
+    assert {name.split(".")[0] for name in imported} <= sys.stdlib_module_names
+    monkeypatch.setitem(retriever_client.CONFIG, "server_url", client.url)
+    query = retriever.chunks[4].page_content
+    assert retriever_client.retrieve_documents(query, size=2) == retriever(query, size=2)
+
+
+def test_invalid_requests(client):
+    with pytest.raises(ValueError, match="Unsupported search mode"):
+        client("query", mode="fuzzy")
+    with pytest.raises(ValueError, match="Invalid request"):
+        client._request("POST", "/retrieve", {"queries": "not a list"})
+    with pytest.raises(RuntimeError, match="404"):
+        client._request("GET", "/missing")
+
+
+def test_concurrent_requests_are_batched(retriever):
+    from retriever_client import RetrieverClient
+
+    server = serve(retriever, max_wait=0.5)
+    client = RetrieverClient(f"http://127.0.0.1:{server.server_address[1]}")
+    queries = [chunk.page_content for chunk in list(retriever.chunks)[:8]]
+    try:
+        with ThreadPoolExecutor(len(queries)) as pool:
+            results = list(pool.map(lambda query: client(query, size=1), queries))
+        # every caller gets the results of its own query
+        assert results == [retriever(query, size=1) for query in queries]
+        assert client.health()["batches"] < len(queries)
+    finally:
+        stop(server)
+
+
+def test_unix_socket(retriever, tmp_path):
+    from retriever_client import RetrieverClient
+    from retriever_server import create_server
+
+    socket_path = str(tmp_path / "retriever.sock")
+    server = create_server(retriever, socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = RetrieverClient(f"unix://{socket_path}")
+        query = retriever.chunks[0].page_content
+        assert client(query, size=2) == retriever(query, size=2)
+    finally:
+        stop(server)
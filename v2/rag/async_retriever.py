@@ -0,0 +1,95 @@
+"""
+Asyncio interface of DocumentRetriever for async tools and agents: embedding, search and expansion run on the
+batching thread of the retriever, so awaiting a retrieval does not block the event loop, and the queries of callers
+awaiting at the same time, from any number of tasks or event loops, are retrieved as one batch.
+
+    retriever = await AsyncDocumentRetriever.load("knowledge")
+    results = await retriever("What is AutoGen Studio?", size=5, target_length=256)
+"""
+import asyncio
+import functools
+import json
+from typing import List
+
+from document_retriever import DocumentRetriever
+from federated_retriever import load_retriever
+from retriever_server import RequestBatcher
+
+
+class AsyncDocumentRetriever:
+    def __init__(self, retriever: DocumentRetriever, max_batch: int = 64, max_wait: float = 0.005):
+        """
+        :param retriever: the retriever, only used from the batching thread once wrapped
+        :param max_batch: the maximum number of queries retrieved in one batch
+        :param max_wait: the number of seconds to wait for more queries after the first one of a batch
+        """
+        self.retriever = retriever
+        self.batcher = RequestBatcher(retriever, max_batch, max_wait)
+
+    @classmethod
+    async def load(cls, index_folder: str, max_batch: int = 64, max_wait: float = 0.005, **kwargs):
+        """
+        Load the embedding model and the index of a folder without blocking the event loop
+        :param index_folder: the folder written by document_indexer.py, the shards of a sharded folder are searched
+            together
+        :param max_batch: the maximum number of queries retrieved in one batch
+        :param max_wait: the number of seconds to wait for more queries after the first one of a batch
+        :param kwargs: the other arguments of DocumentRetriever
+        """
+        loop = asyncio.get_running_loop()
+        retriever = await loop.run_in_executor(None, functools.partial(load_retriever, index_folder, **kwargs))
+        return cls(retriever, max_batch, max_wait)
+
+    async def __call__(
+        self,
+        query: str,
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ) -> str:
+        """
+        Retrieve and expand the chunks of a query, see DocumentRetriever.__call__
+        :return: the expanded chunks as a JSON string
+        """
+        results = await self.retrieve_batch([query], size, target_length, nprobe, ef_search, mode, filters)
+        return json.dumps(results[0], indent=4)
+
+    async def retrieve_batch(
+        self,
+        queries: List[str],
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        """
+        Retrieve and expand the chunks of several queries, see DocumentRetriever.retrieve_batch. Cancelling the
+        awaiting task drops its queries if their batch has not started.
+        :return: the expanded chunks of each query, in query order
+        """
+        options = {
+            "size": size,
+            "target_length": target_length,
+            "nprobe": nprobe,
+            "ef_search": ef_search,
+            "mode": mode,
+            "filters": filters,
+        }
+        return await asyncio.wrap_future(self.batcher.submit(list(queries), options))
+
+    def close(self):
+        """
+        Stop the batching thread after the queued queries are retrieved
+        """
+        self.batcher.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,182 @@
+"""
+Compare the chunker in document_indexer.py with the original line-by-line implementation.
+
+Usage:
+    python benchmarks/bench_chunking.py --size_mb 4 --chunk_size 64 --chunk_step 64
+    python benchmarks/bench_chunking.py --workload short --chunk_size 256 --chunk_step 8
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_indexer import chunk_str_overlap  # noqa: E402
+
+
+class RegexEncoding:
+    """
+    A tokenizer stand-in for machines without the tiktoken BPE files, one token per word or symbol
+    """
+
+    pattern = re.compile(r"\w+|[^\w\s]")
+
+    def encode(self, s: str) -> List[str]:
+        return self.pattern.findall(s)
+
+
+def byte_encoding():
+    """
+    A tiktoken encoding with the split pattern of cl100k_base but only byte pairs of lowercase letters, digits and
+    spaces as merges, for machines without the tiktoken BPE files: it runs through the same tiktoken code as the real
+    encodings, with more tokens per line
+    """
+    import tiktoken
+
+    pattern = (
+        r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|"""
+        r"""\s+(?!\S)|\s+"""
+    )
+    ranks = {bytes([i]): i for i in range(256)}
+    for first in b"abcdefghijklmnopqrstuvwxyz0123456789 ":
+        for second in b"abcdefghijklmnopqrstuvwxyz0123456789":
+            ranks[bytes([first, second])] = len(ranks)
+    return tiktoken.Encoding(name="byte_pairs", pat_str=pattern, mergeable_ranks=ranks, special_tokens={})
+
+
+def chunk_str_overlap_legacy(
+    s: str,
+    separator: chr = "\n",
+    num_tokens: int = 64,
+    step_tokens: int = 64,
+    encoding=None,
+) -> List[str]:
+    """
+    The original chunker, encodes every line on its own and grows every open chunk line by line
+    """
+    assert step_tokens <= num_tokens, (
+        f"The number of tokens {num_tokens} in each chunk " f"should be larger than the step size {step_tokens}."
+    )
+
+    lines = s.split(separator)
+    chunks = dict()
+    final_chunks = []
+
+    if len(lines) == 0:
+        return []
+
+    first_line = lines[0]
+    first_line_size = len(encoding.encode(first_line))
+
+    chunks[0] = [first_line, first_line_size]
+
+    this_step_size = first_line_size
+
+    for i in range(1, len(lines)):
+        line = lines[i]
+        line_size = len(encoding.encode(line))
+
+        to_pop = []
+        for key in chunks:
+            if chunks[key][1] + line_size > num_tokens:
+                to_pop.append(key)
+            else:
+                chunks[key][0] += f"{separator}{line}"
+                chunks[key][1] += line_size
+        final_chunks += [chunks.pop(key)[0] for key in to_pop]
+
+        if this_step_size + line_size > step_tokens:
+            chunks[i] = [line, line_size]
+            this_step_size = 0
+        this_step_size += line_size
+
+    max_remained_chunk = ""
+    max_remained_chunk_size = 0
+    for key in chunks:
+        if chunks[key][1] > max_remained_chunk_size:
+            max_remained_chunk_size = chunks[key][1]
+            max_remained_chunk = chunks[key][0]
+    if max_remained_chunk_size > 0:
+        final_chunks.append(max_remained_chunk)
+
+    return final_chunks
+
+
+def make_text(size_mb: float, seed: int = 0) -> str:
+    """
+    Generate markdown-like text of roughly size_mb megabytes with short, long and blank lines
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(2000)] + ["autogen", "agent", "skill", "index", "(", ")", ":", "-"]
+    lines = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        kind = rng.random()
+        if kind < 0.1:
+            line = ""
+        elif kind < 0.2:
+            line = "# " + " ".join(rng.choices(vocabulary, k=rng.randint(1, 6)))
+        else:
+            line = " ".join(rng.choices(vocabulary, k=rng.randint(3, 40)))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def make_short_lines(num_lines: int, seed: int = 0) -> str:
+    """
+    Generate num_lines lines of 1 to 3 words, like a word list, a log or a table exported line per cell, where many
+    lines fit in a chunk and the original chunker grows many open chunks on every line
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(2000)]
+    return "\n".join(" ".join(rng.choices(vocabulary, k=rng.randint(1, 3))) for _ in range(num_lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workload",
+        help="long: markdown-like lines of up to 40 words, short: lines of 1 to 3 words",
+        choices=["long", "short"],
+        default="long",
+    )
+    parser.add_argument("--size_mb", help="the size of the generated text of the long workload", type=float, default=4)
+    parser.add_argument("--lines", help="the number of lines of the short workload", type=int, default=400000)
+    parser.add_argument("-c", "--chunk_size", help="the size of the chunk", type=int, default=64)
+    parser.add_argument("-s", "--chunk_step", help="the step size of the chunk", type=int, default=64)
+    parser.add_argument(
+        "--tokenizer",
+        help="tiktoken, or bytes (tiktoken with byte-pair merges) or regex when the tiktoken files cannot be "
+        "downloaded",
+        choices=["tiktoken", "bytes", "regex"],
+        default="tiktoken",
+    )
+    args = parser.parse_args()
+
+    if args.tokenizer == "tiktoken":
+        import tiktoken
+
+        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    elif args.tokenizer == "bytes":
+        enc = byte_encoding()
+    else:
+        enc = RegexEncoding()
+
+    text = make_text(args.size_mb) if args.workload == "long" else make_short_lines(args.lines)
+    print(f"Text: {len(text) / 1024 / 1024:.1f} MB, {text.count(chr(10)) + 1} lines")
+
+    timings = {}
+    results = {}
+    for name, func in (("legacy", chunk_str_overlap_legacy), ("single-pass", chunk_str_overlap)):
+        start = time.perf_counter()
+        results[name] = func(text, num_tokens=args.chunk_size, step_tokens=args.chunk_step, encoding=enc)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>12}: {timings[name]:.2f}s, {len(results[name])} chunks")
+
+    assert results["legacy"] == results["single-pass"], "The chunk boundaries differ"
+    print(f"Identical chunks, speedup {timings['legacy'] / timings['single-pass']:.1f}x")
@@ -0,0 +1,73 @@
+"""
+Measure the cold start of the RAG scripts for commands that do not embed: importing the modules, --help and
+--check. Every command runs in a fresh interpreter, the fastest of several runs is kept and the startup of a bare
+interpreter is subtracted, and the heavy dependencies each command loaded are listed.
+
+Usage:
+    python benchmarks/bench_import.py --runs 5 --target_ms 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["numpy", "faiss", "tiktoken", "langchain_core", "langchain_community", "torch", "transformers"]
+# prints the heavy modules loaded by the command that ran before it
+REPORT = f"import sys, json; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+
+
+def run(args, cwd: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def loaded_modules(statement: str, cwd: str):
+    output = subprocess.run(
+        [sys.executable, "-c", f"{statement}\n{REPORT}"], cwd=cwd, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1]) if output.strip() else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", help="the number of runs of each command", type=int, default=5)
+    parser.add_argument("--target_ms", help="the cold start target over a bare interpreter", type=float, default=200)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    documents, knowledge = os.path.join(folder, "documents"), os.path.join(folder, "knowledge")
+    os.makedirs(documents)
+    with open(os.path.join(documents, "doc.md"), "w") as f:
+        f.write("# Document\nSome text.\n")
+
+    check = ["-d", documents, "-o", knowledge, "--check"]
+    commands = {
+        "import document_indexer": (["-c", "import document_indexer"], "import document_indexer"),
+        "import document_retriever": (["-c", "import document_retriever"], "import document_retriever"),
+        "import retriever_client": (["-c", "import retriever_client"], "import retriever_client"),
+        "document_indexer.py --help": (["document_indexer.py", "--help"], None),
+        "document_retriever.py --help": (["document_retriever.py", "--help"], None),
+        "document_indexer.py --check": (
+            ["document_indexer.py", *check],
+            f"import sys; sys.argv = ['document_indexer.py', *{check!r}]\n"
+            "try:\n    import runpy; runpy.run_path('document_indexer.py', run_name='__main__')\n"
+            "except SystemExit:\n    pass",
+        ),
+    }
+
+    baseline = min(run(["-c", "pass"], RAG_DIR) for _ in range(args.runs))
+    print(f"Bare interpreter: {baseline * 1000:.0f} ms")
+    failed = False
+    for name, (command, statement) in commands.items():
+        elapsed = max(min(run(command, RAG_DIR) for _ in range(args.runs)) - baseline, 0)
+        loaded = loaded_modules(statement, RAG_DIR) if statement else None
+        status = "ok" if elapsed * 1000 <= args.target_ms else "SLOW"
+        failed |= status != "ok"
+        heavy = "" if loaded is None else f", loads {', '.join(loaded) or 'no heavy modules'}"
+        print(f"{name:>30}: {elapsed * 1000:6.0f} ms {status}{heavy}")
+    sys.exit(1 if failed else 0)
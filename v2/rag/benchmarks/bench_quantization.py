@@ -0,0 +1,105 @@
+"""
+Compare the recall, memory and query time of the vector storages of document_indexer.py (float32, float16 and int8)
+for each index type, to pick a storage with data. Indexes are created with the indexer's own create_faiss_index.
+
+The vectors are read from an index folder built with float32 storage, or generated: clustered unit vectors, like
+sentence embeddings. Queries are noisy copies of indexed vectors, the exact float32 search gives the true neighbors.
+
+Usage:
+    python benchmarks/bench_quantization.py --vectors 100000 --queries 500 --k 10
+    python benchmarks/bench_quantization.py --index_folder knowledge --index_types flat hnsw --project 20000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_indexer import DEFAULT_INDEX_OPTIONS, INDEX_FILE, STORAGE_TYPES, create_faiss_index  # noqa: E402
+
+
+def make_vectors(count: int, dim: int = 384, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """
+    Generate unit vectors around random cluster centers
+    :param count: the number of vectors
+    :param dim: the dimension
+    :param clusters: the number of clusters
+    :param seed: the random seed
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centers[rng.integers(clusters, size=count)] + 0.5 * rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_vectors(index_folder: str) -> np.ndarray:
+    """
+    Read the vectors of an index folder
+    :param index_folder: the folder written by document_indexer.py
+    """
+    index = faiss.read_index(os.path.join(index_folder, INDEX_FILE))
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    """
+    Get the share of the true neighbors found, averaged over the queries
+    """
+    return float(np.mean([len(set(row) & set(true_row)) / len(true_row) for row, true_row in zip(found, truth)]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_folder", help="read the vectors of a float32 index folder", type=str, default=None)
+    parser.add_argument("--vectors", help="the number of generated vectors", type=int, default=100000)
+    parser.add_argument("--queries", help="the number of queries", type=int, default=500)
+    parser.add_argument("-k", "--k", help="the number of neighbors per query", type=int, default=10)
+    parser.add_argument(
+        "--index_types", help="the index types to compare", nargs="+", default=["flat", "ivf_flat", "hnsw"]
+    )
+    parser.add_argument("--nlist", help="the number of inverted lists of ivf indexes", type=int, default=256)
+    parser.add_argument(
+        "--project", help="the number of vectors to project the memory to", type=int, default=10000000
+    )
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.index_folder) if args.index_folder else make_vectors(args.vectors)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(len(vectors), size=args.queries)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(vectors.shape[1])
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, args.k)
+    print(f"{len(vectors)} vectors of dimension {vectors.shape[1]}, {len(queries)} queries, recall@{args.k}")
+
+    rows = []
+    for index_type in args.index_types:
+        for storage in STORAGE_TYPES:
+            options = {**DEFAULT_INDEX_OPTIONS, "index_type": index_type, "storage": storage, "nlist": args.nlist}
+            index = create_faiss_index(vectors[: options["train_size"]], options)
+            index.add(vectors)
+            if isinstance(index, faiss.IndexIVF):
+                index.nprobe = options["nprobe"]
+            elif isinstance(index, faiss.IndexHNSW):
+                index.hnsw.efSearch = options["ef_search"]
+            size = len(faiss.serialize_index(index))
+            start = time.perf_counter()
+            _, found = index.search(queries, args.k)
+            elapsed = time.perf_counter() - start
+            rows.append((index_type, storage, size / len(vectors), size, recall(found, truth), elapsed / len(queries)))
+
+    print(
+        f"{'index':>10} {'storage':>8} {'bytes/vector':>13} {'size MB':>9} "
+        f"{f'GB at {args.project:,}':>18} {'recall':>7} {'ms/query':>9}"
+    )
+    for index_type, storage, per_vector, size, found_share, seconds in rows:
+        print(
+            f"{index_type:>10} {storage:>8} {per_vector:13.0f} {size / 2**20:9.1f} "
+            f"{per_vector * args.project / 2**30:18.1f} {found_share:7.3f} {seconds * 1000:9.3f}"
+        )
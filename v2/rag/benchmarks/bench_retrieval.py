@@ -0,0 +1,267 @@
+"""
+Measure indexing throughput, query latency, peak memory and recall@k of the RAG skill end to end: generate a synthetic
+corpus of markdown files with labelled facts, build the index with document_indexer.py and replay questions about the
+facts against DocumentRetriever. Use it to compare chunk sizes, index options or changes to the chunker and do_expand.
+
+Runs offline: without the all-MiniLM-L6-v2 model in the local cache, chunks and queries are embedded by the hash
+backend of embedding_backends.py, a bag of hashed words, and without the tiktoken BPE files tokens are counted by
+WordEncoding.
+
+Usage:
+    python benchmarks/bench_retrieval.py --files 500 --file_kb 8 --queries 300 --size 5
+    python benchmarks/bench_retrieval.py --chunk_size 128 --chunk_step 64 --index_type hnsw --json results.json
+    python benchmarks/bench_retrieval.py --embedding_backend onnx --embedding_model all-MiniLM-L6-v2-int8 --threads 4
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_indexer  # noqa: E402
+from document_indexer import DEFAULT_INDEX_OPTIONS, INDEX_TYPES, STORAGE_TYPES, build_index, peak_rss_mb  # noqa: E402
+from document_retriever import SEARCH_MODES, DocumentRetriever  # noqa: E402
+from word_encoding import WordEncoding  # noqa: E402
+
+ATTRIBUTES = ["default port", "owner", "release codename", "retry limit", "storage region", "escalation contact"]
+
+
+def use_offline_models(embedding_backend: str = "auto") -> str:
+    """
+    Replace the tokenizer with WordEncoding where the tiktoken BPE files are not available, and pick the embedding
+    backend
+    :param embedding_backend: an embedding backend, or "auto" for huggingface when its model is in the local cache
+        and hash otherwise
+    :return: the embedding backend
+    """
+    import tiktoken
+
+    try:
+        tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except Exception:
+        encoding = WordEncoding()
+        document_indexer._encoding = encoding
+        tiktoken.encoding_for_model = lambda model_name: encoding
+        print("tiktoken BPE files not available, counting words as tokens.")
+
+    if embedding_backend == "auto":
+        # only look in the local cache, never download the model
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        try:
+            document_indexer.load_embedding_model()
+            embedding_backend = "huggingface"
+        except Exception:
+            print("Embedding model not available, embedding with the hash backend.")
+            embedding_backend = "hash"
+    return embedding_backend
+
+
+def make_corpus(folder: str, files: int, file_kb: float, seed: int = 0) -> List[Dict]:
+    """
+    Write markdown files of filler sentences, each with a few facts about a unique component, in team folders
+    :param folder: the folder of the documents
+    :param files: the number of files
+    :param file_kb: the approximate size of each file in KB
+    :param seed: the random seed
+    :return: the labelled queries, a question per fact with the source and the sentence of the fact
+    """
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "qua", "bri", "dor", "fen", "gul", "hap"]
+    vocabulary = ["".join(rng.choices(syllables, k=rng.randint(1, 3))) for _ in range(3000)]
+    # a few frequent words and a long tail, like natural text
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    labels = []
+    for i in range(files):
+        source = os.path.join(f"team{i % 8}", f"doc{i}.md")
+        component = f"{rng.choice(syllables)}{rng.choice(syllables)}{i}"
+        facts = [
+            f"The {attribute} of {component} is {rng.choice(syllables)}{rng.randint(1000, 9999)}."
+            for attribute in rng.sample(ATTRIBUTES, 3)
+        ]
+        lines = [f"# Component {component}"]
+        size = len(lines[0])
+        while size < file_kb * 1024:
+            line = " ".join(rng.choices(vocabulary, weights, k=rng.randint(6, 18))).capitalize() + "."
+            lines.append(line)
+            size += len(line) + 1
+        for fact in facts:
+            lines.insert(rng.randint(1, len(lines)), fact)
+        os.makedirs(os.path.join(folder, os.path.dirname(source)), exist_ok=True)
+        with open(os.path.join(folder, source), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        for fact in facts:
+            attribute = fact[len("The ") : fact.index(" of ")]
+            labels.append({"query": f"What is the {attribute} of {component}?", "source": source, "fact": fact})
+    return labels
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    """
+    Get the p50, p95 and p99 of latencies in milliseconds
+    """
+    values = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+    return {"p50_ms": float(values[0]), "p95_ms": float(values[1]), "p99_ms": float(values[2])}
+
+
+def run_benchmark(
+    folder: str,
+    files: int = 200,
+    file_kb: float = 8,
+    queries: int = 200,
+    size: int = 5,
+    target_length: int = 256,
+    chunk_size: int = 64,
+    chunk_step: int = 64,
+    workers: int = 1,
+    index_options: Dict = None,
+    mode: str = "vector",
+    seed: int = 0,
+    embedding_options: Dict = None,
+) -> Dict:
+    """
+    Generate a corpus, index it and replay its labelled queries one at a time
+    :param folder: the working folder, receives the documents and the index
+    :param files: the number of files
+    :param file_kb: the approximate size of each file in KB
+    :param queries: the number of queries replayed, sampled from the labelled queries
+    :param size: the number of results per query, the k of recall@k
+    :param target_length: the number of tokens of each expanded result
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    :param index_options: the type and parameters of the faiss index, see DEFAULT_INDEX_OPTIONS
+    :param mode: the search mode
+    :param seed: the random seed
+    :param embedding_options: the embedding backend, model and threads, see document_indexer.DEFAULT_EMBEDDING_OPTIONS
+    :return: the measures
+    """
+    doc_path, index_folder = os.path.join(folder, "documents"), os.path.join(folder, "knowledge")
+    labels = make_corpus(doc_path, files, file_kb, seed)
+    corpus_mb = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(doc_path) for name in names)
+
+    start = time.perf_counter()
+    build_index(
+        doc_path,
+        index_folder,
+        chunk_size,
+        chunk_step,
+        workers,
+        index_options=index_options,
+        embedding_options=embedding_options,
+    )
+    index_seconds = time.perf_counter() - start
+    index_peak_mb = peak_rss_mb()
+    worker_peak_mb = peak_rss_mb(workers=True)
+
+    start = time.perf_counter()
+    # the retriever embeds queries with the backend and model recorded by the indexer
+    threads = (embedding_options or {}).get("threads")
+    retriever = DocumentRetriever(index_folder, cache_size=0, threads=threads)
+    load_seconds = time.perf_counter() - start
+    chunks = retriever.index.ntotal
+    replayed = random.Random(seed).sample(labels, min(queries, len(labels)))
+    # the first query warms the model and the page cache up, it is not measured
+    retriever(replayed[0]["query"], size, target_length, mode=mode)
+    latencies, found = [], 0
+    for label in replayed:
+        start = time.perf_counter()
+        results = retriever.retrieve_batch([label["query"]], size, target_length, mode=mode)[0]
+        latencies.append(time.perf_counter() - start)
+        found += any(
+            result["metadata"]["source"] == label["source"] and label["fact"] in result["chunk"] for result in results
+        )
+
+    return {
+        "files": files,
+        "corpus_mb": corpus_mb / 2**20,
+        "chunks": chunks,
+        "index_seconds": index_seconds,
+        "files_per_second": files / index_seconds,
+        "chunks_per_second": chunks / index_seconds,
+        "load_seconds": load_seconds,
+        "queries": len(replayed),
+        **percentiles(latencies),
+        f"recall@{size}": found / len(replayed),
+        "index_peak_mb": index_peak_mb,
+        "worker_peak_mb": worker_peak_mb,
+        "peak_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", help="the number of generated files", type=int, default=200)
+    parser.add_argument("--file_kb", help="the approximate size of each file in KB", type=float, default=8)
+    parser.add_argument("--queries", help="the number of queries replayed", type=int, default=200)
+    parser.add_argument("--size", help="the number of results per query, the k of recall@k", type=int, default=5)
+    parser.add_argument("--target_length", help="the number of tokens of each result", type=int, default=256)
+    parser.add_argument("-c", "--chunk_size", help="the size of the chunk", type=int, default=64)
+    parser.add_argument("-s", "--chunk_step", help="the step size of the chunk", type=int, default=64)
+    parser.add_argument("-w", "--workers", help="the number of indexing processes", type=int, default=1)
+    parser.add_argument("-t", "--index_type", choices=INDEX_TYPES, default=DEFAULT_INDEX_OPTIONS["index_type"])
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default=DEFAULT_INDEX_OPTIONS["storage"])
+    parser.add_argument("--mode", choices=SEARCH_MODES, default="vector")
+    parser.add_argument(
+        "--embedding_backend",
+        help="the embedding backend, auto for huggingface when its model is in the local cache and hash otherwise",
+        choices=["auto", "huggingface", "onnx", "hash"],
+        default="auto",
+    )
+    parser.add_argument("--embedding_model", help="the model of the embedding backend", type=str, default=None)
+    parser.add_argument("--threads", help="the number of threads embedding a batch", type=int, default=None)
+    parser.add_argument("--seed", help="the random seed of the corpus and the queries", type=int, default=0)
+    parser.add_argument("--output", help="the working folder, a temporary folder by default", type=str, default=None)
+    parser.add_argument("--json", help="also write the measures to this file", type=str, default=None)
+    args = parser.parse_args()
+
+    embedding_backend = use_offline_models(args.embedding_backend)
+    embedding_options = {
+        "embedding_backend": embedding_backend,
+        "embedding_model": args.embedding_model,
+        "threads": args.threads,
+    }
+    folder = args.output or tempfile.mkdtemp()
+    try:
+        measures = run_benchmark(
+            folder,
+            args.files,
+            args.file_kb,
+            args.queries,
+            args.size,
+            args.target_length,
+            args.chunk_size,
+            args.chunk_step,
+            args.workers,
+            {"index_type": args.index_type, "storage": args.storage},
+            args.mode,
+            args.seed,
+            embedding_options,
+        )
+    finally:
+        if not args.output:
+            shutil.rmtree(folder)
+    measures = {"embedding_backend": embedding_backend, **measures}
+
+    print(f"Corpus: {measures['files']} files, {measures['corpus_mb']:.1f} MB, {measures['chunks']} chunks")
+    print(
+        f"Indexing: {measures['index_seconds']:.1f} s, {measures['files_per_second']:.1f} files/s, "
+        f"{measures['chunks_per_second']:.1f} chunks/s, peak memory {measures['index_peak_mb']:.0f} MB"
+        + (f", {measures['worker_peak_mb']:.0f} MB in a worker" if measures["worker_peak_mb"] else "")
+    )
+    print(
+        f"Queries: {measures['queries']} embedded by {embedding_backend}, p50 {measures['p50_ms']:.1f} ms, "
+        f"p95 {measures['p95_ms']:.1f} ms, p99 {measures['p99_ms']:.1f} ms, "
+        f"recall@{args.size} {measures[f'recall@{args.size}']:.3f}"
+    )
+    print(f"Retriever load: {measures['load_seconds']:.2f} s, peak memory {measures['peak_mb']:.0f} MB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(measures, f, indent=4)
@@ -0,0 +1,19 @@
+"""
+A tokenizer stand-in for machines without the tiktoken BPE files, shared by the benchmarks and the tests.
+"""
+import re
+from typing import List
+
+
+class WordEncoding:
+    """
+    One token per word with its leading space, so decoding the tokens gives back the text
+    """
+
+    pattern = re.compile(r"\s*\S+|\s+")
+
+    def encode(self, s: str) -> List[str]:
+        return self.pattern.findall(s)
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
@@ -0,0 +1,301 @@
+"""
+Inverted index of the chunk words, used by document_retriever.py to score chunks with BM25 for keyword and hybrid
+search, e.g. for identifiers, error codes and API names that the embedding model does not match.
+
+The index folder holds the distinct terms sorted by their utf-8 bytes in one file (bm25_terms.bin) and NumPy arrays
+with the byte offset of each term, the offset of its postings, the chunk positions and term frequencies of all
+postings, and the number of terms of each chunk. All of them are memory-mapped: looking a term up is a binary search
+over the terms and reading its postings is one slice, no chunk text is scanned.
+"""
+import json
+import mmap
+import os
+import re
+import tempfile
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TERMS_FILE = "bm25_terms.bin"
+TERM_OFFSETS_FILE = "bm25_term_offsets.npy"
+POSTING_OFFSETS_FILE = "bm25_posting_offsets.npy"
+POSTINGS_FILE = "bm25_postings.npy"
+FREQUENCIES_FILE = "bm25_frequencies.npy"
+LENGTHS_FILE = "bm25_lengths.npy"
+INFO_FILE = "bm25_info.json"
+# the number of postings buffered by BM25Writer before they are spilled to disk, 12 bytes each
+SPILL_SIZE = 1 << 20
+
+K1 = 1.2
+B = 0.75
+
+_word = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lowercase terms, letters, digits and underscores, so snake_case names and error codes stay
+    whole and dotted API names match on each part
+    :param text: the text
+    """
+    return _word.findall(text.lower())
+
+
+def _save_array(path: str, values):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(path + ".tmp", path)
+
+
+class BM25Index:
+    def __init__(
+        self,
+        terms,
+        term_offsets: np.ndarray,
+        posting_offsets: np.ndarray,
+        postings: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+        average_length: float,
+    ):
+        """
+        :param terms: the sorted terms, concatenated, a memory map or bytes
+        :param term_offsets: the byte offset of each term, followed by the size of terms
+        :param posting_offsets: the offset of the postings of each term, followed by the number of postings
+        :param postings: the chunk positions of the postings of all terms, sorted by term then position
+        :param frequencies: the number of occurrences of the term in the chunk of each posting
+        :param lengths: the number of terms of each chunk
+        :param average_length: the average number of terms of a chunk
+        """
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.posting_offsets = posting_offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.average_length = average_length
+
+    def __len__(self) -> int:
+        """
+        Get the number of chunks
+        """
+        return len(self.lengths)
+
+    def _term(self, term_id: int) -> bytes:
+        return self.terms[int(self.term_offsets[term_id]) : int(self.term_offsets[term_id + 1])]
+
+    def term_id(self, term: str) -> Optional[int]:
+        """
+        Find a term by binary search
+        :param term: the term
+        :return: the term id, None if no chunk has the term
+        """
+        key = term.encode("utf-8")
+        low, high = 0, len(self.term_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.term_offsets) - 1 and self._term(low) == key:
+            return low
+        return None
+
+    def postings_of(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the chunks containing a term
+        :param term: the term
+        :return: the chunk positions and the number of occurrences of the term in each chunk
+        """
+        term_id = self.term_id(term)
+        if term_id is None:
+            return self.postings[:0], self.frequencies[:0]
+        start, end = int(self.posting_offsets[term_id]), int(self.posting_offsets[term_id + 1])
+        return self.postings[start:end], self.frequencies[start:end]
+
+    def search(self, query: str, size: int = 5, bitmap: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the chunks with the highest BM25 score for a query, only the postings of the query terms are read
+        :param query: the query
+        :param size: the number of chunks
+        :param bitmap: one bit per chunk packed in little-endian bit order, as np.packbits(mask, bitorder="little"),
+            only the chunks set in it are scored, None to score all chunks
+        :return: the chunk positions and their scores, best first, fewer than size if fewer chunks match
+        """
+        positions, scores = [], []
+        for term in set(tokenize(query)):
+            term_positions, term_frequencies = self.postings_of(term)
+            if not len(term_positions):
+                continue
+            # the document frequency is the one of the whole index, so a filter does not change the scores
+            idf = np.log(1 + (len(self) - len(term_positions) + 0.5) / (len(term_positions) + 0.5))
+            if bitmap is not None:
+                selected = ((bitmap[term_positions >> 3] >> (term_positions & 7)) & 1).astype(bool)
+                term_positions, term_frequencies = term_positions[selected], term_frequencies[selected]
+            frequencies = term_frequencies.astype(np.float32)
+            norm = K1 * (1 - B + B * self.lengths[term_positions] / self.average_length)
+            positions.append(term_positions)
+            scores.append(idf * frequencies * (K1 + 1) / (frequencies + norm))
+        if not positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # sum the scores of chunks matching several terms without allocating a score per chunk of the index
+        matched, inverse = np.unique(np.concatenate(positions), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        best = np.argpartition(-totals, size)[:size] if len(totals) > size else np.arange(len(totals))
+        best = best[np.argsort(-totals[best], kind="stable")]
+        return matched[best].astype(np.int64), totals[best].astype(np.float32)
+
+    @staticmethod
+    def write(folder: str, texts: Iterable[str]):
+        """
+        Build the index of the chunk texts in index order and write it to an index folder
+        :param folder: the index folder
+        :param texts: the chunk texts in index order
+        """
+        writer = BM25Writer(folder)
+        for text in texts:
+            writer.add(text)
+        writer.close()
+
+    @classmethod
+    def load(cls, folder: str) -> "BM25Index":
+        """
+        Open the index of an index folder, memory-mapped
+        :param folder: the index folder
+        """
+        with open(os.path.join(folder, INFO_FILE), encoding="utf-8") as f:
+            info = json.load(f)
+        arrays = [
+            np.load(os.path.join(folder, name), mmap_mode="r")
+            for name in (TERM_OFFSETS_FILE, POSTING_OFFSETS_FILE, POSTINGS_FILE, FREQUENCIES_FILE, LENGTHS_FILE)
+        ]
+        with open(os.path.join(folder, TERMS_FILE), "rb") as f:
+            # an empty file cannot be memory-mapped
+            terms = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if arrays[0][-1] else b""
+        return cls(terms, *arrays, info["average_length"])
+
+
+class BM25Writer:
+    def __init__(self, folder: str, spill_size: int = SPILL_SIZE):
+        """
+        Build the index of an index folder from chunk texts added one at a time in index order. Only the vocabulary
+        and the number of terms of each chunk are held: the postings are spilled to a temporary file in the folder
+        and scattered into the memory-mapped posting arrays once all chunks are added.
+        :param folder: the index folder
+        :param spill_size: the number of postings buffered before they are spilled
+        """
+        self.folder = folder
+        self.spill_size = spill_size
+        # ids in order of first occurrence, renumbered in sorted order on close
+        self.term_ids: Dict[str, int] = dict()
+        self.term_counts = array("q")
+        self.lengths = array("i")
+        # (term id, position, frequency) triples, flattened
+        self.buffer = array("i")
+        self.spill = tempfile.TemporaryFile(dir=folder)
+
+    def add(self, text: str):
+        """
+        Add the next chunk
+        :param text: the text of the chunk
+        """
+        counts = dict()
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+        position = len(self.lengths)
+        self.lengths.append(sum(counts.values()))
+        for term, count in counts.items():
+            term_id = self.term_ids.setdefault(term, len(self.term_ids))
+            if term_id == len(self.term_counts):
+                self.term_counts.append(0)
+            self.term_counts[term_id] += 1
+            self.buffer.extend((term_id, position, count))
+        if len(self.buffer) >= 3 * self.spill_size:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.tofile(self.spill)
+        self.buffer = array("i")
+
+    def close(self):
+        """
+        Write the index files, the info file last
+        """
+        self._spill()
+        encoded = sorted((term.encode("utf-8"), term_id) for term, term_id in self.term_ids.items())
+        self.term_ids = dict()
+        sorted_ids = np.empty(len(encoded), dtype=np.int64)
+        sorted_ids[[term_id for _, term_id in encoded]] = np.arange(len(encoded))
+        term_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        posting_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        if encoded:
+            np.cumsum([len(key) for key, _ in encoded], out=term_offsets[1:])
+            counts = np.frombuffer(self.term_counts, dtype=np.int64)
+            np.cumsum(counts[[term_id for _, term_id in encoded]], out=posting_offsets[1:])
+        total = int(posting_offsets[-1])
+
+        terms_path = os.path.join(self.folder, TERMS_FILE)
+        with open(terms_path + ".tmp", "wb") as f:
+            for key, _ in encoded:
+                f.write(key)
+        os.replace(terms_path + ".tmp", terms_path)
+        del encoded
+        _save_array(os.path.join(self.folder, TERM_OFFSETS_FILE), term_offsets)
+        _save_array(os.path.join(self.folder, POSTING_OFFSETS_FILE), posting_offsets)
+        postings_path = os.path.join(self.folder, POSTINGS_FILE)
+        frequencies_path = os.path.join(self.folder, FREQUENCIES_FILE)
+        if total:
+            postings = np.lib.format.open_memmap(postings_path + ".tmp", "w+", np.int32, (total,))
+            frequencies = np.lib.format.open_memmap(frequencies_path + ".tmp", "w+", np.int32, (total,))
+            # the spilled postings are in position order, a stable sort of each block by term id keeps that order
+            # within the postings of a term
+            cursors = posting_offsets[:-1].copy()
+            self.spill.seek(0)
+            while True:
+                block = np.fromfile(self.spill, dtype=np.int32, count=3 * self.spill_size).reshape(-1, 3)
+                if not len(block):
+                    break
+                block_ids = sorted_ids[block[:, 0]]
+                order = np.argsort(block_ids, kind="stable")
+                block_ids = block_ids[order]
+                rank = np.arange(len(order)) - np.searchsorted(block_ids, block_ids)
+                targets = cursors[block_ids] + rank
+                postings[targets] = block[order, 1]
+                frequencies[targets] = block[order, 2]
+                cursors += np.bincount(block_ids, minlength=len(cursors))
+            postings.flush()
+            frequencies.flush()
+            del postings, frequencies
+            os.replace(postings_path + ".tmp", postings_path)
+            os.replace(frequencies_path + ".tmp", frequencies_path)
+        else:
+            _save_array(postings_path, np.zeros(0, dtype=np.int32))
+            _save_array(frequencies_path, np.zeros(0, dtype=np.int32))
+        self.spill.close()
+        lengths = np.frombuffer(self.lengths, dtype=np.int32) if self.lengths else np.zeros(0, dtype=np.int32)
+        _save_array(os.path.join(self.folder, LENGTHS_FILE), lengths)
+        info = {
+            "k1": K1,
+            "b": B,
+            "chunks": len(lengths),
+            "terms": len(term_offsets) - 1,
+            "average_length": float(lengths.mean()) if len(lengths) else 0.0,
+        }
+        # the info file is written last, an index folder with it has complete postings
+        info_path = os.path.join(self.folder, INFO_FILE)
+        with open(info_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        os.replace(info_path + ".tmp", info_path)
+
+
+def load_bm25_index(folder: str) -> Optional[BM25Index]:
+    """
+    Open the keyword index of an index folder
+    :param folder: the index folder
+    :return: the index, None for indexes built by earlier versions of the indexer
+    """
+    if not os.path.exists(os.path.join(folder, INFO_FILE)):
+        return None
+    return BM25Index.load(folder)
@@ -0,0 +1,115 @@
+"""
+Text and metadata of every chunk in the vector index, read from disk on demand.
+
+The index folder holds the chunks in index order as one JSON object per line (chunks.jsonl) and a NumPy array with
+the byte offset of every line plus the end of the file (chunk_offsets.npy). Both are memory-mapped, so opening a store
+does not depend on its size and the processes reading one index folder share the page cache.
+"""
+import json
+import mmap
+import os
+import pickle
+from array import array
+from typing import Dict, Iterable, Iterator
+
+import numpy as np
+from langchain_core.documents import Document
+
+CHUNKS_FILE = "chunks.jsonl"
+CHUNK_OFFSETS_FILE = "chunk_offsets.npy"
+LEGACY_FILE = "index.pkl"
+
+
+class ChunkStore:
+    def __init__(self, data, offsets: np.ndarray):
+        """
+        :param data: the content of chunks.jsonl, a memory map or bytes
+        :param offsets: the byte offset of each chunk, followed by the size of the data
+        """
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> Document:
+        """
+        Get a chunk by its position in the vector index
+        :param position: the position of the chunk
+        """
+        if not 0 <= position < len(self):
+            raise IndexError(f"No chunk at position {position}, the store has {len(self)} chunks.")
+        record = json.loads(self.data[int(self.offsets[position]) : int(self.offsets[position + 1])])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def __iter__(self) -> Iterator[Document]:
+        for position in range(len(self)):
+            yield self[position]
+
+    @staticmethod
+    def write(folder: str, documents: Iterable[Document]):
+        """
+        Write the chunks of an index folder, replacing the files atomically so open stores keep their old mapping
+        :param folder: the index folder
+        :param documents: the chunks in index order
+        """
+        chunks_path = os.path.join(folder, CHUNKS_FILE)
+        offsets = array("q", [0])
+        with open(chunks_path + ".tmp", "wb") as f:
+            for document in documents:
+                record = {"page_content": document.page_content, "metadata": document.metadata}
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        offsets_path = os.path.join(folder, CHUNK_OFFSETS_FILE)
+        with open(offsets_path + ".tmp", "wb") as f:
+            np.save(f, np.array(offsets, dtype=np.int64))
+        os.replace(chunks_path + ".tmp", chunks_path)
+        os.replace(offsets_path + ".tmp", offsets_path)
+        # drop the pickled docstore written by earlier versions of the indexer, it would be stale
+        if os.path.exists(os.path.join(folder, LEGACY_FILE)):
+            os.remove(os.path.join(folder, LEGACY_FILE))
+
+    @classmethod
+    def load(cls, folder: str) -> "ChunkStore":
+        """
+        Open the chunks of an index folder, memory-mapped
+        :param folder: the index folder
+        """
+        offsets = np.load(os.path.join(folder, CHUNK_OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(folder, CHUNKS_FILE), "rb") as f:
+            # an empty file cannot be memory-mapped
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+        return cls(data, offsets)
+
+
+class LegacyChunkStore:
+    """
+    The LangChain docstore pickled in index.pkl by earlier versions of the indexer
+    """
+
+    def __init__(self, docstore, index_to_docstore_id: Dict[int, str]):
+        self.docstore = docstore
+        self.index_to_docstore_id = index_to_docstore_id
+
+    def __len__(self) -> int:
+        return len(self.index_to_docstore_id)
+
+    def __getitem__(self, position: int) -> Document:
+        return self.docstore.search(self.index_to_docstore_id[position])
+
+    def __iter__(self) -> Iterator[Document]:
+        for position in range(len(self)):
+            yield self[position]
+
+
+def load_chunk_store(folder: str):
+    """
+    Open the chunks of an index folder, falling back to the pickled docstore of older indexes
+    :param folder: the index folder
+    """
+    if os.path.exists(os.path.join(folder, CHUNK_OFFSETS_FILE)):
+        return ChunkStore.load(folder)
+    with open(os.path.join(folder, LEGACY_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return LegacyChunkStore(docstore, index_to_docstore_id)
@@ -1,18 +1,95 @@
+from __future__ import annotations
+
 import argparse
 import csv
 import json
 import os
-import pickle
 import re
+import shutil
+import sys
+import tempfile
 import traceback
-from typing import Dict, List, Literal, Tuple
+import uuid
+import zipfile
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import accumulate, chain, islice
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Literal, Tuple
+from xml.etree import ElementTree
 
 try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from manifest import (
+    diff_manifest,
+    load_index_info,
+    load_manifest,
+    load_shards,
+    save_index_info,
+    save_manifest,
+    save_shards,
+    scan_documents,
+    shard_name,
+    shard_of,
+)
+
+# faiss, numpy, tiktoken and LangChain (which loads torch) are imported by the functions that use them, so --help,
+# --check and the parsing and chunking workers start without them
+if TYPE_CHECKING:
+    import faiss
+    import numpy as np
     import tiktoken
-    from langchain_community.embeddings import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import FAISS
-except ImportError:
-    raise ImportError("Please install the dependencies first.")
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+INDEX_FILE = "index.faiss"
+
+DEFAULT_EMBEDDING_OPTIONS = {
+    # huggingface: sentence-transformers on torch, onnx: ONNX Runtime, hash: hashed words, see embedding_backends.py
+    "embedding_backend": "huggingface",
+    # the model of the backend, None for its default, all-MiniLM-L6-v2 for huggingface and onnx
+    "embedding_model": None,
+    # the number of threads embedding a batch, None for the default of the backend
+    "threads": None,
+}
+# the embedding options recorded in index_info.json, the retriever embeds queries with them
+EMBEDDING_INFO = ("embedding_backend", "embedding_model")
+# the metadata of a chunk dropped as a near duplicate kept in the "duplicates" metadata of the chunk kept in its place
+ALIAS_FIELDS = ("source", "page", "page_end", "row", "row_end")
+
+
+def _line_token_sizes(
+    lines: List[str],
+    encoding: tiktoken.Encoding,
+) -> List[int]:
+    """
+    Get the number of tokens of each line, each distinct line is encoded once
+    :param lines: the lines to encode
+    :param encoding: the encoding to encode the lines
+    """
+    # identical lines (blank lines, repeated headers) are encoded only once. tiktoken's encode_batch is not used: its
+    # thread pool costs more than it saves on lines of a few dozen tokens, about 3x slower than this loop
+    line_sizes = {line: len(encoding.encode(line)) for line in dict.fromkeys(lines)}
+    return [line_sizes[line] for line in lines]
+
+
+def _line_token_offsets(
+    lines: List[str],
+    encoding: tiktoken.Encoding,
+) -> array:
+    """
+    Get the cumulative token offsets of the lines of a document
+    :param lines: the lines of the document
+    :param encoding: the encoding to encode the lines
+    :return: an array of len(lines) + 1 offsets, offsets[i] is the number of tokens before line i
+    """
+    offsets = array("q", [0])
+    offsets.extend(accumulate(_line_token_sizes(lines, encoding)))
+    return offsets
 
 
 def chunk_str_overlap(
@@ -35,47 +112,75 @@ def chunk_str_overlap(
     )
 
     lines = s.split(separator)
-    chunks = dict()
+    offsets = _line_token_offsets(lines, encoding)
+    num_lines = len(lines)
     final_chunks = []
 
-    if len(lines) == 0:
-        return []
-
-    first_line = lines[0]
-    first_line_size = len(encoding.encode(first_line))
+    # A chunk starts at a line and takes the following lines until the next one would overflow num_tokens.
+    # A new chunk starts at the first line that would overflow step_tokens counted from the previous start.
+    start = 0
+    while True:
+        end = bisect_right(offsets, offsets[start] + num_tokens, start + 2) - 1
+        if end >= num_lines:
+            # every later chunk would also run to the end of the document, keep only the largest one
+            if offsets[num_lines] > offsets[start]:
+                final_chunks.append(separator.join(lines[start:]))
+            break
+        final_chunks.append(separator.join(lines[start:end]))
+        start = bisect_right(offsets, offsets[start] + step_tokens, start + 2) - 1
 
-    chunks[0] = [first_line, first_line_size]
-
-    this_step_size = first_line_size
+    return final_chunks
 
-    for i in range(1, len(lines)):
-        line = lines[i]
-        line_size = len(encoding.encode(line))
 
-        to_pop = []
-        for key in chunks:
-            if chunks[key][1] + line_size > num_tokens:
-                to_pop.append(key)
-            else:
-                chunks[key][0] += f"{separator}{line}"
-                chunks[key][1] += line_size
-        final_chunks += [chunks.pop(key)[0] for key in to_pop]
+def iter_chunks_overlap(
+    units: Iterable[Tuple[str, int]],
+    separator: chr = "\n",
+    num_tokens: int = 64,
+    step_tokens: int = 64,
+) -> Iterator[Tuple[str, int, int]]:
+    """
+    Streaming counterpart of chunk_str_overlap, chunks a stream of lines with the same boundaries while only
+    keeping the lines of the chunks still open in memory
+    :param units: the lines to chunk with their number of tokens
+    :param separator: the separator to join the lines of a chunk
+    :param num_tokens: the number of tokens in each chunk
+    :param step_tokens: the number of tokens to step forward
+    :return: the chunk, the index of its first line and the index after its last line
+    """
+    assert step_tokens <= num_tokens, (
+        f"The number of tokens {num_tokens} in each chunk " f"should be larger than the step size {step_tokens}."
+    )
 
-        if this_step_size + line_size > step_tokens:
-            chunks[i] = [line, line_size]
-            this_step_size = 0
+    # lines from the first open chunk on, buffer[0] is line number base
+    buffer = deque()
+    base = 0
+    # start line and tokens before it of each open chunk, oldest first
+    open_chunks = deque()
+    total = 0
+    this_step_size = 0
+    i = -1
+    for i, (line, line_size) in enumerate(units):
+        if i == 0:
+            open_chunks.append((0, 0))
+        else:
+            # the oldest chunks are the largest ones, so the chunks to close are at the front
+            while open_chunks and total + line_size - open_chunks[0][1] > num_tokens:
+                start, _ = open_chunks.popleft()
+                yield separator.join(islice(buffer, start - base, i - base)), start, i
+            if this_step_size + line_size > step_tokens:
+                open_chunks.append((i, total))
+                this_step_size = 0
         this_step_size += line_size
+        total += line_size
+        buffer.append(line)
+        while base < open_chunks[0][0]:
+            buffer.popleft()
+            base += 1
 
-    max_remained_chunk = ""
-    max_remained_chunk_size = 0
-    for key in chunks:
-        if chunks[key][1] > max_remained_chunk_size:
-            max_remained_chunk_size = chunks[key][1]
-            max_remained_chunk = chunks[key][0]
-    if max_remained_chunk_size > 0:
-        final_chunks.append(max_remained_chunk)
-
-    return final_chunks
+    # every open chunk runs to the end of the stream, keep only the largest one
+    if open_chunks and total > open_chunks[0][1]:
+        start = open_chunks[0][0]
+        yield separator.join(islice(buffer, start - base, None)), start, i + 1
 
 
 def get_title(
@@ -114,26 +219,19 @@ def extract_text_from_file(
         extracted_text = " ".join([page.extract_text() for page in reader.pages])
         title = extracted_text.split("\n")[0]
     elif file_type == "docx":
-        try:
-            import docx2txt
-        except ImportError:
-            raise ImportError("Please install docx2txt first.")
-        # Extract text from docx using docx2txt
-        extracted_text = docx2txt.process(file)
+        # the same extraction as the page by page path of the indexer
+        extracted_text = "".join(text for _, text in _iter_docx_pages(file))
         title = extracted_text.split("\n")[0]
     elif file_type == "csv":
         # Extract text from csv using csv module
-        extracted_text = ""
         title = ""
-        reader = csv.reader(file)
-        for row in reader:
-            extracted_text += " ".join(row) + "\n"
+        extracted_text = "".join(record + "\n" for record in iter_records(file, file_type))
     elif file_type == "pptx":
         try:
             import pptx
         except ImportError:
             raise ImportError("Please install python-pptx first.")
-        extracted_text = ""
+        parts = []
         no_title = True
         title = ""
         presentation = pptx.Presentation(file)
@@ -142,11 +240,12 @@ def extract_text_from_file(
                 if shape.has_text_frame:
                     for paragraph in shape.text_frame.paragraphs:
                         for run in paragraph.runs:
-                            extracted_text += run.text + " "
+                            parts.append(run.text + " ")
                             if no_title and len(run.text) > 10:
                                 title = run.text
                                 no_title = False
-                    extracted_text += "\n"
+                    parts.append("\n")
+        extracted_text = "".join(parts)
     else:
         # Unsupported file type
         raise ValueError(f"Unsupported file type: {file_type}")
@@ -154,6 +253,179 @@ def extract_text_from_file(
     return title[:100], extracted_text
 
 
+PAGED_EXTENSIONS = ("pdf", "pptx", "docx")
+
+_WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _iter_docx_pages(file: str) -> Iterator[Tuple[int, str]]:
+    """
+    Stream the main text of a docx file page by page. Word stores the page breaks it rendered last time the file
+    was saved and the explicit ones, the text between two breaks is yielded as a page.
+    """
+    page = 1
+    parts = []
+    body = None
+    with zipfile.ZipFile(file) as archive, archive.open("word/document.xml") as f:
+        for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if tag == f"{_WORD_NAMESPACE}body":
+                    body = elem
+                is_break = tag == f"{_WORD_NAMESPACE}lastRenderedPageBreak" or (
+                    tag == f"{_WORD_NAMESPACE}br" and elem.get(f"{_WORD_NAMESPACE}type") == "page"
+                )
+                # an explicit break is usually followed by a rendered one, only count breaks after some text
+                if is_break and "".join(parts).strip():
+                    yield page, "".join(parts)
+                    page += 1
+                    parts = []
+                continue
+            # same layout as docx2txt: tabs, line breaks and a blank line after each paragraph
+            if tag == f"{_WORD_NAMESPACE}t":
+                parts.append(elem.text or "")
+            elif tag == f"{_WORD_NAMESPACE}tab":
+                parts.append("\t")
+            elif tag in (f"{_WORD_NAMESPACE}br", f"{_WORD_NAMESPACE}cr"):
+                if elem.get(f"{_WORD_NAMESPACE}type") != "page":
+                    parts.append("\n")
+            elif tag == f"{_WORD_NAMESPACE}p":
+                parts.append("\n\n")
+                elem.clear()
+            # detach the finished paragraphs and tables, the tree must not grow with the document
+            if body is not None and len(body) and body[0] is elem:
+                del body[0]
+    yield page, "".join(parts)
+
+
+def iter_pages(
+    file: str,
+    file_type: Literal["pdf", "docx", "pptx"],
+) -> Iterator[Tuple[int, str]]:
+    """
+    Extract text from a pdf, docx or pptx file one page at a time, so only one page is held in memory
+    :param file: the file path
+    :param file_type: the extension of the file
+    :return: the page number, starting at 1, and the text of each page (of each slide for pptx)
+    """
+    if file_type == "pdf":
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise ImportError("Please install pypdf first.")
+        reader = PdfReader(file)
+        for i, page in enumerate(reader.pages):
+            yield i + 1, page.extract_text()
+    elif file_type == "docx":
+        yield from _iter_docx_pages(file)
+    elif file_type == "pptx":
+        try:
+            import pptx
+        except ImportError:
+            raise ImportError("Please install python-pptx first.")
+        presentation = pptx.Presentation(file)
+        for i, slide in enumerate(presentation.slides):
+            parts = []
+            for shape in slide.shapes:
+                if shape.has_text_frame:
+                    for paragraph in shape.text_frame.paragraphs:
+                        for run in paragraph.runs:
+                            parts.append(run.text + " ")
+                    parts.append("\n")
+            yield i + 1, "".join(parts)
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def chunk_pages(
+    pages: Iterable[Tuple[int, str]],
+    num_tokens: int = 64,
+    step_tokens: int = 64,
+    encoding: tiktoken.Encoding = None,
+) -> Iterator[Tuple[str, Dict[str, int]]]:
+    """
+    Split a stream of pages into chunks with overlap, chunks may span pages
+    :param pages: the page number and text of each page
+    :param num_tokens: the number of tokens in each chunk
+    :param step_tokens: the number of tokens to step forward
+    :param encoding: the encoding to encode the pages
+    :return: each chunk with the first and last page it comes from
+    """
+    # index of the first line of each page and the page numbers
+    page_first_lines = []
+    page_numbers = []
+
+    def iter_lines():
+        num_lines = 0
+        for page, text in pages:
+            text = clean_text(text).strip()
+            if not text:
+                continue
+            lines = text.split("\n")
+            page_first_lines.append(num_lines)
+            page_numbers.append(page)
+            num_lines += len(lines)
+            yield from zip(lines, _line_token_sizes(lines, encoding))
+
+    for chunk, start, end in iter_chunks_overlap(iter_lines(), "\n", num_tokens, step_tokens):
+        yield chunk, {
+            "page": page_numbers[bisect_right(page_first_lines, start) - 1],
+            "page_end": page_numbers[bisect_right(page_first_lines, end - 1) - 1],
+        }
+
+
+RECORD_EXTENSIONS = ("csv", "jsonl")
+
+
+def iter_records(
+    file: str,
+    file_type: Literal["csv", "jsonl"],
+) -> Iterator[str]:
+    """
+    Read a csv or jsonl file lazily, one string per csv row or jsonl line. Blank and invalid jsonl lines give an
+    empty string, so the n-th string is always the n-th record of the file.
+    :param file: the file path
+    :param file_type: the extension of the file
+    """
+    if file_type not in RECORD_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    with open(file, "r", encoding="utf-8-sig", errors="ignore", newline="") as f:
+        if file_type == "csv":
+            for row in csv.reader(f):
+                yield " ".join(row)
+        else:
+            for line in f:
+                try:
+                    yield json.dumps(json.loads(line)) if line.strip() else ""
+                except json.JSONDecodeError:
+                    yield ""
+
+
+def chunk_records(
+    records: Iterable[str],
+    num_tokens: int = 64,
+    step_tokens: int = 64,
+    encoding: tiktoken.Encoding = None,
+    batch_size: int = 1024,
+) -> Iterator[Tuple[str, Dict[str, int]]]:
+    """
+    Group a stream of records into chunks with overlap, a record is never split across chunks
+    :param records: the records, one string each
+    :param num_tokens: the number of tokens in each chunk
+    :param step_tokens: the number of tokens to step forward
+    :param encoding: the encoding to encode the records
+    :param batch_size: the number of records encoded at a time
+    :return: each chunk with its first and last record number, starting at 1
+    """
+
+    def iter_units():
+        for batch in batched(records, batch_size):
+            yield from zip(batch, _line_token_sizes(batch, encoding))
+
+    for chunk, start, end in iter_chunks_overlap(iter_units(), "\n", num_tokens, step_tokens):
+        yield chunk, {"row": start + 1, "row_end": end}
+
+
 def text_parser(
     read_file: str,
 ) -> Tuple[str, str]:
@@ -185,10 +457,14 @@ def text_parser(
         title = next(soup.stripped_strings)[:100]
         text = soup.get_text("\n")
     # read json/jsonl file in and convert each json to a row of string
-    elif extension in ("json", "jsonl"):
+    elif extension == "jsonl":
+        # one json per line, lines that are not valid json are skipped
+        text = "\n".join(record for record in iter_records(read_file, extension) if record)
+        title = filename
+    elif extension == "json":
         try:
             with open(read_file, "r", encoding=default_encoding, errors="ignore") as f:
-                data = json.load(f) if extension == "json" else [json.loads(line) for line in f]
+                data = json.load(f)
         except:
             # json file encoding issue, skip this file
             return title, ""
@@ -208,69 +484,1301 @@ def text_parser(
         )
         return title, ""
 
+    return title, clean_text(text)
+
+
+def clean_text(text: str) -> str:
+    """
+    Collapse runs of blank lines and of markdown rule characters
+    :param text: the parsed text
+    """
     output_text = re.sub(r"\n{3,}", "\n\n", text)
     # keep whitespaces for formatting
     output_text = re.sub(r"-{3,}", "---", output_text)
     output_text = re.sub(r"\*{3,}", "***", output_text)
     output_text = re.sub(r"_{3,}", "___", output_text)
+    return output_text
 
-    return title, output_text
 
+_encoding = None
 
-def chunk_document(
+
+def _get_encoding() -> tiktoken.Encoding:
+    """
+    Get the encoding used to count tokens, loaded once per process
+    """
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+
+        _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return _encoding
+
+
+def parse_and_chunk(
+    file: str,
+    chunk_size: int,
+    chunk_step: int,
+) -> Tuple[bool, str, Iterable[Tuple[str, Dict]], str]:
+    """
+    Parse a single file and split its content into chunks, errors are returned instead of raised so that
+    one bad file does not stop the other files in a worker pool. Pdf, docx and pptx files are read page by page
+    and their chunks carry the pages they come from, csv and jsonl files are read record by record and their
+    chunks carry the rows they come from. The chunks of both are spilled to a temporary file as they are made, see
+    spill_chunks, as are those of other files longer than SPILL_CHARS, whose text is read whole. Every chunk
+    carries its number of tokens.
+    :param file: the file path
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :return: whether the file was parsed, the title, the chunks with their extra metadata, a list or the
+        SpilledChunks of a spilled file, and the error message if any
+    """
+    parsed = False
+    title = ""
+    try:
+        extension = os.path.splitext(file)[1].lstrip(".")
+        if extension in PAGED_EXTENSIONS:
+            pages = iter_pages(file, extension)
+            first_page = next(((page, text) for page, text in pages if text.strip()), None)
+            parsed = True
+            if first_page is None:
+                return parsed, title, [], ""
+            title = _page_title(first_page[1], extension)
+            chunks = chunk_pages(chain([first_page], pages), chunk_size, chunk_step, encoding=_get_encoding())
+            return parsed, title, spill_chunks(_with_token_counts(chunks)), ""
+        if extension in RECORD_EXTENSIONS:
+            records = iter_records(file, extension)
+            parsed = True
+            title = os.path.splitext(file)[0]
+            chunks = chunk_records(records, chunk_size, chunk_step, encoding=_get_encoding())
+            return parsed, title, spill_chunks(_with_token_counts(chunks)), ""
+
+        title, content = text_parser(file)
+        parsed = True
+        if len(content) == 0:
+            return parsed, title, [], ""
+
+        chunks = chunk_str_overlap(
+            content.strip(),
+            num_tokens=chunk_size,
+            step_tokens=chunk_step,
+            separator="\n",
+            encoding=_get_encoding(),
+        )
+        chunks = _with_token_counts((chunk, {}) for chunk in chunks)
+        return parsed, title, spill_chunks(chunks) if len(content) > SPILL_CHARS else list(chunks), ""
+    except Exception as e:
+        return parsed, title, [], f"{traceback.format_exc()} {e}"
+
+
+def _with_token_counts(
+    chunks: Iterable[Tuple[str, Dict]],
+) -> Iterator[Tuple[str, Dict]]:
+    """
+    Add the number of tokens of each chunk to its metadata as it passes, so the retriever can expand hits without
+    encoding them
+    :param chunks: the chunks with their extra metadata
+    """
+    encoding = _get_encoding()
+    for chunk, extra_metadata in chunks:
+        yield chunk, {**extra_metadata, "tokens": len(encoding.encode(chunk))}
+
+
+# text files longer than this many characters have their chunks spilled like paged and record files
+SPILL_CHARS = 1 << 20
+
+
+class SpilledChunks:
+    def __init__(self, path: str):
+        """
+        The chunks of a file written to a temporary file by spill_chunks, so they are neither held in memory nor
+        pickled whole from a worker process. They are read back one at a time, and the file is deleted once they
+        are read.
+        :param path: the path of the temporary file
+        """
+        self.path = path
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict]]:
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    chunk, extra_metadata = json.loads(line)
+                    yield chunk, extra_metadata
+        finally:
+            os.remove(self.path)
+
+
+def spill_chunks(chunks: Iterable[Tuple[str, Dict]]) -> SpilledChunks:
+    """
+    Write chunks to a temporary file as they are produced, the file is complete once this returns, so a file
+    failing halfway gives no chunks at all
+    :param chunks: the chunks with their extra metadata
+    """
+    fd, path = tempfile.mkstemp(prefix="chunks-", suffix=".jsonl")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk, extra_metadata in chunks:
+                f.write((json.dumps([chunk, extra_metadata], ensure_ascii=False) + "\n").encode("utf-8"))
+    except BaseException:
+        os.remove(path)
+        raise
+    return SpilledChunks(path)
+
+
+def _page_title(
+    text: str,
+    file_type: str,
+) -> str:
+    """
+    Get the title of a paged document from its first page, the first line or, for pptx, the first line longer
+    than 10 characters
+    """
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    if file_type == "pptx":
+        lines = [line for line in lines if len(line) > 10] or lines
+    return lines[0][:100] if lines else ""
+
+
+def iter_files(doc_path: str) -> Iterator[str]:
+    """
+    Yield the paths of all files under a directory in os.walk order
+    :param doc_path: the path of the documents
+    """
+    for root, dirs, files in os.walk(doc_path):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+def shard_files(doc_path: str, shard: Tuple[int, int] = None) -> List[str]:
+    """
+    List the files of a shard
+    :param doc_path: the path of the documents
+    :param shard: the number and count of the shard, None for all files
+    """
+    if shard is None:
+        return list(iter_files(doc_path))
+    number, count = shard
+    return [f for f in iter_files(doc_path) if shard_of(os.path.relpath(f, doc_path), count) == number]
+
+
+def iter_parsed_chunks(
+    files: Iterable[str],
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+) -> Iterator[Tuple[str, bool, str, Iterable[Tuple[str, Dict]], str]]:
+    """
+    Parse and chunk files, in a process pool when workers > 1. Results are yielded in the order of the input
+    files whatever the number of workers, so the output does not depend on scheduling. When a worker process dies,
+    e.g. of a segfault in a parser or out of memory, the files it may have been parsing are reported as failed and
+    the other files are parsed in a new pool.
+    :param files: the file paths
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of worker processes
+    :return: the file path followed by the result of parse_and_chunk
+    """
+    if workers <= 1:
+        for f in files:
+            yield (f,) + parse_and_chunk(f, chunk_size, chunk_step)
+        return
+
+    # keep a bounded number of files in flight so results stream back without queuing the whole corpus
+    max_pending = workers * 4
+    files = iter(files)
+    # a file whose submission found the pool broken, parsed in the next pool
+    unsubmitted = []
+    while True:
+        pending = deque()
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for f in chain(unsubmitted, files):
+                    unsubmitted = [f]
+                    pending.append((f, executor.submit(parse_and_chunk, f, chunk_size, chunk_step)))
+                    unsubmitted = []
+                    if len(pending) >= max_pending:
+                        # left in pending until its result is read, so it is reported if the pool breaks
+                        f, future = pending[0]
+                        result = future.result()
+                        pending.popleft()
+                        yield (f,) + result
+                while pending:
+                    f, future = pending[0]
+                    result = future.result()
+                    pending.popleft()
+                    yield (f,) + result
+            return
+        except BrokenProcessPool as error:
+            # the pool cannot tell which file killed the worker, the files parsed before keep their results
+            failed = sum(future.exception() is not None for _, future in pending)
+            print(f"A worker process died, {failed} files in flight failed, parsing the others in a new pool...")
+            for f, future in pending:
+                if future.exception() is None:
+                    yield (f,) + future.result()
+                else:
+                    yield f, False, "", [], f"The worker process parsing it died: {error}"
+
+
+def iter_file_chunks(
+    files: Iterable[str],
+    doc_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+    failed: List[str] = None,
+) -> Iterator[Tuple[str, str, Iterable[Tuple[str, Dict]]]]:
+    """
+    Yield the source, title and chunks with their extra metadata of every file that could be parsed, errors are
+    reported and skipped
+    :param files: the file paths
+    :param doc_path: the path of the documents, sources are file paths relative to it
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    :param failed: the sources of the files that could not be parsed are appended to it, None to only report them
+    """
+    file_count = 0
+    for f, parsed, title, chunks, error in iter_parsed_chunks(files, chunk_size, chunk_step, workers):
+        print(f"Reading {f}")
+        if parsed:
+            file_count += 1
+            if file_count % 100 == 0:
+                print(f"{file_count} files read.")
+        if error:
+            print(f"Error encountered when reading {f}: {error}")
+            if failed is not None:
+                failed.append(os.path.relpath(f, doc_path))
+            continue
+        yield os.path.relpath(f, doc_path), title, chunks
+
+
+def iter_chunks(
+    files: Iterable[str],
     doc_path: str,
     chunk_size: int,
     chunk_step: int,
+    workers: int = 1,
+    failed: List[str] = None,
+) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Yield the text and metadata of every chunk of the files, one file in memory at a time
+    :param files: the file paths
+    :param doc_path: the path of the documents, sources are file paths relative to it
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    :param failed: the sources of the files that could not be parsed are appended to it, None to only report them
+    """
+    for source, title, chunks in iter_file_chunks(files, doc_path, chunk_size, chunk_step, workers, failed):
+        for i, (chunk, extra_metadata) in enumerate(chunks):
+            # custom metadata if needed
+            metadata = {
+                "source": source,
+                "title": title,
+                "chunk_id": i,
+                **extra_metadata,
+            }
+            yield chunk, metadata
+
+
+def chunk_files(
+    files: Iterable[str],
+    doc_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
 ) -> Tuple[int, List[str], List[Dict[str, str]], Dict[str, int]]:
     """
-    Split documents into chunks
-    :param doc_path: the path of the documents
+    Split files into chunks
+    :param files: the file paths
+    :param doc_path: the path of the documents, sources are file paths relative to it
     :param chunk_size: the size of the chunk
     :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
     """
     texts = []
     metadata_list = []
     file_count = 0
     chunk_id_to_index = dict()
 
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    for source, title, chunks in iter_file_chunks(files, doc_path, chunk_size, chunk_step, workers):
+        file_count += 1
+        for i, (chunk, extra_metadata) in enumerate(chunks):
+            metadata = {
+                "source": source,
+                "title": title,
+                "chunk_id": i,
+                **extra_metadata,
+            }
+            chunk_id_to_index[f"{source}_{i}"] = len(texts)
+            metadata_list.append(metadata)
+            texts.append(chunk)
+    return file_count, texts, metadata_list, chunk_id_to_index
 
+
+def chunk_document(
+    doc_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+) -> Tuple[int, List[str], List[Dict[str, str]], Dict[str, int]]:
+    """
+    Split documents into chunks
+    :param doc_path: the path of the documents
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    """
     # traverse all files under dir
     print("Split documents into chunks...")
-    for root, dirs, files in os.walk(doc_path):
-        for name in files:
-            f = os.path.join(root, name)
-            print(f"Reading {f}")
-            try:
-                title, content = text_parser(f)
-                file_count += 1
-                if file_count % 100 == 0:
-                    print(f"{file_count} files read.")
-
-                if len(content) == 0:
-                    continue
-
-                chunks = chunk_str_overlap(
-                    content.strip(),
-                    num_tokens=chunk_size,
-                    step_tokens=chunk_step,
-                    separator="\n",
-                    encoding=enc,
-                )
-                source = os.path.sep.join(f.split(os.path.sep)[4:])
-                for i in range(len(chunks)):
-                    # custom metadata if needed
-                    metadata = {
-                        "source": source,
-                        "title": title,
-                        "chunk_id": i,
-                    }
-                    chunk_id_to_index[f"{source}_{i}"] = len(texts) + i
-                    metadata_list.append(metadata)
-                texts.extend(chunks)
-            except Exception as e:
-                print(f"Error encountered when reading {f}: {traceback.format_exc()} {e}")
-    return file_count, texts, metadata_list, chunk_id_to_index
+    return chunk_files(iter_files(doc_path), doc_path, chunk_size, chunk_step, workers)
+
+
+def batched(
+    iterable: Iterable,
+    batch_size: int,
+) -> Iterator[List]:
+    """
+    Group the items of an iterable into lists of batch_size items, the last one may be shorter
+    :param iterable: the items
+    :param batch_size: the number of items in each batch
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _chunk_ids(metadata_list: List[Dict[str, str]]) -> List[str]:
+    """
+    Get the ids of chunks, "<source>_<chunk_id>", by which near duplicates are matched to their kept chunk
+    """
+    return [f"{metadata['source']}_{metadata['chunk_id']}" for metadata in metadata_list]
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# the precision of the vectors stored by flat, ivf_flat and hnsw indexes, 4, 2 and 1 bytes per dimension
+STORAGE_TYPES = ("float32", "float16", "int8")
+_STORAGE_FACTORY = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+DEFAULT_INDEX_OPTIONS = {
+    # flat: exact search, ivf_flat / ivf_pq: inverted lists with full or product-quantized vectors, hnsw: graph
+    "index_type": "flat",
+    # float32 keeps the embeddings, float16 and int8 scalar quantization halve or quarter the vector memory
+    "storage": "float32",
+    # the number of inverted lists of ivf indexes
+    "nlist": 1024,
+    # the number of sub-quantizers of ivf_pq, must divide the embedding dimension
+    "pq_m": 48,
+    # the number of graph neighbors per vector of hnsw
+    "hnsw_m": 32,
+    # the number of vectors embedded before training ivf indexes, the sample they are trained on
+    "train_size": 50000,
+    # default search parameters, stored with the index and overridable per query by the retriever
+    "nprobe": 16,
+    "ef_search": 64,
+}
+
+
+# 8-bit product quantizers need at least 256 training vectors, ivf_pq indexes of fewer chunks are flat
+PQ_MIN_TRAIN = 256
+
+
+def create_faiss_index(
+    sample: np.ndarray,
+    index_options: Dict,
+) -> faiss.Index:
+    """
+    Create a faiss index of the given type and train it on a sample of the vectors when it needs training
+    :param sample: the vectors to train on, also used to get the dimension
+    :param index_options: the index type and its build parameters, see DEFAULT_INDEX_OPTIONS
+    """
+    import faiss
+
+    dim = sample.shape[1]
+    index_type = index_options["index_type"]
+    storage = index_options["storage"]
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}. The supported types are {INDEX_TYPES}")
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unsupported storage: {storage}. The supported storages are {STORAGE_TYPES}")
+    if index_type == "ivf_pq" and storage != "float32":
+        raise ValueError("ivf_pq indexes store product-quantized vectors, the storage only applies to other types.")
+    if index_type == "ivf_pq" and len(sample) < PQ_MIN_TRAIN:
+        print(f"Only {len(sample)} chunks, too few to train an ivf_pq index, using a flat index.")
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim) if storage == "float32" else faiss.index_factory(dim, _STORAGE_FACTORY[storage])
+    elif index_type == "hnsw":
+        index = faiss.index_factory(dim, f"HNSW{index_options['hnsw_m']},{_STORAGE_FACTORY[storage]}")
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dim, f"IVF{min(index_options['nlist'], len(sample))},{_STORAGE_FACTORY[storage]}")
+    else:
+        if dim % index_options["pq_m"]:
+            raise ValueError(f"pq_m {index_options['pq_m']} must divide the embedding dimension {dim}.")
+        index = faiss.index_factory(dim, f"IVF{min(index_options['nlist'], len(sample))},PQ{index_options['pq_m']}")
+    if not index.is_trained:
+        # inverted lists learn their centroids, int8 scalar quantizers the value range of each dimension
+        lists = f" with {index.nlist} lists" if isinstance(index, faiss.IndexIVF) else ""
+        print(f"Training {index_type} {storage} index{lists} on {len(sample)} vectors...")
+        index.train(sample)
+    return index
+
+
+def describe_index(
+    index: faiss.Index,
+    index_options: Dict,
+) -> Dict:
+    """
+    Describe a faiss index for index_info.json: its type and default search parameters
+    :param index: the faiss index
+    :param index_options: the options the index was built with
+    """
+    import faiss
+
+    if isinstance(index, faiss.IndexIVFPQ):
+        return {"index_type": "ivf_pq", "nlist": index.nlist, "nprobe": index_options["nprobe"]}
+    if isinstance(index, faiss.IndexIVF):
+        info = {"index_type": "ivf_flat", "nlist": index.nlist, "nprobe": index_options["nprobe"]}
+    elif isinstance(index, faiss.IndexHNSW):
+        info = {"index_type": "hnsw", "ef_search": index_options["ef_search"]}
+    else:
+        info = {"index_type": "flat"}
+        if index_options["index_type"] == "ivf_pq":
+            # too few chunks to train, kept by incremental updates while that holds, see update_index
+            info["requested_type"] = "ivf_pq"
+    return {**info, "storage": index_storage(index)}
+
+
+def index_storage(
+    index: faiss.Index,
+) -> str:
+    """
+    Get the precision of the vectors stored by a flat, ivf_flat or hnsw index, see STORAGE_TYPES
+    :param index: the faiss index
+    """
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if not hasattr(index, "sq"):
+        return "float32"
+    return {faiss.ScalarQuantizer.QT_fp16: "float16", faiss.ScalarQuantizer.QT_8bit: "int8"}[index.sq.qtype]
+
+
+def _needs_training(index_options: Dict) -> bool:
+    return index_options["index_type"] in ("ivf_flat", "ivf_pq") or index_options["storage"] == "int8"
+
+
+class ChunkSpool:
+    def __init__(self, folder: str):
+        """
+        The text and metadata of embedded chunks, appended batch by batch to an anonymous temporary file in the index
+        folder and read back in order when the chunk store is written, so they are not held in memory
+        :param folder: the index folder
+        """
+        self.folder = folder
+        self.file = tempfile.TemporaryFile(dir=folder)
+        self.count = 0
+
+    def __enter__(self) -> "ChunkSpool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, texts: List[str], metadata_list: List[Dict]):
+        """
+        Append a batch of chunks
+        :param texts: the texts of the chunks
+        :param metadata_list: their metadata
+        """
+        for text, metadata in zip(texts, metadata_list):
+            record = {"page_content": text, "metadata": metadata}
+            self.file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.count += len(texts)
+
+    def __iter__(self) -> Iterator:
+        from langchain_core.documents import Document
+
+        self.file.seek(0)
+        for line in self.file:
+            record = json.loads(line)
+            yield Document(page_content=record["page_content"], metadata=record["metadata"])
+
+
+def add_chunks(
+    index: faiss.Index,
+    chunks: Iterable[Tuple[str, Dict[str, str]]],
+    embeddings,
+    spool: ChunkSpool,
+    batch_size: int = 256,
+    index_options: Dict = None,
+) -> faiss.Index:
+    """
+    Embed chunks batch by batch, add their vectors to a faiss index and their text and metadata to a spool, only one
+    batch of chunks is held at a time. A new ivf or int8 index is trained on a uniform sample of train_size vectors
+    of all chunks, kept by reservoir sampling while the vectors are spilled to a temporary file in the spool folder,
+    and the vectors are added once it is trained.
+    :param index: the index to add to, None to create one
+    :param chunks: the text and metadata of the chunks
+    :param embeddings: the embedding model
+    :param spool: the spool the chunks are appended to, in index order
+    :param batch_size: the number of chunks embedded at a time
+    :param index_options: the type and parameters of a new index, see DEFAULT_INDEX_OPTIONS
+    :return: the index, None if there were no chunks and no index was given
+    """
+    import numpy as np
+
+    index_options = {**DEFAULT_INDEX_OPTIONS, **(index_options or {})}
+    if index is None and _needs_training(index_options):
+        with tempfile.TemporaryFile(dir=spool.folder) as vectors_file:
+            sampler = ReservoirSample(index_options["train_size"])
+            for batch in batched(chunks, batch_size):
+                texts = [text for text, _ in batch]
+                vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+                spool.add(texts, [metadata for _, metadata in batch])
+                sampler.add(vectors)
+                vectors_file.write(vectors.tobytes())
+            if sampler.sample is None:
+                return None
+            index = create_faiss_index(sampler.sample, index_options)
+            vectors_file.seek(0)
+            dim = sampler.sample.shape[1]
+            while True:
+                vectors = np.frombuffer(vectors_file.read(4 * dim * 65536), dtype=np.float32)
+                if not len(vectors):
+                    return index
+                index.add(vectors.reshape(-1, dim))
+
+    for batch in batched(chunks, batch_size):
+        texts = [text for text, _ in batch]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        spool.add(texts, [metadata for _, metadata in batch])
+        if index is None:
+            index = create_faiss_index(vectors, index_options)
+        index.add(vectors)
+    return index
+
+
+class ReservoirSample:
+    def __init__(self, size: int, seed: int = 0):
+        """
+        A uniform sample of at most size rows of the vectors added batch by batch, in the order they were added as
+        long as there are no more than size of them
+        :param size: the number of rows kept
+        :param seed: the seed of the random choices, the same vectors give the same sample
+        """
+        import numpy as np
+
+        self.size = size
+        self.seen = 0
+        self.rows = None
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def sample(self) -> np.ndarray:
+        """
+        The kept rows, None if no vectors were added
+        """
+        return None if self.rows is None else self.rows[: min(self.seen, self.size)]
+
+    def add(self, vectors: np.ndarray):
+        """
+        Add a batch of vectors, each replaces a random kept row with the probability of keeping it
+        :param vectors: the vectors
+        """
+        import numpy as np
+
+        if self.rows is None:
+            # the pages of the rows are only allocated as they are filled
+            self.rows = np.empty((self.size, vectors.shape[1]), dtype=vectors.dtype)
+        free = max(0, min(self.size - self.seen, len(vectors)))
+        self.rows[self.seen : self.seen + free] = vectors[:free]
+        rest = vectors[free:]
+        if len(rest):
+            # the i-th vector seen is kept with probability size / i, in place of a random kept one
+            slots = self.rng.integers(0, self.seen + free + np.arange(1, len(rest) + 1))
+            kept = slots < self.size
+            self.rows[slots[kept]] = rest[kept]
+        self.seen += len(vectors)
+
+
+def _count_chunks(
+    chunks: Iterable[Tuple[str, Dict[str, str]]],
+    counts: Dict[str, int],
+) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Pass chunks through while counting the chunks of each source
+    """
+    for text, metadata in chunks:
+        counts[metadata["source"]] = counts.get(metadata["source"], 0) + 1
+        yield text, metadata
+
+
+def dedupe_chunks(
+    chunks: Iterable[Tuple[str, Dict[str, str]]],
+    near_duplicates,
+    aliases: Dict[str, List[Dict]],
+) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Pass chunks through but the near duplicates of earlier chunks, which are neither embedded nor indexed. Where a
+    dropped chunk occurs is added to aliases under the id of the chunk kept in its place. The kept chunks of a
+    file are numbered without gaps, so the expansion windows of the retriever skip the dropped boilerplate.
+    :param chunks: the text and metadata of the chunks
+    :param near_duplicates: the kept chunks by chunk id, see near_duplicates.NearDuplicates
+    :param aliases: the places of the dropped chunks by id of the kept chunk, filled in as chunks pass
+    """
+    chunk_ids = dict()
+    dropped = 0
+    for text, metadata in chunks:
+        metadata = {**metadata, "chunk_id": chunk_ids.get(metadata["source"], 0)}
+        original = near_duplicates.check(_chunk_ids([metadata])[0], text)
+        if original is not None:
+            aliases.setdefault(original, []).append({key: metadata[key] for key in ALIAS_FIELDS if key in metadata})
+            dropped += 1
+            continue
+        chunk_ids[metadata["source"]] = metadata["chunk_id"] + 1
+        yield text, metadata
+    if dropped:
+        print(f"Skipped {dropped} near-duplicate chunks.")
+
+
+def _with_aliases(
+    documents: Iterable,
+    aliases: Dict[str, List[Dict]],
+    reindexed: Iterable[str] = (),
+) -> Iterator:
+    """
+    Pass chunks through with the places of the near duplicates dropped in their favor added to their "duplicates"
+    metadata, and the places in re-indexed files removed from it
+    :param documents: the chunks
+    :param aliases: the places of the dropped chunks by id of the kept chunk, see dedupe_chunks
+    :param reindexed: the changed and deleted files, whose chunks are dropped again or go away
+    """
+    from langchain_core.documents import Document
+
+    reindexed = set(reindexed)
+    for document in documents:
+        duplicates = document.metadata.get("duplicates", [])
+        kept = [alias for alias in duplicates if alias["source"] not in reindexed]
+        kept += aliases.get(_chunk_ids([document.metadata])[0], [])
+        if kept != duplicates:
+            metadata = {key: value for key, value in document.metadata.items() if key != "duplicates"}
+            metadata = {**metadata, "duplicates": kept} if kept else metadata
+            document = Document(page_content=document.page_content, metadata=metadata)
+        yield document
+
+
+def _alias_sources(chunk_store, stale: Iterable[str], sources: Iterable[str]) -> List[str]:
+    """
+    Get the files with chunks dropped as near duplicates of chunks of the stale files, which go away, and so on for
+    the chunks of those files
+    :param chunk_store: the chunks of the index
+    :param stale: the changed and deleted files
+    :param sources: the files that still exist
+    :return: the files to index again, apart from the stale files
+    """
+    # the files with chunks dropped in favor of each file, one pass over the chunks
+    aliased_by = dict()
+    for document in chunk_store:
+        for alias in document.metadata.get("duplicates", ()):
+            aliased_by.setdefault(document.metadata["source"], set()).add(alias["source"])
+    stale, sources, found = set(stale), set(sources), []
+    while True:
+        aliased = {alias for source in stale for alias in aliased_by.get(source, ())}
+        more = sorted(source for source in aliased - stale if source in sources)
+        if not more:
+            return found
+        stale.update(more)
+        found += more
+
+
+def load_embedding_model(model_name: str = EMBEDDING_MODEL, backend: str = "huggingface", threads: int = None):
+    """
+    Load the embedding model, the only place the indexer imports it
+    :param model_name: the model name
+    :param backend: the embedding backend, see embedding_backends.BACKENDS
+    :param threads: the number of threads embedding a batch, None for the default of the backend
+    """
+    from embedding_backends import create_backend
+
+    return create_backend(backend, model_name, threads)
+
+
+def get_embeddings(embedding_cache: str = None, embedding_options: Dict = None):
+    """
+    Get the embedding model, looked up in an on-disk embedding cache first when a cache folder is given
+    :param embedding_cache: the embedding cache folder
+    :param embedding_options: the embedding backend, model and threads, see DEFAULT_EMBEDDING_OPTIONS
+    """
+    from embedding_backends import cache_model_name
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+    embedding_options = _embedding_options(embedding_options)
+    backend, model_name = embedding_options["embedding_backend"], embedding_options["embedding_model"]
+    embeddings = load_embedding_model(model_name, backend, embedding_options["threads"])
+    if embedding_cache:
+        cache = EmbeddingCache(embedding_cache)
+        embeddings = CachedEmbeddings(embeddings, cache_model_name(backend, model_name), cache)
+    return embeddings
+
+
+def _embedding_options(embedding_options: Dict = None) -> Dict:
+    from embedding_backends import describe_embeddings
+
+    embedding_options = {**DEFAULT_EMBEDDING_OPTIONS, **(embedding_options or {})}
+    # the model defaults to the one of the backend
+    return {
+        **embedding_options,
+        **describe_embeddings(embedding_options["embedding_backend"], embedding_options["embedding_model"]),
+    }
+
+
+def _report_cache(embeddings):
+    from embedding_cache import CachedEmbeddings
+
+    if isinstance(embeddings, CachedEmbeddings):
+        print(f"Embedding cache: {embeddings.hits} chunks reused, {embeddings.misses} chunks embedded.")
+
+
+def peak_rss_mb(workers: bool = False) -> float:
+    """
+    Get the peak resident set size of this process in MB, 0 where the resource module is not available. Files are
+    parsed in worker processes with --workers, so the memory of parsing the largest file only shows in theirs.
+    :param workers: get the largest peak of the finished worker processes instead, 0 if there were none
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if workers else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _write_index(
+    index: faiss.Index,
+    documents: Iterable,
+    manifest: Dict,
+    output_path: str,
+    index_options: Dict,
+    embedding_options: Dict,
+):
+    """
+    Write an index folder in one pass over its chunks: each chunk is appended to the chunk store and the keyword,
+    neighbor and filter indexes as it streams through, so only a few bytes per chunk and one entry per source are held
+    :param index: the faiss index of the chunks
+    :param documents: the chunks in index order
+    :param manifest: the manifest of the indexed files
+    :param output_path: the index folder
+    :param index_options: the type and search parameters of the index, see DEFAULT_INDEX_OPTIONS
+    :param embedding_options: the embedding backend and model, see DEFAULT_EMBEDDING_OPTIONS
+    """
+    import faiss
+    from bm25_index import BM25Writer
+    from chunk_store import ChunkStore
+    from metadata_filter import MetadataFilters
+    from neighbor_index import NeighborIndexBuilder
+
+    # the default search parameters are also set on the index itself for readers going through faiss directly
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = index_options["nprobe"]
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = index_options["ef_search"]
+    os.makedirs(output_path, exist_ok=True)
+    # retrievers memory-map index.faiss, so it is replaced rather than overwritten in place
+    index_path = os.path.join(output_path, INDEX_FILE)
+    faiss.write_index(index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+
+    keywords = BM25Writer(output_path)
+    # positions shift when vectors are deleted, so the neighbor index is always rebuilt from the chunks
+    neighbors = NeighborIndexBuilder()
+    # the filters only read the metadata of the first chunk of each source
+    first_chunks = []
+
+    def written():
+        for document in documents:
+            keywords.add(document.page_content)
+            neighbors.add(document.metadata)
+            if document.metadata["chunk_id"] == 0:
+                first_chunks.append(document.metadata)
+            yield document
+
+    ChunkStore.write(output_path, written())
+    keywords.close()
+    neighbors = neighbors.build()
+    neighbors.save(output_path)
+    MetadataFilters.from_metadata(neighbors, first_chunks).save(output_path)
+    # index_info.json is written last: retrievers reload the index when its version changes
+    index_info = describe_index(index, index_options)
+    index_info.update({key: embedding_options[key] for key in EMBEDDING_INFO}, version=uuid.uuid4().hex)
+    save_index_info(output_path, index_info)
+    save_manifest(output_path, manifest)
+    print(f"Saved index to {output_path}")
+
+
+def build_index(
+    doc_path: str,
+    output_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+    embedding_cache: str = None,
+    batch_size: int = 256,
+    index_options: Dict = None,
+    embedding_options: Dict = None,
+    shard: Tuple[int, int] = None,
+    dedup_threshold: float = None,
+):
+    """
+    Index all documents from scratch
+    :param doc_path: the path of the documents
+    :param output_path: the path of the output
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    :param embedding_cache: the embedding cache folder, None to embed every chunk
+    :param batch_size: the number of chunks embedded at a time
+    :param index_options: the type and parameters of the faiss index, see DEFAULT_INDEX_OPTIONS
+    :param embedding_options: the embedding backend, model and threads, see DEFAULT_EMBEDDING_OPTIONS
+    :param shard: the number and count of the shard to index, only the files whose source hashes to it, see
+        build_shards
+    :param dedup_threshold: the estimated Jaccard similarity of the words above which a chunk is a near duplicate of
+        an earlier chunk and dropped, see dedupe_chunks, None to index every chunk
+    """
+    index_options = {**DEFAULT_INDEX_OPTIONS, **(index_options or {})}
+    embedding_options = _embedding_options(embedding_options)
+    dedup_threshold = dedup_threshold or None
+    files = shard_files(doc_path, shard)
+    entries = scan_documents(doc_path, files)
+    counts = dict()
+    embeddings = get_embeddings(embedding_cache, embedding_options)
+
+    print("Split documents into chunks...")
+    failed = []
+    chunks = iter_chunks(files, doc_path, chunk_size, chunk_step, workers, failed)
+    aliases = dict()
+    if dedup_threshold:
+        from near_duplicates import NearDuplicates
+
+        chunks = dedupe_chunks(chunks, NearDuplicates(dedup_threshold), aliases)
+    os.makedirs(output_path, exist_ok=True)
+    with ChunkSpool(output_path) as spool:
+        index = add_chunks(None, _count_chunks(chunks, counts), embeddings, spool, batch_size, index_options)
+        _report_cache(embeddings)
+        if index is None:
+            print("No chunks to index.")
+            return
+
+        for source in entries:
+            entries[source]["chunks"] = counts.get(source, 0)
+        _mark_failed(entries, failed)
+        manifest = {"chunk_size": chunk_size, "chunk_step": chunk_step, "dedup_threshold": dedup_threshold}
+        manifest["files"] = entries
+        _write_index(index, _with_aliases(spool, aliases), manifest, output_path, index_options, embedding_options)
+
+
+def _mark_failed(entries: Dict[str, Dict], failed: List[str]):
+    # the files that could not be parsed stay in the manifest, marked so update_index parses them again
+    for source in failed:
+        entries[source]["failed"] = True
+
+
+def check_index(
+    doc_path: str,
+    output_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    dedup_threshold: float = None,
+) -> bool:
+    """
+    Report whether the index is up to date with the documents, without loading the embedding model or the index. The
+    shards of a sharded index folder are checked against the files that hash to them, see build_shards.
+    :param doc_path: the path of the documents
+    :param output_path: the path of the output
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param dedup_threshold: the near-duplicate threshold of the index, None if it keeps every chunk
+    :return: whether the index is up to date
+    """
+    shards = load_shards(output_path)
+    if shards is None:
+        folders = {output_path: list(iter_files(doc_path))}
+    else:
+        # a shard without an index that has files needs indexing, a shard whose files are all gone needs removing
+        folders = {os.path.join(output_path, name): [] for name in shards["shards"]}
+        for f in iter_files(doc_path):
+            folder = os.path.join(output_path, shard_name(shard_of(os.path.relpath(f, doc_path), shards["count"])))
+            folders.setdefault(folder, []).append(f)
+
+    added, changed, deleted, failed = set(), set(), set(), set()
+    for folder, files in folders.items():
+        manifest = load_manifest(folder)
+        if (
+            manifest is None
+            or not os.path.exists(os.path.join(folder, INDEX_FILE))
+            or (manifest["chunk_size"], manifest["chunk_step"]) != (chunk_size, chunk_step)
+            or manifest.get("dedup_threshold") != (dedup_threshold or None)
+        ):
+            print(f"No index with a matching manifest found in {folder}, all its documents need indexing.")
+            return False
+        entries = scan_documents(doc_path, files, manifest["files"])
+        diff = diff_manifest(manifest["files"], entries)
+        for sources, shard_sources in zip((added, changed, deleted), diff):
+            sources.update(shard_sources)
+        failed.update(source for source in entries if manifest["files"].get(source, {}).get("failed"))
+    for label, sources in (("New", added), ("Changed", changed), ("Deleted", deleted), ("Failed", failed - changed)):
+        for source in sorted(sources):
+            print(f"{label}: {source}")
+    if failed - changed:
+        # files that keep failing would otherwise never let the index be up to date
+        print(f"{len(failed - changed)} files could not be parsed, --incremental parses them again.")
+    if added or changed or deleted:
+        option = "--incremental" if shards is None else f"--incremental --shards {shards['count']}"
+        print(f"{len(added)} new, {len(changed)} changed, {len(deleted)} deleted files, run with {option}.")
+        return False
+    print("Index is up to date.")
+    return True
+
+
+def update_index(
+    doc_path: str,
+    output_path: str,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+    embedding_cache: str = None,
+    batch_size: int = 256,
+    index_options: Dict = None,
+    embedding_options: Dict = None,
+    shard: Tuple[int, int] = None,
+    dedup_threshold: float = None,
+):
+    """
+    Re-index only the new and changed documents and drop the deleted ones, according to the manifest of the
+    existing index. Falls back to build_index when there is no usable index, when the index type, storage, embedding
+    backend or model or the near-duplicate threshold changed, or when vectors have to be removed from an ivf or hnsw
+    index, which do not support removal by position. New chunks are also checked against the indexed ones for near
+    duplicates, and files with near duplicates of chunks of changed or deleted files are indexed again.
+    :param doc_path: the path of the documents
+    :param output_path: the path of the output
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking files in parallel
+    :param embedding_cache: the embedding cache folder, None to embed every chunk
+    :param batch_size: the number of chunks embedded at a time
+    :param index_options: the type and parameters of the faiss index, see DEFAULT_INDEX_OPTIONS
+    :param embedding_options: the embedding backend, model and threads, see DEFAULT_EMBEDDING_OPTIONS
+    :param shard: the number and count of the shard to index, only the files whose source hashes to it, see
+        build_shards
+    :param dedup_threshold: the estimated Jaccard similarity of the words above which a chunk is a near duplicate of
+        an earlier chunk and dropped, see dedupe_chunks, None to index every chunk
+    """
+    from embedding_backends import index_embeddings
+
+    index_options = {**DEFAULT_INDEX_OPTIONS, **(index_options or {})}
+    embedding_options = _embedding_options(embedding_options)
+    dedup_threshold = dedup_threshold or None
+    manifest = load_manifest(output_path)
+    index_info = load_index_info(output_path)
+    index_type = index_info.get("index_type", "flat")
+    requested_type = index_type
+    if manifest is not None and index_info.get("requested_type"):
+        # a flat index that stands in for an ivf_pq index of too few chunks, until it has enough to train one
+        if sum(entry.get("chunks", 0) for entry in manifest["files"].values()) < PQ_MIN_TRAIN:
+            requested_type = index_info["requested_type"]
+    rebuild_args = (
+        doc_path,
+        output_path,
+        chunk_size,
+        chunk_step,
+        workers,
+        embedding_cache,
+        batch_size,
+        index_options,
+        embedding_options,
+        shard,
+        dedup_threshold,
+    )
+    if (
+        manifest is None
+        or not os.path.exists(os.path.join(output_path, INDEX_FILE))
+        or (manifest["chunk_size"], manifest["chunk_step"]) != (chunk_size, chunk_step)
+        or requested_type != index_options["index_type"]
+        or index_info.get("storage", "float32") != index_options["storage"]
+        or index_embeddings(index_info) != {key: embedding_options[key] for key in EMBEDDING_INFO}
+        or manifest.get("dedup_threshold") != dedup_threshold
+    ):
+        print("No index with a matching manifest, index type, storage and embeddings found, indexing all documents...")
+        return build_index(*rebuild_args)
+
+    previous = manifest["files"]
+    files = shard_files(doc_path, shard)
+    entries = scan_documents(doc_path, files, previous)
+    added, changed, deleted = diff_manifest(previous, entries)
+    # files that could not be parsed are parsed again, a parser may have been installed or fixed since
+    retried = [source for source in entries if previous.get(source, {}).get("failed") and source not in changed]
+    print(
+        f"{len(added)} new, {len(changed)} changed, {len(deleted)} deleted, "
+        f"{len(entries) - len(added) - len(changed)} unchanged files, {len(retried)} of them retried."
+    )
+    for source in entries:
+        entries[source]["chunks"] = previous[source]["chunks"] if source in previous else 0
+    manifest = {"chunk_size": chunk_size, "chunk_step": chunk_step, "dedup_threshold": dedup_threshold}
+    if not added and not changed and not deleted and not retried:
+        save_manifest(output_path, {**manifest, "files": entries})
+        print("Index is up to date.")
+        return
+
+    import faiss
+    import numpy as np
+    from chunk_store import load_chunk_store
+    from neighbor_index import load_neighbor_index
+
+    embeddings = get_embeddings(embedding_cache, embedding_options)
+    chunk_store = load_chunk_store(output_path)
+    if dedup_threshold:
+        # the near duplicates dropped in favor of chunks of changed or deleted files lose their kept chunk
+        aliased = _alias_sources(chunk_store, changed + deleted, [source for source in entries if source in previous])
+        if aliased:
+            print(f"Indexing {len(aliased)} unchanged files with near duplicates of changed or deleted files again.")
+        changed = changed + aliased
+    neighbors = load_neighbor_index(output_path)
+    stale = [
+        position
+        for source in changed + deleted
+        for position in (neighbors.position(source, i) for i in range(previous[source]["chunks"]))
+        if position is not None
+    ]
+    if stale and index_type != "flat":
+        print(f"Vectors cannot be removed from a {index_type} index, indexing all documents...")
+        return build_index(*rebuild_args)
+    index = faiss.read_index(os.path.join(output_path, INDEX_FILE))
+    # the chunks kept in place, in index order, read from the old chunk store while the new one is written
+    kept = np.ones(len(chunk_store), dtype=bool)
+    kept[stale] = False
+    if stale:
+        index.remove_ids(faiss.IDSelectorBatch(np.array(stale, dtype=np.int64)))
+
+    to_index = set(added + changed + retried)
+    counts = dict()
+    failed = []
+    chunks = iter_chunks(
+        [f for f in files if os.path.relpath(f, doc_path) in to_index],
+        doc_path,
+        chunk_size,
+        chunk_step,
+        workers,
+        failed,
+    )
+    aliases = dict()
+    reindexed = set(changed + deleted)
+    if dedup_threshold:
+        from near_duplicates import NearDuplicates
+
+        # new chunks are also near duplicates of the indexed ones, whose aliases in re-indexed files are dropped
+        near_duplicates = NearDuplicates(dedup_threshold)
+        for position in np.flatnonzero(kept):
+            document = chunk_store[int(position)]
+            signature = near_duplicates.signature(document.page_content)
+            if signature is not None:
+                near_duplicates.add(_chunk_ids([document.metadata])[0], signature)
+        chunks = dedupe_chunks(chunks, near_duplicates, aliases)
+    with ChunkSpool(output_path) as spool:
+        index = add_chunks(index, _count_chunks(chunks, counts), embeddings, spool, batch_size, index_options)
+        _report_cache(embeddings)
+        for source in to_index:
+            entries[source]["chunks"] = counts.get(source, 0)
+        _mark_failed(entries, failed)
+        manifest["files"] = entries
+        if not added and not changed and not deleted and not counts:
+            # only retried files, which failed again: the index is unchanged
+            save_manifest(output_path, manifest)
+            print("Index is up to date.")
+            return
+        documents = chain((chunk_store[int(position)] for position in np.flatnonzero(kept)), spool)
+        _write_index(
+            index, _with_aliases(documents, aliases, reindexed), manifest, output_path, index_options, embedding_options
+        )
+
+
+def build_shards(
+    doc_path: str,
+    output_path: str,
+    shards: int,
+    chunk_size: int,
+    chunk_step: int,
+    workers: int = 1,
+    embedding_cache: str = None,
+    batch_size: int = 256,
+    index_options: Dict = None,
+    embedding_options: Dict = None,
+    only: List[int] = None,
+    incremental: bool = False,
+    processes: int = None,
+    merge: bool = False,
+    dedup_threshold: float = None,
+):
+    """
+    Index the documents in shards: files are split into shards by a stable hash of their source, each shard is
+    indexed in its own process into its own index folder in output_path, with its own chunk store and manifest, and
+    shards.json lists the shards. The retriever searches all shards, see federated_retriever.load_retriever.
+    :param doc_path: the path of the documents
+    :param output_path: the sharded index folder
+    :param shards: the number of shards
+    :param chunk_size: the size of the chunk
+    :param chunk_step: the step size of the chunk
+    :param workers: the number of processes parsing and chunking the files of each shard in parallel
+    :param embedding_cache: the embedding cache folder shared by the shards, None to embed every chunk
+    :param batch_size: the number of chunks embedded at a time
+    :param index_options: the type and parameters of the faiss index of each shard, see DEFAULT_INDEX_OPTIONS
+    :param embedding_options: the embedding backend, model and threads, see DEFAULT_EMBEDDING_OPTIONS
+    :param only: the shards to index, None for all of them; the other shards are kept as they are
+    :param incremental: update the shards with update_index rather than rebuilding them
+    :param processes: the number of shards indexed at the same time, defaults to one per core
+    :param merge: also merge the shards into a single index in output_path, see merge_shards
+    :param dedup_threshold: the near-duplicate threshold of each shard, near duplicates are only dropped within a shard,
+        see build_index
+    """
+    dedup_threshold = dedup_threshold or None
+    previous = load_shards(output_path)
+    if only is not None:
+        layout = None
+        if previous is not None:
+            layout = tuple(previous.get(key) for key in ("count", "chunk_size", "chunk_step", "dedup_threshold"))
+        if layout != (shards, chunk_size, chunk_step, dedup_threshold):
+            raise ValueError(
+                f"{output_path} has no {shards} shards of this chunk size, step and near-duplicate threshold, "
+                "index all shards"
+            )
+        if not all(0 <= number < shards for number in only):
+            raise ValueError(f"Shards are numbered from 0 to {shards - 1}")
+    numbers = sorted(set(only)) if only is not None else list(range(shards))
+
+    # a shard without files has no index, a shard that lost all its files loses its index
+    counts = dict()
+    for f in iter_files(doc_path):
+        number = shard_of(os.path.relpath(f, doc_path), shards)
+        counts[number] = counts.get(number, 0) + 1
+    stale = [shard_name(number) for number in numbers if not counts.get(number)]
+    if previous is not None and previous["count"] != shards:
+        stale += [name for name in previous["shards"] if name not in map(shard_name, range(shards))]
+    for name in stale:
+        shutil.rmtree(os.path.join(output_path, name), ignore_errors=True)
+    numbers = [number for number in numbers if counts.get(number)]
+
+    processes = min(processes or os.cpu_count() or 1, max(len(numbers), 1))
+    embedding_options = {**DEFAULT_EMBEDDING_OPTIONS, **(embedding_options or {})}
+    if embedding_options["threads"] is None and processes > 1:
+        # the processes share the cores rather than each embedding on all of them
+        embedding_options["threads"] = max(1, (os.cpu_count() or 1) // processes)
+    index_function = update_index if incremental else build_index
+    jobs = [
+        (
+            doc_path,
+            os.path.join(output_path, shard_name(number)),
+            chunk_size,
+            chunk_step,
+            workers,
+            embedding_cache,
+            batch_size,
+            index_options,
+            embedding_options,
+            (number, shards),
+            dedup_threshold,
+        )
+        for number in numbers
+    ]
+    print(f"Indexing {len(jobs)} of {shards} shards in {processes} processes...")
+    if processes <= 1:
+        for job in jobs:
+            index_function(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for future in [executor.submit(index_function, *job) for job in jobs]:
+                future.result()
+
+    os.makedirs(output_path, exist_ok=True)
+    names = [
+        shard_name(number)
+        for number in range(shards)
+        if os.path.exists(os.path.join(output_path, shard_name(number), INDEX_FILE))
+    ]
+    manifest = {
+        "count": shards,
+        "chunk_size": chunk_size,
+        "chunk_step": chunk_step,
+        "dedup_threshold": dedup_threshold,
+        "shards": names,
+        "merged": False,
+    }
+    save_shards(output_path, manifest)
+    print(f"Saved {len(names)} shards to {output_path}")
+    if merge:
+        merge_shards(output_path, index_options)
+
+
+def merge_shards(
+    output_path: str,
+    index_options: Dict = None,
+):
+    """
+    Merge the shards of a sharded index folder into a single index in the folder itself, from the vectors of the
+    shard indexes, so the retriever searches one index. The shards are kept for shard-level rebuilds, after which the
+    shards are merged again.
+    :param output_path: the sharded index folder
+    :param index_options: the type and parameters of the merged index, defaults to the index type, storage and
+        search parameters of the shards
+    """
+    import faiss
+    import numpy as np
+    from chunk_store import load_chunk_store
+    from embedding_backends import index_embeddings
+
+    shards = load_shards(output_path)
+    if shards is None:
+        raise ValueError(f"{output_path} is not a sharded index folder")
+    vectors, stores, files, infos = [], [], dict(), []
+    for name in shards["shards"]:
+        folder = os.path.join(output_path, name)
+        info = load_index_info(folder)
+        if info.get("index_type") == "ivf_pq":
+            # the vectors of ivf_pq indexes are only kept quantized, merging would quantize them twice
+            raise ValueError("ivf_pq shards cannot be merged, search the shards instead")
+        index = faiss.read_index(os.path.join(folder, INDEX_FILE))
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        vectors.append(index.reconstruct_n(0, index.ntotal))
+        stores.append(load_chunk_store(folder))
+        files.update(load_manifest(folder)["files"])
+        infos.append(info)
+    if not infos:
+        print("No shards to merge.")
+        return
+    embeddings = [index_embeddings(info) for info in infos]
+    if any(embedding != embeddings[0] for embedding in embeddings):
+        raise ValueError("The shards were embedded by different backends or models, rebuild them")
+
+    inherited = {key: infos[0][key] for key in ("index_type", "storage", "nprobe", "ef_search") if key in infos[0]}
+    index_options = {**DEFAULT_INDEX_OPTIONS, **inherited, **(index_options or {})}
+    vectors = np.concatenate(vectors)
+    print(f"Merging {len(infos)} shards, {len(vectors)} chunks...")
+    # the shards hold different files, train on a sample of all of them
+    sampler = ReservoirSample(index_options["train_size"])
+    sampler.add(vectors)
+    index = create_faiss_index(sampler.sample, index_options)
+    for start in range(0, len(vectors), 50000):
+        index.add(vectors[start : start + 50000])
+    manifest = {key: shards.get(key) for key in ("chunk_size", "chunk_step", "dedup_threshold")}
+    manifest["files"] = files
+    _write_index(index, chain.from_iterable(stores), manifest, output_path, index_options, embeddings[0])
+    save_shards(output_path, {**shards, "merged": True})
 
 
 if __name__ == "__main__":
@@ -304,20 +1812,178 @@ if __name__ == "__main__":
         type=str,
         default="knowledge",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="the number of processes parsing and chunking files in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="only re-index new and changed documents and drop deleted ones, according to the index manifest",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--check",
+        help="only report whether the index is up to date with the documents, exit status 1 if it is not",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-e",
+        "--embedding_cache",
+        help="the folder of the embedding cache, defaults to embedding_cache in the output path",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        help="embed every chunk without looking up the embedding cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--index_type",
+        help="flat for exact search, ivf_flat, ivf_pq or hnsw for approximate search on large corpora",
+        choices=INDEX_TYPES,
+        default=DEFAULT_INDEX_OPTIONS["index_type"],
+    )
+    parser.add_argument(
+        "--storage",
+        help="the precision of the stored vectors of flat, ivf_flat and hnsw indexes, float16 and int8 use less memory",
+        choices=STORAGE_TYPES,
+        default=DEFAULT_INDEX_OPTIONS["storage"],
+    )
+    parser.add_argument(
+        "--nlist",
+        help="the number of inverted lists of ivf indexes",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["nlist"],
+    )
+    parser.add_argument(
+        "--pq_m",
+        help="the number of sub-quantizers of ivf_pq indexes, must divide the embedding dimension",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["pq_m"],
+    )
+    parser.add_argument(
+        "--hnsw_m",
+        help="the number of graph neighbors per vector of hnsw indexes",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["hnsw_m"],
+    )
+    parser.add_argument(
+        "--train_size",
+        help="the number of chunks ivf indexes are trained on",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["train_size"],
+    )
+    parser.add_argument(
+        "--nprobe",
+        help="the default number of inverted lists visited per query by ivf indexes",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["nprobe"],
+    )
+    parser.add_argument(
+        "--ef_search",
+        help="the default size of the candidate list per query of hnsw indexes",
+        type=int,
+        default=DEFAULT_INDEX_OPTIONS["ef_search"],
+    )
+    parser.add_argument(
+        "--embedding_backend",
+        help="huggingface, onnx for ONNX Runtime without torch, or hash for hashed words without a model",
+        choices=("huggingface", "onnx", "hash"),
+        default=DEFAULT_EMBEDDING_OPTIONS["embedding_backend"],
+    )
+    parser.add_argument(
+        "--embedding_model",
+        help="the model of the embedding backend, an onnx model name ending in -int8 runs the quantized model",
+        type=str,
+        default=DEFAULT_EMBEDDING_OPTIONS["embedding_model"],
+    )
+    parser.add_argument(
+        "--threads",
+        help="the number of threads embedding a batch, defaults to one per core",
+        type=int,
+        default=DEFAULT_EMBEDDING_OPTIONS["threads"],
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        help="drop chunks whose words are this similar (estimated Jaccard, e.g. 0.9) to an earlier chunk, recording "
+        "where they occur in the metadata of the kept chunk; unset to index every chunk",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        help="the number of chunks embedded and added to the index at a time",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--shards",
+        help="split the files into this many shards by a hash of their path, each indexed in its own process",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--shard",
+        help="only index this shard of a sharded index, can be repeated",
+        type=int,
+        action="append",
+    )
+    parser.add_argument(
+        "--shard_processes",
+        help="the number of shards indexed at the same time, defaults to one per core",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--merge",
+        help="merge the shards into a single index in the output path, rather than searching them separately",
+        action="store_true",
+    )
     args = parser.parse_args()
 
-    file_count, texts, metadata_list, chunk_id_to_index = chunk_document(
+    if args.check:
+        up_to_date = check_index(
+            args.doc_path, args.output_path, args.chunk_size, args.chunk_step, args.dedup_threshold
+        )
+        sys.exit(0 if up_to_date else 1)
+
+    embedding_cache = None
+    if not args.no_embedding_cache:
+        embedding_cache = args.embedding_cache or os.path.join(args.output_path, "embedding_cache")
+
+    index_arguments = dict(
         doc_path=args.doc_path,
+        output_path=args.output_path,
         chunk_size=args.chunk_size,
         chunk_step=args.chunk_step,
+        workers=args.workers,
+        embedding_cache=embedding_cache,
+        batch_size=args.batch_size,
+        index_options={option: getattr(args, option) for option in DEFAULT_INDEX_OPTIONS},
+        embedding_options={option: getattr(args, option) for option in DEFAULT_EMBEDDING_OPTIONS},
+        dedup_threshold=args.dedup_threshold,
     )
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    vectorstore = FAISS.from_texts(
-        texts=texts,
-        metadatas=metadata_list,
-        embedding=embeddings,
-    )
-    vectorstore.save_local(folder_path=args.output_path)
-    with open(os.path.join(args.output_path, "chunk_id_to_index.pkl"), "wb") as f:
-        pickle.dump(chunk_id_to_index, f)
-    print(f"Saved vectorstore to {args.output_path}")
+    if args.shards:
+        build_shards(
+            shards=args.shards,
+            only=args.shard,
+            incremental=args.incremental,
+            processes=args.shard_processes,
+            merge=args.merge,
+            **index_arguments,
+        )
+    elif args.merge:
+        # the merged index is of the type of the shards
+        merge_shards(args.output_path)
+    else:
+        index_function = update_index if args.incremental else build_index
+        index_function(**index_arguments)
+    worker_peak = peak_rss_mb(workers=True)
+    print(f"Peak memory: {peak_rss_mb():.0f} MB" + (f", {worker_peak:.0f} MB in a worker" if worker_peak else ""))
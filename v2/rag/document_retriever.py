@@ -1,14 +1,35 @@
+from __future__ import annotations
+
 import os
-import pickle
 import json
+import math
 import argparse
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from manifest import INDEX_INFO_FILE, load_index_info
+from query_cache import LRUCache
+
+# faiss, numpy, tiktoken and the index helpers are loaded by the first DocumentRetriever, and the embedding model
+# (LangChain and torch) by load_embedding_model, so importing this module and --help stay fast
+faiss = np = tiktoken = filter_key = None
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+INDEX_FILE = "index.faiss"
 
-try:
-    import tiktoken
-    from langchain_community.embeddings import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import FAISS
-except ImportError:
-    raise ImportError("Please install langchain-community first.")
+SEARCH_MODES = ("vector", "keyword", "hybrid")
+# candidates taken from each ranking per requested chunk in hybrid mode, and the rank offset of the fusion
+HYBRID_CANDIDATES = 4
+RRF_K = 60
+# hits taken per requested chunk before merging, hits merged into the window of a better one free their slot
+MERGE_CANDIDATES = 2
+# number of filters whose chunk selection is kept in memory
+SELECTION_CACHE_SIZE = 64
+# selections of at most this many chunks are scored exactly, from their vectors only, rather than by a filtered search
+EXACT_SEARCH_LIMIT = 4096
+# the largest candidate list of the filtered hnsw searches repeated for queries short of results
+MAX_EF_SEARCH = 1024
 
 # Configuration - Users/AI skill developers must update this path to their specific index folder
 # To test with sample data set index_folder to "knowledge"
@@ -16,103 +37,647 @@ CONFIG = {
     "index_folder": "rag/knowledge",  # TODO: Update this path before using
 }
 
+# the pip packages of the modules the retriever imports when it is created
+_PACKAGES = {"faiss": "faiss-cpu", "numpy": "numpy", "tiktoken": "tiktoken"}
+
+
+def _load_dependencies():
+    global faiss, np, tiktoken, filter_key
+    try:
+        import faiss
+        import numpy as np
+        import tiktoken
+    except ImportError as error:
+        module = (error.name or "").split(".")[0]
+        raise ImportError(f"Please install {_PACKAGES.get(module, module or 'faiss-cpu')} first.") from error
+    from metadata_filter import filter_key
+
+
+def load_embedding_model(model_name: str = EMBEDDING_MODEL, backend: str = "huggingface", threads: int = None):
+    """
+    Load the embedding model, the only place the retriever imports it
+    :param model_name: the model name
+    :param backend: the embedding backend, see embedding_backends.BACKENDS
+    :param threads: the number of threads embedding a batch, None for the default of the backend
+    """
+    from embedding_backends import create_backend
+
+    return create_backend(backend, model_name, threads)
+
+
+def load_query_embeddings(
+    index_folder: str,
+    backend: str,
+    model_name: str,
+    threads: int = None,
+    embedding_cache: str = None,
+):
+    """
+    Load the embedding model of the queries of an index, looking embeddings up in the embedding cache written by the
+    indexer when there is one, read-only: queries are kept by the bounded query embedding cache of the retriever, so
+    the cache of the indexer does not grow with them
+    :param index_folder: the folder written by document_indexer.py
+    :param backend: the embedding backend recorded by the indexer
+    :param model_name: the embedding model recorded by the indexer
+    :param threads: the number of threads embedding a batch of queries, None for the default of the backend
+    :param embedding_cache: the embedding cache folder, defaults to the one of the index folder if there is one
+    """
+    from embedding_backends import cache_model_name
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+    embeddings = load_embedding_model(model_name, backend, threads)
+    embedding_cache = embedding_cache or os.path.join(index_folder, "embedding_cache")
+    if not os.path.isdir(embedding_cache):
+        return embeddings
+    cache = EmbeddingCache(embedding_cache, readonly=True)
+    return CachedEmbeddings(embeddings, cache_model_name(backend, model_name), cache)
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], size: int, k: int = RRF_K) -> List[int]:
+    """
+    Fuse rankings by reciprocal rank fusion, each chunk scores the sum of 1 / (k + rank) over the rankings it is in
+    :param rankings: the chunk positions of each ranking, best first
+    :param size: the number of chunks
+    :param k: the rank offset, higher values flatten the difference between the first ranks
+    :return: the chunk positions, best first
+    """
+    return list(_fuse(rankings, size, k))
+
+
+def _fuse(rankings: List[np.ndarray], size: int, k: int = RRF_K) -> Dict[int, float]:
+    # the fused scores of the best chunks, best first
+    scores = dict()
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[int(position)] = scores.get(int(position), 0.0) + 1.0 / (k + rank + 1)
+    return {position: scores[position] for position in sorted(scores, key=lambda position: -scores[position])[:size]}
+
+
+class Selection:
+    """
+    The chunks matching a filter, as a bitmap for faiss and the keyword index, one bit per chunk, and the positions of
+    the chunks of selections scored exactly. Only these are cached, not a boolean mask of a byte per chunk.
+    """
+
+    def __init__(self, mask: np.ndarray):
+        """
+        :param mask: one boolean per chunk position
+        """
+        self.count = int(mask.sum())
+        self.positions = np.flatnonzero(mask) if self.count <= EXACT_SEARCH_LIMIT else None
+        # faiss reads the bitmap without copying it, it lives as long as the selection
+        self.bitmap = np.packbits(mask, bitorder="little")
+        self.selector = faiss.IDSelectorBitmap(self.bitmap)
+
+
+def _vector_ranking(positions: np.ndarray, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # faiss pads missing hits with -1, the squared l2 distances of unit vectors become cosine similarities
+    found = positions >= 0
+    return positions[found], 1 - distances[found] / 2
+
+
+def _normalize(query: str) -> str:
+    # queries differing only in whitespace share their cache entries
+    return " ".join(query.split())
+
+
 class DocumentRetriever:
-    def __init__(self, index_folder):
+    def __init__(
+        self,
+        index_folder,
+        embedding_cache=None,
+        cache_size=1024,
+        cache_ttl=None,
+        embedding_backend=None,
+        embedding_model=None,
+        threads=None,
+        embeddings=None,
+    ):
+        """
+        :param index_folder: the folder written by document_indexer.py
+        :param embedding_cache: the embedding cache folder, defaults to the one of the index folder if there is one
+        :param cache_size: the number of query embeddings and of query results kept in memory, 0 disables both
+        :param cache_ttl: the number of seconds query embeddings and results are kept, None to keep them until evicted
+        :param embedding_backend: the embedding backend, None for the one recorded by the indexer, which it must match
+        :param embedding_model: the embedding model, None for the one recorded by the indexer, which it must match
+        :param threads: the number of threads embedding a batch of queries, None for the default of the backend
+        :param embeddings: the embedding model of the recorded backend and model, loaded by another retriever or by
+            load_query_embeddings, used as it is, None to load it
+        """
         self.index_folder = index_folder
-        self.vectorstore = None
-        self.chunk_id_to_index = None
-        self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        self.index = None
+        self.chunks = None
+        self.neighbors = None
+        self.keywords = None
+        self.filters = None
+        self.index_info = None
+        self.version = None
+        self._index_info_mtime = None
+        _load_dependencies()
+        from embedding_backends import check_embeddings
+
+        # queries are embedded like the chunks, vectors of other backends or models are not comparable
+        self.embedding_backend, self.embedding_model = check_embeddings(
+            load_index_info(index_folder), embedding_backend, embedding_model
+        )
+        self.embeddings = embeddings or load_query_embeddings(
+            index_folder, self.embedding_backend, self.embedding_model, threads, embedding_cache
+        )
+        self.query_embeddings = LRUCache(cache_size, cache_ttl)
+        self.results = LRUCache(cache_size, cache_ttl)
+        self.selections = LRUCache(SELECTION_CACHE_SIZE)
+        self._direct_map_lock = threading.Lock()
         self._init()
         self.enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
     def _init(self):
-        self.vectorstore = FAISS.load_local(
-            folder_path=self.index_folder,
-            embeddings=self.embeddings,
-        )
-        with open(os.path.join(self.index_folder, "chunk_id_to_index.pkl"), "rb") as f:
-            self.chunk_id_to_index = pickle.load(f)
+        from bm25_index import load_bm25_index
+        from chunk_store import load_chunk_store
+        from metadata_filter import load_metadata_filters
+        from neighbor_index import load_neighbor_index
 
-    def __call__(self, query: str, size: int = 5, target_length: int = 256):
-        if self.vectorstore is None:
-            raise Exception("Vectorstore not initialized")
+        self._index_info_mtime = self._stat_index_info()
+        # both the vectors and the chunk texts are memory-mapped, so startup does not depend on the index size and
+        # retrievers of the same index folder share the page cache; older faiss releases can only map ivf lists
+        mmap_flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        self.index = faiss.read_index(os.path.join(self.index_folder, INDEX_FILE), mmap_flags)
+        self.chunks = load_chunk_store(self.index_folder)
+        self.neighbors = load_neighbor_index(self.index_folder)
+        self.keywords = load_bm25_index(self.index_folder)
+        self.filters = load_metadata_filters(self.index_folder, self.neighbors)
+        # selections are chunk positions of the loaded index
+        self.selections.clear()
+        self.index_info = load_index_info(self.index_folder)
+        self.version = self.index_info.get("version")
 
-        result = self.vectorstore.similarity_search(query=query, k=size)
-        expanded_chunks = self.do_expand(result, target_length)
+    def _stat_index_info(self):
+        try:
+            return os.stat(os.path.join(self.index_folder, INDEX_INFO_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
-        return json.dumps(expanded_chunks, indent=4)
+    def refresh(self):
+        """
+        Reload the index when the indexer wrote a new version of it, index_info.json is written last so the other
+        files are complete by then. Results cached for the previous version are dropped. An index embedded by another
+        backend or model is not loaded, the retriever has to be created again for it.
+        """
+        from embedding_backends import check_embeddings
+
+        mtime = self._stat_index_info()
+        if mtime == self._index_info_mtime:
+            return
+        check_embeddings(load_index_info(self.index_folder), self.embedding_backend, self.embedding_model)
+        previous = self.version
+        self._init()
+        if self.version != previous:
+            self.results.clear()
+
+    def cache_info(self):
+        """
+        Get the hit and miss counters of the query embedding and result caches
+        """
+        return {"embeddings": self.query_embeddings.info(), "results": self.results.info()}
+
+    def __call__(
+        self,
+        query: str,
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        results = self.retrieve_batch([query], size, target_length, nprobe, ef_search, mode, filters)
+        return json.dumps(results[0], indent=4)
+
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        """
+        Retrieve and expand the chunks of several queries at once: the queries are embedded together, searched with
+        one faiss call, and hits shared by several queries are expanded once. Hits whose expansions overlap are merged,
+        see merge_expansions. Results are cached per query, cached results are shared between calls and must not be
+        modified.
+        :param queries: the queries
+        :param size: the number of chunks per query
+        :param target_length: the number of tokens of each expanded chunk
+        :param nprobe: the number of inverted lists visited by an ivf index, defaults to the value of the indexer
+        :param ef_search: the candidate list size of an hnsw index, defaults to the value of the indexer
+        :param mode: "vector" for embedding search, "keyword" for BM25 search, "hybrid" to fuse both rankings
+        :param filters: only search the chunks whose metadata match, the values of "source", "title" or "folder",
+            a string or a list of strings, e.g. {"folder": "api"}; chunks must match every field and any of its values
+        :return: the expanded chunks of each query, in query order, with the score of their best hit
+        """
+        if self.index is None:
+            raise Exception("Index not initialized")
+
+        self.refresh()
+        key = filter_key(filters)
+        keys = [
+            (self.version, _normalize(query), size, target_length, nprobe, ef_search, mode, key) for query in queries
+        ]
+        cached = [self.results.get(key) for key in keys]
+        missing = {key: query for key, query, result in zip(keys, queries, cached) if result is None}
+        computed = dict()
+        if missing:
+            candidates = size * MERGE_CANDIDATES
+            rankings = self._rank_batch(list(missing.values()), candidates, nprobe, ef_search, mode, filters)
+            windows = dict()
+            for key, (positions, scores) in zip(missing, rankings):
+                computed[key] = self.merge_expansions(positions, scores, size, target_length, windows)
+                self.results.put(key, computed[key])
+        return [computed[key] if result is None else result for key, result in zip(keys, cached)]
+
+    def search(self, query: str, size: int = 5, nprobe=None, ef_search=None, mode: str = "vector", filters=None):
+        """
+        Find the chunks closest to a query, without expansion
+        :param query: the query
+        :param size: the number of chunks
+        :param nprobe: the number of inverted lists visited by an ivf index, defaults to the value of the indexer
+        :param ef_search: the candidate list size of an hnsw index, defaults to the value of the indexer
+        :param mode: "vector" for embedding search, "keyword" for BM25 search, "hybrid" to fuse both rankings
+        :param filters: only search the chunks whose metadata match, the values of "source", "title" or "folder",
+            a string or a list of strings, e.g. {"folder": "api"}; chunks must match every field and any of its values
+        """
+        return self.search_batch([query], size, nprobe, ef_search, mode, filters)[0]
+
+    def search_batch(
+        self, queries: List[str], size: int = 5, nprobe=None, ef_search=None, mode: str = "vector", filters=None
+    ):
+        """
+        Find the chunks closest to each query, without expansion
+        :param queries: the queries
+        :param size: the number of chunks per query
+        :param nprobe: the number of inverted lists visited by an ivf index, defaults to the value of the indexer
+        :param ef_search: the candidate list size of an hnsw index, defaults to the value of the indexer
+        :param mode: "vector" for embedding search, "keyword" for BM25 search, "hybrid" to fuse both rankings
+        :param filters: only search the chunks whose metadata match, the values of "source", "title" or "folder",
+            a string or a list of strings, e.g. {"folder": "api"}; chunks must match every field and any of its values
+        :return: the chunks of each query, in query order
+        """
+        self.refresh()
+        return self._search_batch(queries, size, nprobe, ef_search, mode, filters)
+
+    def _search_batch(
+        self, queries: List[str], size: int, nprobe=None, ef_search=None, mode: str = "vector", filters=None
+    ):
+        rankings = self._rank_batch(queries, size, nprobe, ef_search, mode, filters)
+        return [[self.chunks[int(position)] for position in positions] for positions, _ in rankings]
+
+    def _rank_batch(
+        self,
+        queries: List[str],
+        size: int,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+        vectors: np.ndarray = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # the chunk positions and scores of the hits of each query, best first, higher scores are better; vectors are
+        # the query embeddings when they were computed already
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unsupported search mode: {mode}. The supported modes are {SEARCH_MODES}")
+        if mode != "vector" and self.keywords is None:
+            raise ValueError(f"The index has no keyword index for {mode} search, rebuild it with document_indexer.py")
+        selection = self.selection(filters)
+        if not queries:
+            return []
+        if selection is not None and not selection.count:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        bitmap = None if selection is None else selection.bitmap
+        if mode == "vector":
+            return self._vector_search(queries, size, nprobe, ef_search, selection, vectors)
+        if mode == "keyword":
+            return [self.keywords.search(query, size, bitmap) for query in queries]
+        # both searches return more candidates than needed, chunks found by only one of them can still rank high
+        candidates = size * HYBRID_CANDIDATES
+        rankings = []
+        for query, (vector_ranking, _) in zip(
+            queries, self._vector_search(queries, candidates, nprobe, ef_search, selection, vectors)
+        ):
+            fused = _fuse([vector_ranking, self.keywords.search(query, candidates, bitmap)[0]], size)
+            rankings.append((np.array(list(fused), dtype=np.int64), np.array(list(fused.values()), dtype=np.float32)))
+        return rankings
+
+    def selection(self, filters) -> Optional[Selection]:
+        """
+        Get the chunks matching a filter, kept for the next queries with the same filter
+        :param filters: the filter, see retrieve_batch
+        :return: the selection, None for no filter
+        """
+        key = filter_key(filters)
+        if key is None:
+            return None
+        if self.filters is None:
+            raise ValueError("The index has no metadata filters, rebuild it with document_indexer.py")
+        selection = self.selections.get(key)
+        if selection is None:
+            selection = Selection(self.filters.mask(key))
+            self.selections.put(key, selection)
+        return selection
+
+    def _vector_search(
+        self,
+        queries: List[str],
+        size: int,
+        nprobe=None,
+        ef_search=None,
+        selection: Selection = None,
+        vectors: np.ndarray = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        embeddings = self.embed_queries(queries) if vectors is None else vectors
+        if selection is not None and selection.count <= EXACT_SEARCH_LIMIT:
+            return self._exact_search(embeddings, size, selection)
+        selector = None if selection is None else selection.selector
+        params = self._search_parameters(nprobe, ef_search, selector)
+        distances, positions = self.index.search(embeddings, size, params=params)
+        rankings = [_vector_ranking(row, distance) for row, distance in zip(positions, distances)]
+        if selection is not None:
+            # ivf lists and hnsw neighbors visited by a search can hold too few selected chunks, the queries short of
+            # results are searched again visiting as many more lists or candidates as the filter leaves out, within
+            # bounds so they never cost more than a scan of the index
+            short = [i for i, (ranking, _) in enumerate(rankings) if len(ranking) < min(size, selection.count)]
+            if short and isinstance(self.index, (faiss.IndexIVF, faiss.IndexHNSW)):
+                widen = self.index.ntotal / selection.count
+                if isinstance(self.index, faiss.IndexIVF):
+                    nprobe = min(math.ceil(params.nprobe * widen), self.index.nlist)
+                else:
+                    ef_search = min(math.ceil(params.efSearch * widen), max(MAX_EF_SEARCH, params.efSearch))
+                params = self._search_parameters(nprobe, ef_search, selector)
+                distances, positions = self.index.search(embeddings[short], size, params=params)
+                for i, row, distance in zip(short, positions, distances):
+                    rankings[i] = _vector_ranking(row, distance)
+        return rankings
+
+    def _exact_search(
+        self, embeddings: np.ndarray, size: int, selection: Selection
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # only the vectors of the selected chunks are scored, which costs less than any filtered search of the index
+        # when the filter is selective; quantized vectors are scored as the index stores them
+        index = self.index
+        if isinstance(index, faiss.IndexIVF) and index.direct_map.no():
+            with self._direct_map_lock:
+                if index.direct_map.no():
+                    index.make_direct_map()
+        vectors = index.reconstruct_batch(selection.positions)
+        distances, rows = faiss.knn(embeddings, vectors, min(size, selection.count))
+        return [_vector_ranking(selection.positions[row], distance) for row, distance in zip(rows, distances)]
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Embed queries, the queries missing from the query embedding cache in one batch
+        :param queries: the queries
+        :return: one row per query
+        """
+        keys = [_normalize(query) for query in queries]
+        vectors = [self.query_embeddings.get(key) for key in keys]
+        missing = {key: query for key, query, vector in zip(keys, queries, vectors) if vector is None}
+        if missing:
+            # all-MiniLM-L6-v2 embeds queries and documents the same way, embed_documents runs one batch through
+            # the model
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            for key, vector in computed.items():
+                self.query_embeddings.put(key, vector)
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return np.array(vectors, dtype=np.float32)
+
+    def _search_parameters(self, nprobe=None, ef_search=None, selector=None):
+        # parameters are passed per query rather than set on the shared index, so concurrent queries do not race
+        index = self.index
+        if isinstance(index, faiss.IndexIVF):
+            nprobe = nprobe or self.index_info.get("nprobe", index.nprobe)
+            return faiss.SearchParametersIVF(nprobe=nprobe, sel=selector)
+        if isinstance(index, faiss.IndexHNSW):
+            ef_search = ef_search or self.index_info.get("ef_search", index.hnsw.efSearch)
+            return faiss.SearchParametersHNSW(efSearch=ef_search, sel=selector)
+        if selector is not None:
+            return faiss.SearchParameters(sel=selector)
+        return None
 
     def do_expand(self, result, target_length):
-        expanded_chunks = []
-        # do expansion
-        for r in result:
-            source = r.metadata["source"]
-            chunk_id = r.metadata["chunk_id"]
-            content = r.page_content
-
-            expanded_result = content
-            left_chunk_id, right_chunk_id = chunk_id - 1, chunk_id + 1
-            left_valid, right_valid = True, True
-            chunk_ids = [chunk_id]
-            while True:
-                current_length = len(self.enc.encode(expanded_result))
-                if f"{source}_{left_chunk_id}" in self.chunk_id_to_index:
-                    chunk_ids.append(left_chunk_id)
-                    left_chunk_index = self.vectorstore.index_to_docstore_id[
-                        self.chunk_id_to_index[f"{source}_{left_chunk_id}"]
-                    ]
-                    left_chunk = self.vectorstore.docstore.search(left_chunk_index)
-                    encoded_left_chunk = self.enc.encode(left_chunk.page_content)
-                    if len(encoded_left_chunk) + current_length < target_length:
-                        expanded_result = left_chunk.page_content + expanded_result
-                        left_chunk_id -= 1
-                        current_length += len(encoded_left_chunk)
-                    else:
-                        expanded_result += self.enc.decode(
-                            encoded_left_chunk[-(target_length - current_length) :],
-                        )
-                        current_length = target_length
-                        break
+        """
+        Grow each hit with its neighbor chunks, one on the left then one on the right, until target_length tokens.
+        The lengths come from the token counts stored by the indexer, only the neighbor cut at the boundary is
+        encoded, and chunks of indexes without token counts are encoded once each.
+        :param result: the hits
+        :param target_length: the number of tokens of each expanded hit
+        """
+        return [
+            {"chunk": "".join(self.expand_window(r, target_length).values()), "metadata": r.metadata} for r in result
+        ]
+
+    def expand_window(self, hit, target_length) -> Dict[int, str]:
+        """
+        Grow a hit with its neighbor chunks like do_expand
+        :param hit: the hit
+        :param target_length: the number of tokens of the window
+        :return: the text of each chunk of the window by chunk id, in chunk order, the outer chunks may be cut
+        """
+        source = hit.metadata["source"]
+        chunk_id = hit.metadata["chunk_id"]
+
+        parts = deque([(chunk_id, hit.page_content)])
+        current_length = self.token_count(hit)
+        left_chunk_id, right_chunk_id = chunk_id - 1, chunk_id + 1
+        while current_length < target_length:
+            left_position = self.neighbors.position(source, left_chunk_id)
+            if left_position is not None:
+                left_chunk = self.chunks[left_position]
+                left_length = self.token_count(left_chunk)
+                if current_length + left_length < target_length:
+                    parts.appendleft((left_chunk_id, left_chunk.page_content))
+                    left_chunk_id -= 1
+                    current_length += left_length
                 else:
-                    left_valid = False
-
-                if f"{source}_{right_chunk_id}" in self.chunk_id_to_index:
-                    chunk_ids.append(right_chunk_id)
-                    right_chunk_index = self.vectorstore.index_to_docstore_id[
-                        self.chunk_id_to_index[f"{source}_{right_chunk_id}"]
-                    ]
-                    right_chunk = self.vectorstore.docstore.search(right_chunk_index)
-                    encoded_right_chunk = self.enc.encode(right_chunk.page_content)
-                    if len(encoded_right_chunk) + current_length < target_length:
-                        expanded_result += right_chunk.page_content
-                        right_chunk_id += 1
-                        current_length += len(encoded_right_chunk)
-                    else:
-                        expanded_result += self.enc.decode(
-                            encoded_right_chunk[: target_length - current_length],
-                        )
-                        current_length = target_length
-                        break
+                    # keep the end of the left neighbor, the part next to the hit
+                    tokens = self.enc.encode(left_chunk.page_content)
+                    text = self.enc.decode(tokens[len(tokens) - (target_length - current_length) :])
+                    parts.appendleft((left_chunk_id, text))
+                    break
+
+            right_position = self.neighbors.position(source, right_chunk_id)
+            if right_position is not None:
+                right_chunk = self.chunks[right_position]
+                right_length = self.token_count(right_chunk)
+                if current_length + right_length < target_length:
+                    parts.append((right_chunk_id, right_chunk.page_content))
+                    right_chunk_id += 1
+                    current_length += right_length
                 else:
-                    right_valid = False
+                    tokens = self.enc.encode(right_chunk.page_content)
+                    parts.append((right_chunk_id, self.enc.decode(tokens[: target_length - current_length])))
+                    break
+
+            if left_position is None and right_position is None:
+                break
+        return dict(parts)
+
+    def merge_expansions(self, positions, scores, size: int, target_length: int, windows: Dict = None):
+        """
+        Expand the hits of a query, merging hits of the same source whose windows overlap or touch into one window,
+        so no text is returned twice. A merged hit does not take a result of its own, the next distinct hit does.
+        :param positions: the chunk positions of the hits, best first, more than size to fill the freed results
+        :param scores: the score of each hit
+        :param size: the number of results
+        :param target_length: the number of tokens of the window of each hit, a merged window is the union of the
+            windows of its hits cut down to target_length tokens around the best one, see _trim
+        :param windows: the windows of hits expanded earlier by (source, chunk id), shared between queries
+        :return: the windows with the metadata and score of their best hit and, for merged windows, the chunk id
+            and score of each hit, best first
+        """
+        windows = dict() if windows is None else windows
+        groups = []
+        for position, score in zip(positions, scores):
+            hit = self.chunks[int(position)]
+            source, chunk_id = hit.metadata["source"], hit.metadata["chunk_id"]
+            hit_score = (chunk_id, round(float(score), 4))
+            # a hit is covered by a window holding its whole chunk, a window cutting it is merged with its own
+            covering = [
+                group
+                for group in groups
+                if group["source"] == source and group["window"].get(chunk_id) == hit.page_content
+            ]
+            if covering:
+                covering[0]["hits"].append(hit_score)
+                continue
+            if len(groups) == size:
+                continue
+            if (source, chunk_id) not in windows:
+                windows[(source, chunk_id)] = self.expand_window(hit, target_length)
+            window = windows[(source, chunk_id)]
+            group = {"source": source, "window": window, "hit": hit, "hits": [hit_score]}
+            touching = [
+                other
+                for other in groups
+                if other["source"] == source
+                and min(window) <= max(other["window"]) + 1
+                and min(other["window"]) <= max(window) + 1
+            ]
+            if not touching:
+                groups.append(group)
+                continue
+            # the best group takes the others, which frees their results
+            merged = touching[0]
+            merged["merged"] = True
+            for other in touching[1:] + [group]:
+                merged["window"] = self._union(source, merged["window"], other["window"])
+                merged["hits"].extend(other["hits"])
+                if other is not group:
+                    groups.remove(other)
 
-                if not left_valid and not right_valid:
+        results = []
+        for group in groups:
+            hits = sorted(group["hits"], key=lambda hit_score: -hit_score[1])
+            if group.get("merged"):
+                group["window"] = self._trim(group["source"], group["window"], hits, target_length)
+                # the hits cut off by the trimmed window are dropped from it
+                window, source = group["window"], group["source"]
+                hits = [hit for hit in hits if window.get(hit[0]) == self._chunk_text(source, hit[0])]
+            result = {
+                "chunk": "".join(group["window"][chunk_id] for chunk_id in sorted(group["window"])),
+                "metadata": group["hit"].metadata,
+                "score": hits[0][1],
+            }
+            if len(hits) > 1:
+                result["hits"] = [{"chunk_id": chunk_id, "score": score} for chunk_id, score in hits]
+            results.append(result)
+        return results
+
+    def _union(self, source: str, window: Dict[int, str], other: Dict[int, str]) -> Dict[int, str]:
+        # a chunk cut differently by the two windows, at the end of one and the start of the other, is taken whole
+        merged = dict(window)
+        for chunk_id, text in other.items():
+            if chunk_id in merged and merged[chunk_id] != text:
+                text = self.chunks[self.neighbors.position(source, chunk_id)].page_content
+            merged[chunk_id] = text
+        return merged
+
+    def _chunk_text(self, source: str, chunk_id: int) -> str:
+        return self.chunks[self.neighbors.position(source, chunk_id)].page_content
+
+    def _trim(self, source: str, window: Dict[int, str], hits: List, target_length: int) -> Dict[int, str]:
+        """
+        Cut a merged window down to target_length tokens around its best hit: the chunks of the other hits are kept,
+        best first, where they fit with the chunks between, then neighbors are added one on the left and one on the
+        right like expand_window
+        :param source: the source of the window
+        :param window: the text of each chunk of the window by chunk id, contiguous
+        :param hits: the chunk id and score of each hit in the window, best first
+        :param target_length: the number of tokens of the window
+        :return: the window, unchanged when it has at most target_length tokens
+        """
+        lengths = dict()
+        for chunk_id, text in window.items():
+            chunk = self.chunks[self.neighbors.position(source, chunk_id)]
+            lengths[chunk_id] = self.token_count(chunk) if text == chunk.page_content else len(self.enc.encode(text))
+        if sum(lengths.values()) <= target_length:
+            return window
+
+        low = high = hits[0][0]
+        current_length = lengths[low]
+        for chunk_id, _ in hits[1:]:
+            span = range(chunk_id, low) if chunk_id < low else range(high + 1, chunk_id + 1)
+            span_length = sum(lengths[i] for i in span)
+            if current_length + span_length <= target_length:
+                low, high = min(low, chunk_id), max(high, chunk_id)
+                current_length += span_length
+        parts = deque((chunk_id, window[chunk_id]) for chunk_id in range(low, high + 1))
+        while current_length < target_length and (low - 1 in window or high + 1 in window):
+            if low - 1 in window:
+                low -= 1
+                if current_length + lengths[low] < target_length:
+                    parts.appendleft((low, window[low]))
+                    current_length += lengths[low]
+                else:
+                    tokens = self.enc.encode(window[low])
+                    parts.appendleft((low, self.enc.decode(tokens[len(tokens) - (target_length - current_length) :])))
+                    break
+            if high + 1 in window:
+                high += 1
+                if current_length + lengths[high] < target_length:
+                    parts.append((high, window[high]))
+                    current_length += lengths[high]
+                else:
+                    tokens = self.enc.encode(window[high])
+                    parts.append((high, self.enc.decode(tokens[: target_length - current_length])))
                     break
+        return dict(parts)
 
-            expanded_chunks.append(
-                {
-                    "chunk": expanded_result,
-                    "metadata": r.metadata,
-                    # "length": current_length,
-                    # "chunk_ids": chunk_ids
-                },
-            )
-        return expanded_chunks
+    def token_count(self, chunk) -> int:
+        """
+        Get the number of tokens of a chunk, stored in its metadata by the indexer or counted for older indexes
+        :param chunk: the chunk
+        """
+        if "tokens" in chunk.metadata:
+            return chunk.metadata["tokens"]
+        return len(self.enc.encode(chunk.page_content))
 
 # Example Usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Retrieve documents based on a query.')
-    parser.add_argument('query', nargs='?', type=str, help='The query to retrieve documents for.')
+    parser.add_argument(
+        'query', nargs='*', type=str, help='The queries to retrieve documents for, retrieved as one batch.'
+    )
+    parser.add_argument(
+        '--mode', choices=SEARCH_MODES, default='vector', help='Embedding, BM25 keyword or hybrid search.'
+    )
+    parser.add_argument('--source', action='append', help='Only search the chunks of this file, can be repeated.')
+    parser.add_argument(
+        '--title', action='append', help='Only search the chunks of documents with this title, can be repeated.'
+    )
+    parser.add_argument(
+        '--folder', action='append', help='Only search the chunks of files in this folder, can be repeated.'
+    )
     args = parser.parse_args()
 
     if not args.query:
@@ -128,8 +693,12 @@ if __name__ == "__main__":
 
     # Instantiate and use the DocumentRetriever with the configured index folder
     retriever = DocumentRetriever(index_folder=index_folder)
-    query = args.query
     size = 5  # Number of results to retrieve
     target_length = 256  # Target length of expanded content
-    results = retriever(query, size, target_length)
+    filters = {field: getattr(args, field) for field in ("source", "title", "folder") if getattr(args, field)}
+    if len(args.query) == 1:
+        results = retriever(args.query[0], size, target_length, mode=args.mode, filters=filters)
+    else:
+        results = retriever.retrieve_batch(args.query, size, target_length, mode=args.mode, filters=filters)
+        results = json.dumps(results, indent=4)
     print(results)
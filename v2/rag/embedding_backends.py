@@ -0,0 +1,288 @@
+"""
+Embedding backends of the RAG skill, created by name by document_indexer.py and document_retriever.py:
+
+- "huggingface": the sentence-transformers model through LangChain and torch, the default
+- "onnx": the same model exported to ONNX, run by ONNX Runtime with the tokenizers library and no torch, optionally
+  int8-quantized, on a configurable number of threads, batching texts of similar length together
+- "hash": a deterministic bag of hashed words, for tests and machines without a model
+
+The indexer records the backend and the model in index_info.json. Vectors of different backends or models are not
+comparable, so the retriever embeds queries with the recorded ones and refuses others.
+"""
+import hashlib
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    raise ImportError("Please install langchain-core first.")
+
+BACKENDS = ("huggingface", "onnx", "hash")
+DEFAULT_BACKEND = "huggingface"
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+HASH_MODEL = "bag-of-words-384"
+# where the onnx backend keeps the int8 models it quantizes
+MODEL_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "rag", "onnx")
+
+
+def describe_embeddings(backend: str = DEFAULT_BACKEND, model_name: str = None) -> Dict:
+    """
+    Describe the embeddings of an index for index_info.json
+    :param backend: the backend name
+    :param model_name: the model name, defaults to the default model of the backend
+    """
+    return {"embedding_backend": backend, "embedding_model": model_name or _default_model(backend)}
+
+
+def cache_model_name(backend: str = DEFAULT_BACKEND, model_name: str = None) -> str:
+    """
+    Get the model name of the embedding cache keys, the embeddings of each backend and model are cached apart
+    :param backend: the backend name
+    :param model_name: the model name
+    """
+    model_name = model_name or _default_model(backend)
+    # huggingface keeps the plain model name of caches written before there were backends
+    return model_name if backend == "huggingface" else f"{backend}/{model_name}"
+
+
+def _default_model(backend: str) -> str:
+    return HASH_MODEL if backend == "hash" else DEFAULT_MODEL
+
+
+def create_backend(backend: str = DEFAULT_BACKEND, model_name: str = None, threads: int = None) -> Embeddings:
+    """
+    Create an embedding backend
+    :param backend: the backend name, see BACKENDS
+    :param model_name: the model name, defaults to the default model of the backend
+    :param threads: the number of threads embedding a batch, None for the default of the backend
+    """
+    model_name = model_name or _default_model(backend)
+    if backend == "huggingface":
+        return HuggingFaceBackend(model_name, threads)
+    if backend == "onnx":
+        return ONNXBackend(model_name, threads)
+    if backend == "hash":
+        return HashBackend(model_name)
+    raise ValueError(f"Unsupported embedding backend: {backend}. The supported backends are {BACKENDS}")
+
+
+class HuggingFaceBackend(Embeddings):
+    def __init__(self, model_name: str = DEFAULT_MODEL, threads: int = None):
+        """
+        :param model_name: the sentence-transformers model name
+        :param threads: the number of torch threads, None for one per core
+        """
+        try:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+        except ImportError:
+            raise ImportError("Please install langchain-community first.")
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+        self.model = HuggingFaceEmbeddings(model_name=model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+
+class ONNXBackend(Embeddings):
+    """
+    A sentence-transformers model run by ONNX Runtime: token embeddings are mean-pooled over the attention mask and
+    normalized, like the sentence-transformers pipeline of all-MiniLM-L6-v2
+    """
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL,
+        threads: int = None,
+        quantized: bool = None,
+        batch_tokens: int = 16384,
+        max_length: int = 256,
+        cache_folder: str = MODEL_CACHE,
+    ):
+        """
+        :param model_name: a folder with model.onnx and tokenizer.json, or a model of the Hugging Face hub with an
+            onnx export such as all-MiniLM-L6-v2, downloaded once; a name ending in "-int8" selects the int8 model
+        :param threads: the number of threads running a batch, None for one per core
+        :param quantized: run the int8 model, quantized once from model.onnx into cache_folder, defaults to the model
+            name
+        :param batch_tokens: the maximum number of tokens of a padded batch, texts are batched by length
+        :param max_length: the maximum number of tokens of a text, longer texts are truncated
+        :param cache_folder: the folder of the quantized models, the model folder is left as downloaded
+        """
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ImportError("Please install onnxruntime and tokenizers first.")
+        if quantized is None:
+            quantized = model_name.endswith("-int8")
+        folder = _model_folder(model_name[: -len("-int8")] if model_name.endswith("-int8") else model_name)
+        model_path = _onnx_file(folder)
+        if quantized:
+            model_path = _quantized(model_path, cache_folder)
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(folder, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.no_padding()
+        self.batch_tokens = batch_tokens
+
+    def _batches(self, lengths: List[int]) -> List[List[int]]:
+        # texts sorted by length are cut into batches of at most batch_tokens padded tokens, so short texts are not
+        # padded to the longest text of the call
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches, batch = [], []
+        for i in order:
+            if batch and (len(batch) + 1) * lengths[i] > self.batch_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        encodings = self.tokenizer.encode_batch(texts)
+        vectors = [None] * len(texts)
+        for batch in self._batches([len(encoding.ids) for encoding in encodings]):
+            width = max(len(encodings[i].ids) for i in batch)
+            ids = np.zeros((len(batch), width), dtype=np.int64)
+            mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, i in enumerate(batch):
+                ids[row, : len(encodings[i].ids)] = encodings[i].ids
+                mask[row, : len(encodings[i].ids)] = 1
+            inputs = {"input_ids": ids, "attention_mask": mask, "token_type_ids": np.zeros_like(ids)}
+            tokens = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+            pooled = (tokens * mask[:, :, None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            for row, i in enumerate(batch):
+                vectors[i] = pooled[row].tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _model_folder(model_name: str) -> str:
+    if os.path.isdir(model_name):
+        return model_name
+    try:
+        from huggingface_hub import snapshot_download
+    except ImportError:
+        raise ImportError("Please install huggingface-hub first, or pass the folder of an onnx model.")
+    repo_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    return snapshot_download(repo_id, allow_patterns=["onnx/model.onnx", "model.onnx", "tokenizer.json"])
+
+
+def _onnx_file(folder: str) -> str:
+    for name in ("model.onnx", os.path.join("onnx", "model.onnx")):
+        if os.path.exists(os.path.join(folder, name)):
+            return os.path.join(folder, name)
+    raise FileNotFoundError(f"No model.onnx in {folder}")
+
+
+def _quantized(model_path: str, cache_folder: str) -> str:
+    # the model folder is often a hub snapshot shared with other programs, so the int8 model goes to a folder of our
+    # own, named after the resolved path, size and modification time of the model it is quantized from
+    real_path = os.path.realpath(model_path)
+    stat = os.stat(real_path)
+    key = hashlib.sha1(f"{real_path}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(cache_folder, f"model_int8-{key}.onnx")
+    if not os.path.exists(path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        os.makedirs(cache_folder, exist_ok=True)
+        print(f"Quantizing {model_path} to int8 in {cache_folder}...")
+        quantize_dynamic(model_path, path + ".tmp", weight_type=QuantType.QInt8)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+class HashBackend(Embeddings):
+    """
+    Each word but the most common English ones adds +1 or -1 to one dimension chosen by its hash, so texts sharing
+    words are close. Deterministic and without a model, for tests and benchmarks on machines without one.
+    """
+
+    _word = re.compile(r"\w+")
+    stop_words = frozenset("a an and are for in is it of on or the to what which who with".split())
+
+    def __init__(self, model_name: str = HASH_MODEL):
+        """
+        :param model_name: bag-of-words-<dimension>
+        """
+        match = re.fullmatch(r"bag-of-words-(\d+)", model_name)
+        if match is None:
+            raise ValueError(f"Unsupported hash model: {model_name}, use bag-of-words-<dimension>")
+        self.dim = int(match.group(1))
+        self.slots: Dict[str, Tuple[int, float]] = dict()
+
+    def _slot(self, word: str) -> Tuple[int, float]:
+        if word not in self.slots:
+            digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            self.slots[word] = (digest % self.dim, 1.0 if digest >> 63 else -1.0)
+        return self.slots[word]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in self._word.findall(text.lower()):
+                if word in self.stop_words:
+                    continue
+                slot, sign = self._slot(word)
+                vectors[row, slot] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def index_embeddings(index_info: Dict) -> Dict:
+    """
+    Get the embeddings recorded in the index info, indexes without them were embedded by the default backend and model
+    :param index_info: the index info
+    """
+    return {
+        "embedding_backend": index_info.get("embedding_backend", DEFAULT_BACKEND),
+        "embedding_model": index_info.get("embedding_model", DEFAULT_MODEL),
+    }
+
+
+def check_embeddings(
+    index_info: Dict,
+    backend: Optional[str] = None,
+    model_name: Optional[str] = None,
+) -> Tuple[str, str]:
+    """
+    Get the backend and model to embed the queries of an index with, those the indexer recorded
+    :param index_info: the index info
+    :param backend: the requested backend, None for the recorded one
+    :param model_name: the requested model, None for the recorded one
+    :return: the backend and the model
+    """
+    recorded = index_embeddings(index_info)
+    requested = describe_embeddings(backend or recorded["embedding_backend"], model_name)
+    if model_name is None and requested["embedding_backend"] == recorded["embedding_backend"]:
+        requested["embedding_model"] = recorded["embedding_model"]
+    if requested != recorded:
+        raise ValueError(
+            "The index was embedded by the {embedding_backend} backend with {embedding_model}".format(**recorded)
+            + ", not by the {embedding_backend} backend with {embedding_model}.".format(**requested)
+        )
+    return recorded["embedding_backend"], recorded["embedding_model"]
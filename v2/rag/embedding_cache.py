@@ -0,0 +1,251 @@
+"""
+On-disk cache of embeddings keyed by the model name and a hash of the text.
+
+The cache folder holds an append-only float32 matrix (vectors.f32, one row per text) that is memory-mapped for reads
+and a key file (keys.bin) with the 16-byte digest of each row, in row order. The dimension is kept in info.json. Appends
+are serialized with a file lock so an indexer and several retrievers can share one cache.
+
+The keys are looked up by binary search in sorted_keys.bin, the sorted keys of the first rows followed by their row
+numbers, memory-mapped. Only the keys appended since it was written are read into memory, and once there are TAIL_ROWS
+of them a writer merges them into a new sorted_keys.bin, so opening a cache takes the same time whatever its size.
+"""
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    raise ImportError("Please install langchain-core first.")
+
+try:
+    import fcntl
+except ImportError:  # Windows, appends are not locked
+    fcntl = None
+
+KEY_SIZE = 16
+# the number of keys appended after the sorted keys, held in memory, from which a writer merges them into the sorted
+# keys
+TAIL_ROWS = 65536
+
+
+class EmbeddingCache:
+    def __init__(self, folder: str, readonly: bool = False):
+        """
+        Open or create an embedding cache
+        :param folder: the cache folder
+        :param readonly: never write to the cache, for folders shared read-only
+        """
+        self.folder = folder
+        self.readonly = readonly
+        self.keys_path = os.path.join(folder, "keys.bin")
+        self.vectors_path = os.path.join(folder, "vectors.f32")
+        self.info_path = os.path.join(folder, "info.json")
+        self.sorted_path = os.path.join(folder, "sorted_keys.bin")
+        self.dim = None
+        self.num_rows = 0
+        self.sorted_keys = np.empty(0, dtype=f"S{KEY_SIZE}")
+        self.sorted_rows = np.empty(0, dtype=np.int64)
+        self._sorted_stat = None
+        # the rows appended after the sorted keys by key
+        self.tail: Dict[bytes, int] = dict()
+        self.vectors = None
+        if not readonly:
+            os.makedirs(folder, exist_ok=True)
+        self._refresh()
+        if not readonly and len(self.tail) >= TAIL_ROWS:
+            # caches written before there were sorted keys are sorted once
+            with self._lock():
+                self._refresh()
+                self._merge()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> bytes:
+        """
+        Get the cache key of a text embedded by a model
+        :param model_name: the embedding model name
+        :param text: the embedded text
+        """
+        return hashlib.blake2b(f"{model_name}\0{text}".encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def _stat(self, path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _load_sorted(self):
+        # sorted_keys.bin is replaced rather than rewritten, so the arrays mapped from it stay valid
+        self._sorted_stat = self._stat(self.sorted_path)
+        count = 0 if self._sorted_stat is None else self._sorted_stat[1] // (KEY_SIZE + 8)
+        if count:
+            self.sorted_keys = np.memmap(self.sorted_path, dtype=f"S{KEY_SIZE}", mode="r", shape=(count,))
+            self.sorted_rows = np.memmap(
+                self.sorted_path, dtype="<i8", mode="r", offset=count * KEY_SIZE, shape=(count,)
+            )
+        else:
+            self.sorted_keys = np.empty(0, dtype=f"S{KEY_SIZE}")
+            self.sorted_rows = np.empty(0, dtype=np.int64)
+        self.tail.clear()
+        self.num_rows = count
+
+    def _refresh(self):
+        """
+        Pick up the rows appended since the last refresh, including those appended by other processes, and the sorted
+        keys merged by other processes
+        """
+        if self.dim is None and os.path.exists(self.info_path):
+            with open(self.info_path, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        if self.dim is None or not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+        if self._stat(self.sorted_path) != self._sorted_stat:
+            self._load_sorted()
+        num_rows = min(
+            os.path.getsize(self.keys_path) // KEY_SIZE,
+            os.path.getsize(self.vectors_path) // (4 * self.dim),
+        )
+        if num_rows > self.num_rows:
+            with open(self.keys_path, "rb") as f:
+                f.seek(self.num_rows * KEY_SIZE)
+                new_keys = f.read((num_rows - self.num_rows) * KEY_SIZE)
+            for i in range(0, len(new_keys), KEY_SIZE):
+                self.tail.setdefault(new_keys[i : i + KEY_SIZE], self.num_rows + i // KEY_SIZE)
+            self.num_rows = num_rows
+        if self.num_rows and (self.vectors is None or len(self.vectors) != self.num_rows):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.num_rows, self.dim))
+
+    def _rows(self, keys: List[bytes]) -> List[Optional[int]]:
+        # the row of each key, None for keys not in the cache
+        rows = [self.tail.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing and len(self.sorted_keys):
+            wanted = np.array([keys[i] for i in missing], dtype=f"S{KEY_SIZE}")
+            found = np.minimum(np.searchsorted(self.sorted_keys, wanted), len(self.sorted_keys) - 1)
+            matches = self.sorted_keys[found] == wanted
+            for i, j in zip(np.asarray(missing)[matches], found[matches]):
+                rows[i] = int(self.sorted_rows[j])
+        return rows
+
+    def _merge(self):
+        """
+        Merge the keys appended since the sorted keys were written into new sorted keys, with the lock held
+        """
+        if not self.tail:
+            return
+        keys = np.array(list(self.tail), dtype=f"S{KEY_SIZE}")
+        rows = np.fromiter(self.tail.values(), dtype=np.int64, count=len(self.tail))
+        order = np.argsort(keys, kind="stable")
+        keys, rows = keys[order], rows[order]
+        at = np.searchsorted(self.sorted_keys, keys)
+        merged_keys = np.insert(np.asarray(self.sorted_keys), at, keys)
+        merged_rows = np.insert(np.asarray(self.sorted_rows), at, rows)
+        with open(self.sorted_path + ".tmp", "wb") as f:
+            f.write(merged_keys.tobytes())
+            f.write(merged_rows.astype("<i8").tobytes())
+        os.replace(self.sorted_path + ".tmp", self.sorted_path)
+        self._refresh()
+
+    def _truncate(self, num_rows: int):
+        for path, row_size in ((self.keys_path, KEY_SIZE), (self.vectors_path, 4 * self.dim)):
+            if os.path.exists(path) and os.path.getsize(path) > num_rows * row_size:
+                os.truncate(path, num_rows * row_size)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.folder, "lock"), "w") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def get_many(self, keys: List[bytes]) -> List[np.ndarray]:
+        """
+        Look up embeddings
+        :param keys: the cache keys
+        :return: the embedding of each key, None for keys not in the cache
+        """
+        rows = self._rows(keys)
+        if any(row is None for row in rows):
+            self._refresh()
+            rows = self._rows(keys)
+        return [None if row is None else self.vectors[row] for row in rows]
+
+    def put_many(self, keys: List[bytes], vectors: List[List[float]]):
+        """
+        Add embeddings to the cache, keys already cached are skipped
+        :param keys: the cache keys
+        :param vectors: the embedding of each key
+        """
+        if self.readonly or not keys:
+            return
+        with self._lock():
+            self._refresh()
+            new_rows = dict()
+            for key, vector, row in zip(keys, vectors, self._rows(keys)):
+                if row is None and key not in new_rows:
+                    new_rows[key] = vector
+            if not new_rows:
+                return
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                with open(self.info_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            # vectors are written before keys, so a key on disk always has its row; a writer that died between the
+            # two writes left rows or a partial key without a key, cut off so they do not shift the rows appended now.
+            # Readers only map the rows of complete keys, which are kept.
+            self._truncate(len(self))
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.asarray(list(new_rows.values()), dtype=np.float32).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new_rows))
+            self._refresh()
+            if len(self.tail) >= TAIL_ROWS:
+                self._merge()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that are looked up in an EmbeddingCache before running the model
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: EmbeddingCache):
+        """
+        :param embeddings: the embeddings computing the cache misses
+        :param model_name: the embedding model name, part of the cache key
+        :param cache: the embedding cache
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, texts: List[str], embed_misses) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = dict()
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], texts[i])
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = dict(zip(missing, embed_misses(list(missing.values()))))
+            self.cache.put_many(list(computed), list(computed.values()))
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        # cached rows are float32, round fresh embeddings the same way so results do not depend on cache state
+        return np.asarray(vectors, dtype=np.float32).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
@@ -0,0 +1,238 @@
+"""
+Federated search over several index folders, e.g. one per team or product line: each query is searched in every folder
+in parallel threads, the hits of all folders are merged by normalized score and only the winners are expanded.
+
+    retriever = FederatedRetriever(["knowledge/team_a", "knowledge/product_b"])
+    results = retriever("What is AutoGen Studio?", size=5, target_length=256)
+
+Folders embedded by the same backend and model share one embedding model, and each query is embedded once for them.
+Each result also holds the "index_folder" it comes from. load_retriever opens the shards of a sharded index folder
+written by document_indexer.py --shards this way.
+"""
+import argparse
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import document_retriever
+from document_retriever import MERGE_CANDIDATES, RRF_K, DocumentRetriever, _normalize
+from manifest import load_index_info, load_shards
+from query_cache import LRUCache
+
+
+def normalize_scores(scores: List, mode: str) -> List:
+    """
+    Put the scores of the hits of a query in several folders on one scale, higher is better. Cosine similarities of
+    vector search are comparable between folders and kept. BM25 scores are divided by the best score of all folders.
+    Fused hybrid scores depend on ranks only and are divided by the best possible fused score.
+    :param scores: the scores of the hits in each folder
+    :param mode: the search mode
+    :return: the normalized scores of the hits in each folder
+    """
+    if mode == "keyword":
+        best = max((float(folder_scores.max()) for folder_scores in scores if len(folder_scores)), default=0.0)
+        return [folder_scores / best for folder_scores in scores] if best > 0 else scores
+    if mode == "hybrid":
+        return [folder_scores * (RRF_K + 1) / 2 for folder_scores in scores]
+    return scores
+
+
+class FederatedRetriever:
+    def __init__(self, index_folders: List[str], workers: int = None, cache_size=1024, cache_ttl=None, **kwargs):
+        """
+        :param index_folders: the folders written by document_indexer.py
+        :param workers: the number of threads searching and expanding, defaults to one per folder
+        :param cache_size: the number of query results kept in memory, and of query embeddings by each folder,
+            0 disables both
+        :param cache_ttl: the number of seconds query embeddings and results are kept, None to keep them until evicted
+        :param kwargs: the other arguments of DocumentRetriever, the same for every folder
+        """
+        from embedding_backends import index_embeddings
+
+        if not index_folders:
+            raise ValueError("No index folder to search")
+        self.index_folders = list(index_folders)
+        # the embedding backend and model of each folder, folders sharing them share the model
+        self.embedding_keys = [
+            tuple(index_embeddings(load_index_info(folder)).values()) for folder in self.index_folders
+        ]
+        # each model is loaded and wrapped in the embedding cache of the first folder using it once, the retrievers use
+        # it as it is
+        models = dict()
+        for folder, key in zip(self.index_folders, self.embedding_keys):
+            if key not in models:
+                models[key] = document_retriever.load_query_embeddings(
+                    folder, *key, kwargs.get("threads"), kwargs.get("embedding_cache")
+                )
+        self.retrievers = [
+            DocumentRetriever(folder, cache_size=cache_size, cache_ttl=cache_ttl, embeddings=models[key], **kwargs)
+            for folder, key in zip(self.index_folders, self.embedding_keys)
+        ]
+        self.executor = ThreadPoolExecutor(workers or len(self.retrievers), thread_name_prefix="federated-retriever")
+        self.results = LRUCache(cache_size, cache_ttl)
+
+    def _map(self, function, *iterables) -> List:
+        # faiss searches release the GIL, so the folders are searched at the same time
+        return list(self.executor.map(function, *iterables))
+
+    def __call__(
+        self,
+        query: str,
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        results = self.retrieve_batch([query], size, target_length, nprobe, ef_search, mode, filters)
+        return json.dumps(results[0], indent=4)
+
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        """
+        Retrieve and expand the chunks of several queries from all folders, see DocumentRetriever.retrieve_batch. Each
+        folder is searched for the best hits of the queries, the best hits of all folders win by normalized score and
+        only they are expanded. Results are cached per query and must not be modified.
+        :param queries: the queries
+        :param size: the number of chunks per query, from all folders
+        :param target_length: the number of tokens of each expanded chunk
+        :param nprobe: the number of inverted lists visited by ivf indexes, defaults to the value of each indexer
+        :param ef_search: the candidate list size of hnsw indexes, defaults to the value of each indexer
+        :param mode: "vector" for embedding search, "keyword" for BM25 search, "hybrid" to fuse both rankings
+        :param filters: only search the chunks whose metadata match, see DocumentRetriever.retrieve_batch
+        :return: the expanded chunks of each query, in query order, with their normalized score and index folder
+        """
+        self._map(DocumentRetriever.refresh, self.retrievers)
+        versions = tuple(retriever.version for retriever in self.retrievers)
+        key = document_retriever.filter_key(filters)
+        keys = [(versions, _normalize(query), size, target_length, nprobe, ef_search, mode, key) for query in queries]
+        cached = [self.results.get(key) for key in keys]
+        missing = {key: query for key, query, result in zip(keys, queries, cached) if result is None}
+        computed = dict()
+        if missing:
+            results = self._retrieve(list(missing.values()), size, target_length, nprobe, ef_search, mode, filters)
+            for key, result in zip(missing, results):
+                computed[key] = result
+                self.results.put(key, result)
+        return [computed[key] if result is None else result for key, result in zip(keys, cached)]
+
+    def _retrieve(self, queries: List[str], size, target_length, nprobe, ef_search, mode, filters) -> List[List[Dict]]:
+        vectors = dict()
+        if mode != "keyword":
+            # the queries are embedded once per embedding model rather than once per folder
+            embedders = dict()
+            for retriever, embedding_key in zip(self.retrievers, self.embedding_keys):
+                embedders.setdefault(embedding_key, retriever)
+            embedded = self._map(lambda retriever: retriever.embed_queries(queries), embedders.values())
+            vectors = dict(zip(embedders, embedded))
+        # each folder ranks as many candidates as a single retriever would, hits merged into a window free their slot
+        rankings = self._map(
+            lambda retriever, embedding_key: retriever._rank_batch(
+                queries, size * MERGE_CANDIDATES, nprobe, ef_search, mode, filters, vectors.get(embedding_key)
+            ),
+            self.retrievers,
+            self.embedding_keys,
+        )
+
+        folders = range(len(self.retrievers))
+        scores, winners = [], []
+        for i in range(len(queries)):
+            query_scores = normalize_scores([rankings[folder][i][1] for folder in folders], mode)
+            hits = sorted(
+                ((float(score), folder) for folder in folders for score in query_scores[folder]),
+                key=lambda hit: -hit[0],
+            )
+            scores.append(query_scores)
+            # the number of results each folder wins
+            winners.append(Counter(folder for _, folder in hits[:size]))
+
+        def expand(folder: int) -> List[List[Dict]]:
+            retriever, windows = self.retrievers[folder], dict()
+            return [
+                retriever.merge_expansions(
+                    rankings[folder][i][0], scores[i][folder], winners[i][folder], target_length, windows
+                )
+                if winners[i][folder]
+                else []
+                for i in range(len(queries))
+            ]
+
+        expanded = self._map(expand, folders)
+        results = []
+        for i in range(len(queries)):
+            merged = [
+                {**result, "index_folder": self.index_folders[folder]}
+                for folder in folders
+                for result in expanded[folder][i]
+            ]
+            results.append(sorted(merged, key=lambda result: -result["score"])[:size])
+        return results
+
+    @property
+    def version(self) -> str:
+        # changes when any folder is rebuilt
+        return ",".join(str(retriever.version) for retriever in self.retrievers)
+
+    def cache_info(self):
+        """
+        Get the hit and miss counters of the result cache and of the caches of each folder
+        """
+        return {"results": self.results.info(), "folders": [retriever.cache_info() for retriever in self.retrievers]}
+
+    def close(self):
+        """
+        Stop the search threads
+        """
+        self.executor.shutdown()
+
+
+def load_retriever(index_folder: str, **kwargs):
+    """
+    Open an index folder, the shards of a sharded index folder are searched together by a FederatedRetriever unless
+    they were merged into a single index. Open the folder again after changing its number of shards.
+    :param index_folder: the folder written by document_indexer.py
+    :param kwargs: the other arguments of DocumentRetriever
+    :return: a DocumentRetriever or a FederatedRetriever
+    """
+    shards = load_shards(index_folder)
+    if shards is None or shards["merged"]:
+        return DocumentRetriever(index_folder, **kwargs)
+    if not shards["shards"]:
+        raise ValueError(f"The sharded index {index_folder} has no shards")
+    # the shards share the embedding cache of the sharded folder
+    embedding_cache = os.path.join(index_folder, "embedding_cache")
+    if os.path.isdir(embedding_cache):
+        kwargs.setdefault("embedding_cache", embedding_cache)
+    return FederatedRetriever([os.path.join(index_folder, name) for name in shards["shards"]], **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieve documents from several index folders.")
+    parser.add_argument("query", nargs="+", type=str, help="the queries, retrieved as one batch")
+    parser.add_argument(
+        "-i", "--index_folder", nargs="+", required=True, help="the index folders to search, or one sharded folder"
+    )
+    parser.add_argument("--size", type=int, default=5, help="the number of results per query")
+    parser.add_argument("--target_length", type=int, default=256, help="the number of tokens of each result")
+    parser.add_argument("--mode", choices=document_retriever.SEARCH_MODES, default="vector", help="the search mode")
+    args = parser.parse_args()
+
+    if len(args.index_folder) == 1:
+        retriever = load_retriever(args.index_folder[0])
+    else:
+        retriever = FederatedRetriever(args.index_folder)
+    results = retriever.retrieve_batch(args.query, args.size, args.target_length, mode=args.mode)
+    print(json.dumps(results[0] if len(args.query) == 1 else results, indent=4))
+    if isinstance(retriever, FederatedRetriever):
+        retriever.close()
@@ -0,0 +1,199 @@
+"""
+Manifest of the indexed documents, used by document_indexer.py to re-index only new, changed and deleted files,
+description of the index itself (index_info.json), read by document_retriever.py, and manifest of the shards of a
+sharded index (shards.json).
+
+The manifest is a json file next to the index:
+{
+    "chunk_size": 64,
+    "chunk_step": 64,
+    "dedup_threshold": null,
+    "files": {"relative/path.md": {"size": 123, "mtime": 1700000000.0, "sha256": "...", "chunks": 3}, ...}
+}
+"dedup_threshold" is the near-duplicate threshold of the indexer, null when it kept every chunk, and "chunks" the
+number of chunks of a file in the index.
+
+A sharded index folder holds one index folder per shard, the shard of a file is given by a hash of its source:
+{
+    "count": 4,
+    "chunk_size": 64,
+    "chunk_step": 64,
+    "dedup_threshold": null,
+    "shards": ["shard_000", "shard_001", "shard_003"],
+    "merged": false
+}
+"shards" lists the shards with an index, a shard without files has none. "merged" tells whether the shards were also
+merged into a single index in the folder itself.
+"""
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+MANIFEST_FILE = "manifest.json"
+INDEX_INFO_FILE = "index_info.json"
+SHARDS_FILE = "shards.json"
+
+
+def file_digest(
+    file: str,
+    block_size: int = 1 << 20,
+) -> str:
+    """
+    Get the sha256 hex digest of a file, read in blocks
+    :param file: the file path
+    :param block_size: the number of bytes read at a time
+    """
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_documents(
+    doc_path: str,
+    files: List[str],
+    previous: Dict[str, Dict] = None,
+) -> Dict[str, Dict]:
+    """
+    Build the manifest entries of the given files. A file whose size and mtime did not change since the previous
+    manifest keeps its previous hash instead of being read again.
+    :param doc_path: the path of the documents, the entries are keyed by the path relative to it
+    :param files: the file paths
+    :param previous: the entries of the previous manifest
+    """
+    previous = previous or {}
+    entries = {}
+    for f in files:
+        source = os.path.relpath(f, doc_path)
+        stat = os.stat(f)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+        old_entry = previous.get(source)
+        if old_entry and old_entry["size"] == entry["size"] and old_entry["mtime"] == entry["mtime"]:
+            entry["sha256"] = old_entry["sha256"]
+        else:
+            entry["sha256"] = file_digest(f)
+        entries[source] = entry
+    return entries
+
+
+def diff_manifest(
+    previous: Dict[str, Dict],
+    current: Dict[str, Dict],
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Compare two sets of manifest entries by content hash
+    :param previous: the entries of the previous manifest
+    :param current: the entries of the current documents
+    :return: the added, changed and deleted paths
+    """
+    added = [source for source in current if source not in previous]
+    changed = [
+        source for source in current if source in previous and current[source]["sha256"] != previous[source]["sha256"]
+    ]
+    deleted = [source for source in previous if source not in current]
+    return added, changed, deleted
+
+
+def load_manifest(folder: str) -> Dict:
+    """
+    Load the manifest of an index folder, or None if the folder has no manifest
+    :param folder: the index folder
+    """
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(
+    folder: str,
+    manifest: Dict,
+):
+    """
+    Save the manifest of an index folder, the file is replaced atomically
+    :param folder: the index folder
+    :param manifest: the manifest
+    """
+    path = os.path.join(folder, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def load_index_info(folder: str) -> Dict:
+    """
+    Load the description of how the index of a folder was built, an empty dict for indexes built by earlier
+    versions of the indexer
+    :param folder: the index folder
+    """
+    path = os.path.join(folder, INDEX_INFO_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index_info(
+    folder: str,
+    index_info: Dict,
+):
+    """
+    Save the description of how the index of a folder was built
+    :param folder: the index folder
+    :param index_info: the index type, its search parameters and the version stamp of the build
+    """
+    path = os.path.join(folder, INDEX_INFO_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index_info, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def shard_of(
+    source: str,
+    count: int,
+) -> int:
+    """
+    Get the shard of a file, stable across runs, processes and platforms
+    :param source: the path of the file relative to the documents
+    :param count: the number of shards
+    """
+    digest = hashlib.blake2b(source.replace(os.sep, "/").encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % count
+
+
+def shard_name(shard: int) -> str:
+    """
+    Get the folder name of a shard in a sharded index folder
+    :param shard: the shard number
+    """
+    return f"shard_{shard:03d}"
+
+
+def load_shards(folder: str) -> Dict:
+    """
+    Load the shard manifest of a sharded index folder, or None if the folder is not sharded
+    :param folder: the index folder
+    """
+    path = os.path.join(folder, SHARDS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_shards(
+    folder: str,
+    shards: Dict,
+):
+    """
+    Save the shard manifest of a sharded index folder, the file is replaced atomically
+    :param folder: the index folder
+    :param shards: the shard manifest
+    """
+    path = os.path.join(folder, SHARDS_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(shards, f, indent=1)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,151 @@
+"""
+Chunk selection by source, title or folder, used by document_retriever.py to restrict a search to part of the index.
+
+The chunks of a source are stored contiguously (see neighbor_index.py), so the chunks of any metadata value are a set
+of source ranges. The indexer writes the ids of the sources of every title and every folder (metadata_filters.json),
+sources are looked up by their id in sources.json. A filter becomes a bitmap over the chunk positions when it is first
+queried, nothing is precomputed per value; the retriever caches the bitmaps of recent filters and uses them in faiss
+as a search-time IDSelector and in the keyword search to skip postings, so no chunk outside of it is scored.
+"""
+import json
+import os
+import posixpath
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from neighbor_index import NeighborIndex
+
+FILTERS_FILE = "metadata_filters.json"
+# values of the same field are alternatives, the fields of a filter must all match
+FILTER_FIELDS = ("source", "title", "folder")
+
+
+def _posix(path: str) -> str:
+    return path.replace(os.sep, "/").strip("/")
+
+
+def folders_of(source: str) -> List[str]:
+    """
+    Get the folders containing a source, from its own folder up to the top folder of the documents
+    :param source: the path of the source relative to the documents folder
+    """
+    folders = []
+    folder = posixpath.dirname(_posix(source))
+    while folder:
+        folders.append(folder)
+        folder = posixpath.dirname(folder)
+    return folders
+
+
+def filter_key(filters: Optional[Dict[str, Union[str, List[str]]]]) -> Optional[Tuple]:
+    """
+    Validate a filter and turn it into a hashable key, equal for filters selecting the same chunks
+    :param filters: the values of each field, a string or a list of strings, e.g. {"folder": "api", "title": [...]}
+    :return: the key, None for no filter
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError(f"filters must map fields to values, got {filters!r}")
+    key = []
+    for field, values in sorted(filters.items()):
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unsupported filter field: {field}. The supported fields are {FILTER_FIELDS}")
+        values = [values] if isinstance(values, str) else values
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"The {field} filter must be a string or a list of strings")
+        if field != "title":
+            values = [_posix(value) for value in values]
+        key.append((field, tuple(sorted(set(values)))))
+    return tuple(key)
+
+
+class MetadataFilters:
+    def __init__(self, neighbors: NeighborIndex, values: Dict[str, Dict[str, List[int]]]):
+        """
+        :param neighbors: the neighbor index, with the chunk range of each source
+        :param values: the ids of the sources of each title and each folder
+        """
+        self.neighbors = neighbors
+        self.values = values
+        self.source_ids = {_posix(source): i for i, source in enumerate(neighbors.sources)}
+
+    @classmethod
+    def from_metadata(cls, neighbors: NeighborIndex, metadata_list: Iterable[Dict]) -> "MetadataFilters":
+        """
+        Build the filters from the metadata of the chunks in index order
+        :param neighbors: the neighbor index of the same chunks
+        :param metadata_list: the metadata of each chunk, with source, chunk_id and title
+        """
+        values = {"title": dict(), "folder": dict()}
+        for metadata in metadata_list:
+            if metadata["chunk_id"]:
+                continue
+            source_id = neighbors.source_ids[metadata["source"]]
+            values["title"].setdefault(metadata.get("title", ""), []).append(source_id)
+            for folder in folders_of(metadata["source"]):
+                values["folder"].setdefault(folder, []).append(source_id)
+        return cls(neighbors, values)
+
+    def save(self, folder: str):
+        """
+        Save the filters to an index folder
+        :param folder: the index folder
+        """
+        path = os.path.join(folder, FILTERS_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.values, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, folder: str, neighbors: NeighborIndex) -> "MetadataFilters":
+        """
+        Load the filters of an index folder
+        :param folder: the index folder
+        :param neighbors: the neighbor index of the folder
+        """
+        with open(os.path.join(folder, FILTERS_FILE), encoding="utf-8") as f:
+            return cls(neighbors, json.load(f))
+
+    def select_sources(self, key: Tuple) -> np.ndarray:
+        """
+        Get the sources matching a filter
+        :param key: the filter key, see filter_key
+        :return: the sorted source ids
+        """
+        selected = None
+        for field, values in key:
+            if field == "source":
+                ids = {self.source_ids[value] for value in values if value in self.source_ids}
+            else:
+                ids = {i for value in values for i in self.values[field].get(value, ())}
+            selected = ids if selected is None else selected & ids
+        return np.array(sorted(selected), dtype=np.int64)
+
+    def mask(self, key: Tuple) -> np.ndarray:
+        """
+        Get the chunks matching a filter
+        :param key: the filter key, see filter_key
+        :return: one boolean per chunk position
+        """
+        source_ids = self.select_sources(key)
+        starts = self.neighbors.offsets[source_ids]
+        # +1 at the start and -1 at the end of each selected range, the running sum is 1 inside them: the ranges of
+        # sources do not overlap, so it fits a byte per chunk
+        delta = np.zeros(len(self.neighbors) + 1, dtype=np.int8)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, starts + self.neighbors.counts[source_ids], -1)
+        return np.cumsum(delta[:-1], dtype=np.int8).view(bool)
+
+
+def load_metadata_filters(folder: str, neighbors) -> Optional[MetadataFilters]:
+    """
+    Load the filters of an index folder
+    :param folder: the index folder
+    :param neighbors: the neighbor index of the folder
+    :return: the filters, None for indexes built by earlier versions of the indexer
+    """
+    if not isinstance(neighbors, NeighborIndex) or not os.path.exists(os.path.join(folder, FILTERS_FILE)):
+        return None
+    return MetadataFilters.load(folder, neighbors)
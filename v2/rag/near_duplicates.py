@@ -0,0 +1,119 @@
+"""
+Near-duplicate detection of chunks with MinHash and locality-sensitive hashing, used by document_indexer.py to embed
+and index one copy of the boilerplate repeated across documents: license headers, navigation bars, repeated slides.
+
+A chunk is split into overlapping word n-grams (shingles). Its MinHash signature holds, for each of num_perm hash
+functions, the smallest hash of its shingles; two signatures agree at a position with a probability equal to the
+Jaccard similarity of the shingle sets. The signatures are cut into bands and each band is hashed into a bucket, so a
+chunk is only compared with the earlier chunks sharing one of its buckets.
+"""
+import re
+import zlib
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_word = re.compile(r"\w+")
+
+
+def lsh_parameters(threshold: float, num_perm: int = NUM_PERM) -> Tuple[int, int]:
+    """
+    Get the number of bands and of rows per band of the buckets: chunks with a Jaccard similarity s share a bucket
+    with probability 1 - (1 - s^rows)^bands, which rises steeply around (1 / bands)^(1 / rows). The steepest point
+    is taken just below the threshold, candidates are checked against the threshold anyway.
+    :param threshold: the Jaccard similarity above which chunks are near duplicates
+    :param num_perm: the number of hash functions of a signature
+    """
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [split for split in splits if (1 / split[0]) ** (1 / split[1]) <= threshold]
+    return max(below, key=lambda split: (1 / split[0]) ** (1 / split[1])) if below else splits[-1]
+
+
+class NearDuplicates:
+    def __init__(self, threshold: float = 0.9, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed=1):
+        """
+        :param threshold: the estimated Jaccard similarity of the word shingles above which a chunk is a near duplicate
+        :param num_perm: the number of hash functions of a signature, more estimate the similarity closer and take
+            4 bytes more per kept chunk
+        :param shingle_size: the number of words of a shingle
+        :param seed: the seed of the hash functions
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"The near-duplicate threshold must be in (0, 1], not {threshold}")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = lsh_parameters(threshold, num_perm)
+        self.buckets: List[Dict[bytes, List[int]]] = [dict() for _ in range(self.bands)]
+        self.signatures: List[np.ndarray] = []
+        self.keys: List[Hashable] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        Get the MinHash signature of a text
+        :param text: the text
+        :return: the signature, None for a text without words
+        """
+        words = _word.findall(text.lower())
+        if not words:
+            return None
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), np.uint64, len(shingles))
+        # universal hashing modulo a Mersenne prime, the products wrap around like in datasketch
+        permuted = (hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _bands(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows : (band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def find(self, signature: np.ndarray) -> Optional[Hashable]:
+        """
+        Find the kept chunk most similar to a signature above the threshold
+        :param signature: the signature
+        :return: the key of the chunk, None if there is none
+        """
+        candidates = {i for bucket, band in zip(self.buckets, self._bands(signature)) for i in bucket.get(band, ())}
+        best, best_similarity = None, self.threshold
+        for i in sorted(candidates):
+            similarity = float(np.mean(self.signatures[i] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = i, similarity
+                if similarity == 1:
+                    break
+        return None if best is None else self.keys[best]
+
+    def add(self, key: Hashable, signature: np.ndarray):
+        """
+        Keep a chunk, later near duplicates of it are found by its key
+        :param key: the key of the chunk
+        :param signature: its signature
+        """
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            bucket.setdefault(band, []).append(len(self.keys))
+        self.signatures.append(signature)
+        self.keys.append(key)
+
+    def check(self, key: Hashable, text: str) -> Optional[Hashable]:
+        """
+        Find the kept near duplicate of a chunk, or keep the chunk when there is none
+        :param key: the key of the chunk
+        :param text: the text of the chunk
+        :return: the key of the kept near duplicate, None if the chunk was kept
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return None
+        original = self.find(signature)
+        if original is None:
+            self.add(key, signature)
+        return original
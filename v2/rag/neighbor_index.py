@@ -0,0 +1,159 @@
+"""
+Position of every chunk in the vector index, used to find the neighbors of a hit when expanding it.
+
+The chunks of a source are stored contiguously and in chunk id order, so the position of chunk i of a source is
+offsets[source] + i. The index folder holds the sources in order (sources.json) and two NumPy arrays with the
+position of the first chunk and the number of chunks of each source, loaded memory-mapped.
+"""
+import json
+import os
+import pickle
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+SOURCES_FILE = "sources.json"
+OFFSETS_FILE = "source_offsets.npy"
+COUNTS_FILE = "source_counts.npy"
+LEGACY_FILE = "chunk_id_to_index.pkl"
+
+
+def _save_array(path: str, values: np.ndarray):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(path + ".tmp", path)
+
+
+class NeighborIndex:
+    def __init__(self, sources: List[str], offsets: np.ndarray, counts: np.ndarray):
+        """
+        :param sources: the sources in index order
+        :param offsets: the position of the first chunk of each source
+        :param counts: the number of chunks of each source
+        """
+        self.sources = sources
+        self.offsets = offsets
+        self.counts = counts
+        self.source_ids = {source: i for i, source in enumerate(sources)}
+
+    def __len__(self) -> int:
+        return int(self.counts.sum())
+
+    def position(self, source: str, chunk_id: int) -> Optional[int]:
+        """
+        Get the position of a chunk in the vector index
+        :param source: the source of the chunk
+        :param chunk_id: the chunk id within the source
+        :return: the position, None if the source has no such chunk
+        """
+        source_id = self.source_ids.get(source)
+        if source_id is None or not 0 <= chunk_id < self.counts[source_id]:
+            return None
+        return int(self.offsets[source_id]) + chunk_id
+
+    @classmethod
+    def from_metadata(cls, metadata_list: Iterable[Dict]) -> "NeighborIndex":
+        """
+        Build the index from the metadata of the chunks in index order
+        :param metadata_list: the metadata of each chunk, with source and chunk_id
+        """
+        builder = NeighborIndexBuilder()
+        for metadata in metadata_list:
+            builder.add(metadata)
+        return builder.build()
+
+    def save(self, folder: str):
+        """
+        Save the index to an index folder
+        :param folder: the index folder
+        """
+        # retrievers memory-map the arrays, so every file is replaced rather than overwritten in place: truncating a
+        # mapped file kills its readers with SIGBUS
+        sources_path = os.path.join(folder, SOURCES_FILE)
+        with open(sources_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.sources, f)
+        _save_array(os.path.join(folder, OFFSETS_FILE), self.offsets)
+        _save_array(os.path.join(folder, COUNTS_FILE), self.counts)
+        os.replace(sources_path + ".tmp", sources_path)
+        # drop the mapping written by earlier versions of the indexer, it would be stale
+        if os.path.exists(os.path.join(folder, LEGACY_FILE)):
+            os.remove(os.path.join(folder, LEGACY_FILE))
+
+    @classmethod
+    def load(cls, folder: str) -> "NeighborIndex":
+        """
+        Load the index of an index folder, the arrays are memory-mapped
+        :param folder: the index folder
+        """
+        with open(os.path.join(folder, SOURCES_FILE), encoding="utf-8") as f:
+            sources = json.load(f)
+        offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        counts = np.load(os.path.join(folder, COUNTS_FILE), mmap_mode="r")
+        return cls(sources, offsets, counts)
+
+
+class NeighborIndexBuilder:
+    """
+    Builds a NeighborIndex from the metadata of chunks added one at a time in index order, holding one entry per
+    source
+    """
+
+    def __init__(self):
+        self.sources: List[str] = []
+        self.offsets = array("q")
+        self.counts = array("q")
+        self.position = 0
+
+    def add(self, metadata: Dict):
+        """
+        Add the next chunk
+        :param metadata: the metadata of the chunk, with source and chunk_id
+        """
+        if self.sources and self.sources[-1] == metadata["source"]:
+            self.counts[-1] += 1
+        else:
+            self.sources.append(metadata["source"])
+            self.offsets.append(self.position)
+            self.counts.append(1)
+        self.position += 1
+        if metadata["chunk_id"] != self.counts[-1] - 1:
+            raise ValueError(
+                f"Chunk {metadata['chunk_id']} of {metadata['source']} is not stored right after the previous "
+                f"chunk of its source."
+            )
+
+    def build(self) -> NeighborIndex:
+        """
+        Get the index of the added chunks
+        """
+        if len(set(self.sources)) != len(self.sources):
+            raise ValueError("The chunks of each source must be stored contiguously.")
+        offsets, counts = np.array(self.offsets, dtype=np.int64), np.array(self.counts, dtype=np.int64)
+        return NeighborIndex(self.sources, offsets, counts)
+
+
+class LegacyNeighborIndex:
+    """
+    The "<source>_<chunk_id>" to position mapping pickled by earlier versions of the indexer
+    """
+
+    def __init__(self, chunk_id_to_index: Dict[str, int]):
+        self.chunk_id_to_index = chunk_id_to_index
+
+    def __len__(self) -> int:
+        return len(self.chunk_id_to_index)
+
+    def position(self, source: str, chunk_id: int) -> Optional[int]:
+        return self.chunk_id_to_index.get(f"{source}_{chunk_id}")
+
+
+def load_neighbor_index(folder: str):
+    """
+    Load the neighbor index of an index folder, falling back to the pickled mapping of older indexes
+    :param folder: the index folder
+    """
+    if os.path.exists(os.path.join(folder, SOURCES_FILE)):
+        return NeighborIndex.load(folder)
+    with open(os.path.join(folder, LEGACY_FILE), "rb") as f:
+        return LegacyNeighborIndex(pickle.load(f))
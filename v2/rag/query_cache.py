@@ -0,0 +1,69 @@
+"""
+Bounded in-memory LRU cache with an optional time to live, used by document_retriever.py to reuse the embeddings and
+results of queries asked again.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        """
+        :param max_size: the number of entries kept, the least recently used entry is evicted first, 0 disables
+            the cache
+        :param ttl: the number of seconds an entry is kept, None to keep entries until they are evicted
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # the retriever may be shared by the threads of a server
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable):
+        """
+        Get the value of a key and mark it as recently used
+        :param key: the key
+        :return: the value, None if the key is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value):
+        """
+        Set the value of a key, evicting the least recently used entries beyond max_size
+        :param key: the key
+        :param value: the value, not None
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self) -> Dict[str, int]:
+        """
+        Get the hit and miss counters and the size of the cache
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size}
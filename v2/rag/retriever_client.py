@@ -0,0 +1,135 @@
+"""
+Client of retriever_server.py with the call signature of DocumentRetriever, standard library only, so a skill
+switches to the resident server by replacing DocumentRetriever(index_folder) with RetrieverClient(url):
+
+    retriever = RetrieverClient("http://127.0.0.1:8765")  # or RetrieverClient("unix:///tmp/retriever.sock")
+    results = retriever("What is AutoGen Studio?", size=5, target_length=256)
+
+It imports no other module of this folder, so its content can be pasted as a skill on its own, see retrieve_documents.
+"""
+import http.client
+import json
+import socket
+from typing import List
+from urllib.parse import urlsplit
+
+# Configuration - Users/AI skill developers must update this address to the one of their retriever_server.py
+CONFIG = {
+    "server_url": "http://127.0.0.1:8765",  # or unix:///path/to/socket
+}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RetrieverClient:
+    def __init__(self, url: str = None, timeout: float = 60):
+        """
+        :param url: the server address, http://host:port or unix:///path/to/socket, None for the one in CONFIG
+        :param timeout: the number of seconds to wait for an answer
+        """
+        url = url or CONFIG["server_url"]
+        self.url = url
+        self.timeout = timeout
+        parts = urlsplit(url)
+        if parts.scheme == "unix":
+            self.socket_path = parts.path
+        elif parts.scheme == "http":
+            self.socket_path = None
+            self.host, self.port = parts.hostname, parts.port or 80
+        else:
+            raise ValueError(f"Unsupported url: {url}, use http://host:port or unix:///path/to/socket")
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method: str, path: str, body=None):
+        connection = self._connection()
+        try:
+            data = None if body is None else json.dumps(body).encode("utf-8")
+            connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status == 400:
+            raise ValueError(result["error"])
+        if response.status != 200:
+            raise RuntimeError(f"Retriever server error {response.status}: {result.get('error')}")
+        return result
+
+    def __call__(
+        self,
+        query: str,
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        """
+        Retrieve and expand the chunks of a query, see DocumentRetriever.__call__
+        :return: the expanded chunks as a JSON string
+        """
+        request = {"query": query, "size": size, "target_length": target_length, "mode": mode}
+        results = self._request("POST", "/retrieve", _with_search_parameters(request, nprobe, ef_search, filters))
+        return json.dumps(results, indent=4)
+
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        size: int = 5,
+        target_length: int = 256,
+        nprobe=None,
+        ef_search=None,
+        mode: str = "vector",
+        filters=None,
+    ):
+        """
+        Retrieve and expand the chunks of several queries, see DocumentRetriever.retrieve_batch
+        :return: the expanded chunks of each query, in query order
+        """
+        request = {"queries": list(queries), "size": size, "target_length": target_length, "mode": mode}
+        return self._request("POST", "/retrieve", _with_search_parameters(request, nprobe, ef_search, filters))
+
+    def health(self):
+        """
+        Get the index version, the number of batches retrieved and the cache counters of the server
+        """
+        return self._request("GET", "/health")
+
+
+def _with_search_parameters(request, nprobe, ef_search, filters):
+    if nprobe is not None:
+        request["nprobe"] = nprobe
+    if ef_search is not None:
+        request["ef_search"] = ef_search
+    if filters:
+        request["filters"] = filters
+    return request
+
+
+def retrieve_documents(query: str, size: int = 5, target_length: int = 256, mode: str = "vector", filters=None):
+    """
+    Retrieve the chunks of the indexed documents most relevant to a query from the retriever server in CONFIG,
+    each expanded with its neighbors to about target_length tokens
+    :param query: the query
+    :param size: the number of chunks
+    :param target_length: the number of tokens of each expanded chunk
+    :param mode: vector, keyword or hybrid search
+    :param filters: only search the chunks of these sources, titles or folders, e.g. {"folder": "api"}
+    :return: the expanded chunks and their metadata as a JSON string
+    """
+    return RetrieverClient()(query, size=size, target_length=target_length, mode=mode, filters=filters)
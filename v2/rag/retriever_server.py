@@ -0,0 +1,234 @@
+"""
+Resident retriever service: keeps the embedding model and the index of a folder loaded and answers retrieval requests
+as JSON over localhost HTTP or a Unix socket, so skills do not load them again on every call.
+
+POST /retrieve with {"query": "...", "size": 5, "target_length": 256, "mode": "vector"} returns the expanded chunks
+like DocumentRetriever.__call__, or with {"queries": [...], ...} the expanded chunks of each query like
+DocumentRetriever.retrieve_batch. "nprobe", "ef_search" and "filters" are optional. GET /health returns the index
+version and the cache counters. Requests arriving together are retrieved as one batch. Use retriever_client.py to call
+it.
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from document_retriever import CONFIG, DocumentRetriever
+from federated_retriever import load_retriever
+
+DEFAULT_PORT = 8765
+# options of a request, requests with the same options are retrieved in one batch
+OPTIONS = {"size": 5, "target_length": 256, "nprobe": None, "ef_search": None, "mode": "vector", "filters": None}
+
+
+class RequestBatcher:
+    """
+    Collects the requests of the handler threads and retrieves them in batches on one thread, waiting at most
+    max_wait seconds after the first request of a batch for more requests
+    """
+
+    def __init__(self, retriever: DocumentRetriever, max_batch: int = 64, max_wait: float = 0.005):
+        """
+        :param retriever: the retriever, only used from the batching thread
+        :param max_batch: the maximum number of queries retrieved in one batch
+        :param max_wait: the number of seconds to wait for more requests after the first one of a batch
+        """
+        self.retriever = retriever
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="retriever-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, queries: List[str], options: Dict) -> Future:
+        """
+        Queue queries for retrieval
+        :param queries: the queries
+        :param options: the retrieval options, see OPTIONS
+        :return: a future of the expanded chunks of each query
+        """
+        future = Future()
+        self.requests.put((queries, {**OPTIONS, **options}, future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        count = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # retrieve what was collected, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+            count += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            groups = dict()
+            # requests cancelled while queued are dropped, the others can no longer be cancelled
+            for request in filter(lambda request: request[2].set_running_or_notify_cancel(), batch):
+                # filters are dicts, the options are compared by their JSON form
+                groups.setdefault(json.dumps(request[1], sort_keys=True), []).append(request)
+            for requests in groups.values():
+                queries = [query for request_queries, _, _ in requests for query in request_queries]
+                try:
+                    results = self.retriever.retrieve_batch(queries, **requests[0][1])
+                except Exception as e:
+                    for _, _, future in requests:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                for request_queries, _, future in requests:
+                    future.set_result(results[: len(request_queries)])
+                    results = results[len(request_queries) :]
+
+
+class RetrieverHandler(BaseHTTPRequestHandler):
+    server_version = "RetrieverServer/1.0"
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": f"Unknown path: {self.path}"})
+        batcher = self.server.batcher
+        self._reply(
+            200,
+            {
+                "status": "ok",
+                "version": batcher.retriever.version,
+                "batches": batcher.batches,
+                "cache": batcher.retriever.cache_info(),
+            },
+        )
+
+    def do_POST(self):
+        if self.path != "/retrieve":
+            return self._reply(404, {"error": f"Unknown path: {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            single = "queries" not in request
+            queries = [request["query"]] if single else request["queries"]
+            if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                raise ValueError("query must be a string and queries a list of strings")
+            options = {key: request[key] for key in OPTIONS if key in request}
+        except (ValueError, KeyError) as e:
+            return self._reply(400, {"error": f"Invalid request: {e}"})
+        try:
+            results = self.server.batcher.submit(queries, options).result()
+        except ValueError as e:
+            return self._reply(400, {"error": str(e)})
+        except Exception as e:
+            return self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+        self._reply(200, results[0] if single else results)
+
+    def _reply(self, status: int, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # clients of a unix socket have no address, the request handler logs one
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def create_server(
+    retriever: DocumentRetriever,
+    host: str = "127.0.0.1",
+    port: int = DEFAULT_PORT,
+    socket_path: str = None,
+    max_batch: int = 64,
+    max_wait: float = 0.005,
+    verbose: bool = False,
+):
+    """
+    Create a retriever server, call serve_forever on it to answer requests
+    :param retriever: the retriever
+    :param host: the host to listen on
+    :param port: the port to listen on, 0 for any free port
+    :param socket_path: the unix socket to listen on instead of host and port
+    :param max_batch: the maximum number of queries retrieved in one batch
+    :param max_wait: the number of seconds to wait for more requests after the first one of a batch
+    :param verbose: log every request
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RetrieverHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RetrieverHandler)
+        server.daemon_threads = True
+    server.batcher = RequestBatcher(retriever, max_batch, max_wait)
+    server.verbose = verbose
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve document retrieval over localhost HTTP or a unix socket.")
+    parser.add_argument("-i", "--index_folder", type=str, default=CONFIG["index_folder"], help="the index folder")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="the host to listen on")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="the port to listen on")
+    parser.add_argument("--socket", type=str, default=None, help="the unix socket to listen on instead of a port")
+    parser.add_argument("--max_batch", type=int, default=64, help="the maximum number of queries in one batch")
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=5, help="the time to wait for more requests before retrieving a batch"
+    )
+    parser.add_argument("--cache_size", type=int, default=1024, help="the number of cached queries, 0 disables it")
+    parser.add_argument("--threads", type=int, default=None, help="the number of threads embedding a batch")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    print(f"Loading index {args.index_folder}...")
+    # the shards of a sharded index folder are searched together
+    retriever = load_retriever(args.index_folder, cache_size=args.cache_size, threads=args.threads)
+    server = create_server(
+        retriever, args.host, args.port, args.socket, args.max_batch, args.max_wait_ms / 1000, args.verbose
+    )
+    print(f"Serving on {args.socket or f'http://{args.host}:{server.server_address[1]}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)